@@ -0,0 +1,192 @@
+"""
+ArrayApertureMetric.py
+
+Structure-of-arrays counterpart of ApertureMetric.Aperture.
+Instead of one LeafPair (and one Rect) object per leaf pair, bank A/B positions, leaf tops,
+leaf widths and jaw are kept as NumPy arrays, and field sizes, areas, open leaf widths and
+side perimeters are computed for all leaf pairs in one vectorized call.
+
+Leaf positions may carry leading dimensions (e.g. one row per control point), in which case
+every quantity is computed for all apertures at once and reductions run over the last axis.
+Results are identical to the ones of Aperture.Area() and Aperture.side_perimeter().
+"""
+
+import numpy as np
+
+from macaron_plancomplexity.jit_utils import compiled, side_perimeter_kernel
+
+
+def sequential_sum(values: np.ndarray) -> np.ndarray:
+    """
+    Sums values over the last axis from left to right, like the builtin sum does
+    (np.sum uses pairwise summation, which may differ in the last bits)
+    :param values: array to reduce over its last axis
+    :return: the sums
+    """
+    if values.shape[-1] == 0:
+        return np.zeros(values.shape[:-1])
+    return np.cumsum(values, axis=-1)[..., -1]
+
+
+class ArrayAperture:
+    """
+        The second to last dimension of leaf_positions corresponds to the bank (A, B),
+        and the last dimension corresponds to the leaf pair.
+        Leaf coordinates follow the IEC 61217 standard, as in ApertureMetric.Aperture.
+
+        jaw is the position of the jaw, given as left, top, right, bottom;
+        it can be a single jaw or one jaw per aperture (..., 4).
+    """
+
+    def __init__(self, leaf_positions, leaf_widths, jaw):
+        """
+        :param leaf_positions: Numpy array of floats, shaped (..., 2, n_pairs)
+        :param leaf_widths: Numpy array 1D with n_pairs widths
+        :param jaw: jaw positions (left, top, right, bottom), shaped (4,) or (..., 4)
+        """
+        positions = np.asarray(leaf_positions, dtype=float)
+        self.left = positions[..., 0, :]
+        self.right = positions[..., 1, :]
+        self.widths = np.asarray(leaf_widths, dtype=float)
+        self.tops = self.GetLeafTops(self.widths)
+        self.bottoms = self.tops - self.widths
+
+        jaw = np.asarray(jaw, dtype=float)
+        # Trailing singleton axis lets jaw edges broadcast against leaf pairs
+        self.jaw_left = jaw[..., 0, None]
+        self.jaw_top = jaw[..., 1, None]
+        self.jaw_right = jaw[..., 2, None]
+        self.jaw_bottom = jaw[..., 3, None]
+
+    @staticmethod
+    def GetLeafTops(widths: np.ndarray) -> np.ndarray:
+        """
+        Using the leaf widths, creates an array of the location
+        of all the leaf tops (relative to the isocenter), as Aperture.GetLeafTops
+        :param widths: leaf widths
+        :return: leaf tops
+        """
+        leaf_tops = np.zeros(len(widths))
+
+        # Leaf index right below isocenter
+        middle_index = int(len(widths) / 2)
+
+        # Bottom half: running difference going down, top half: running sum going up
+        leaf_tops[middle_index + 1:] = -np.cumsum(widths[middle_index:-1])
+        leaf_tops[:middle_index] = np.cumsum(widths[:middle_index][::-1])[::-1]
+
+        return leaf_tops
+
+    @property
+    def LeafPairCount(self) -> int:
+        return self.widths.shape[0]
+
+    def IsOutsideJaw(self) -> np.ndarray:
+        """
+            Same as LeafPair.IsOutsideJaw, for all leaf pairs
+            (edges equal to the jaw edge count as outside)
+        """
+        return (
+            (self.jaw_top <= self.bottoms)
+            | (self.jaw_bottom >= self.tops)
+            | (self.jaw_left >= self.right)
+            | (self.jaw_right <= self.left)
+        )
+
+    # Methods below accept the quantities they are derived from, if already computed (see BeamQuantities)
+
+    def FieldSize(self, outside: np.ndarray = None) -> np.ndarray:
+        if outside is None:
+            outside = self.IsOutsideJaw()
+        size = np.minimum(self.jaw_right, self.right) - np.maximum(self.jaw_left, self.left)
+        return np.where(outside, 0.0, size)
+
+    def OpenLeafWidth(self, outside: np.ndarray = None) -> np.ndarray:
+        """
+        Returns the amount of leaf width that is open,
+        considering the position of the jaw
+        """
+        if outside is None:
+            outside = self.IsOutsideJaw()
+        width = np.minimum(self.jaw_top, self.tops) - np.maximum(self.jaw_bottom, self.bottoms)
+        return np.where(outside, 0.0, width)
+
+    def FieldArea(self, field_size: np.ndarray = None, open_width: np.ndarray = None) -> np.ndarray:
+        if field_size is None:
+            field_size = self.FieldSize()
+        if open_width is None:
+            open_width = self.OpenLeafWidth()
+        return field_size * open_width
+
+    @property
+    def LeafPairArea(self) -> np.ndarray:
+        return self.FieldArea()
+
+    def IsOpenButBehindJaw(self, field_size: np.ndarray = None) -> np.ndarray:
+        if field_size is None:
+            field_size = self.FieldSize()
+        return (field_size > 0.0) & ((self.jaw_left > self.left) | (self.jaw_right < self.right))
+
+    def HasOpenLeafBehindJaws(self) -> np.ndarray:
+        return np.any(self.IsOpenButBehindJaw(), axis=-1)
+
+    def Area(self, field_area: np.ndarray = None) -> np.ndarray:
+        if field_area is None:
+            field_area = self.FieldArea()
+        return sequential_sum(field_area)
+
+    def side_perimeter(self, field_size: np.ndarray = None, outside: np.ndarray = None) -> np.ndarray:
+        """
+            Vectorized Aperture.side_perimeter: each leaf pair is compared with the previous one
+            (the first one with the last, as the per-object implementation does).
+            Uses the compiled kernel of jit_utils when numba is available
+        """
+        if self.LeafPairCount == 0:
+            return np.zeros(self.left.shape[:-1])
+
+        if outside is None:
+            outside = self.IsOutsideJaw()
+        if field_size is None:
+            field_size = self.FieldSize(outside)
+
+        kernel = compiled(side_perimeter_kernel)
+        if kernel is not None:
+            shape = np.broadcast_shapes(self.left.shape, self.jaw_left.shape)
+            jaws = np.concatenate((self.jaw_left, self.jaw_top, self.jaw_right, self.jaw_bottom), axis=-1)
+            perimeters = kernel(
+                np.ascontiguousarray(np.broadcast_to(self.left, shape).reshape(-1, shape[-1])),
+                np.ascontiguousarray(np.broadcast_to(self.right, shape).reshape(-1, shape[-1])),
+                self.tops,
+                self.bottoms,
+                np.ascontiguousarray(np.broadcast_to(jaws, shape[:-1] + (4,)).reshape(-1, 4)),
+                np.ascontiguousarray(np.broadcast_to(field_size, shape).reshape(-1, shape[-1])),
+                np.ascontiguousarray(np.broadcast_to(outside, shape).reshape(-1, shape[-1])),
+            )
+            return perimeters.reshape(shape[:-1])
+
+        # Top leaf pair of each (top, bottom) couple
+        top_size = np.roll(field_size, 1, axis=-1)
+        top_outside = np.roll(outside, 1, axis=-1)
+        top_left = np.roll(self.left, 1, axis=-1)
+        top_right = np.roll(self.right, 1, axis=-1)
+        top_bottoms = np.roll(self.bottoms, 1)
+
+        top_edge_left = np.maximum(self.jaw_left, top_left)
+        bottom_edge_left = np.maximum(self.jaw_left, self.left)
+        top_edge_right = np.minimum(self.jaw_right, top_right)
+        bottom_edge_right = np.minimum(self.jaw_right, self.right)
+        overlap = np.abs(top_edge_left - bottom_edge_left) + np.abs(top_edge_right - bottom_edge_right)
+
+        # Same precedence as the if-chain of Aperture.SidePerimeter
+        conditions = [
+            top_outside & outside,
+            np.broadcast_to(self.jaw_top <= top_bottoms, overlap.shape),
+            np.broadcast_to(self.jaw_bottom >= self.tops, overlap.shape),
+            (self.left > top_right) | (self.right < top_left),
+        ]
+        choices = [0.0, field_size, top_size, top_size + field_size]
+        sides = np.select(conditions, choices, default=overlap)
+
+        # Top end of first leaf pair, sides, bottom end of last leaf pair
+        terms = np.concatenate((field_size[..., :1], sides, field_size[..., -1:]), axis=-1)
+        return sequential_sum(terms)
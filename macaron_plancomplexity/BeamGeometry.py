@@ -0,0 +1,138 @@
+from typing import Dict
+
+import numpy as np
+
+from macaron_plancomplexity.decoding_utils import (
+    GANTRY_ANGLE,
+    CUMULATIVE_METERSET_WEIGHT,
+    decode_DS_rows,
+    get_control_point_values,
+    get_raw_leaf_jaw_positions)
+
+
+class BeamGeometry:
+    """
+    Geometry of a beam, decoded once from its control points into a few NumPy arrays, so that metrics
+    do not need the pydicom dataset (which can then be released, see DICOMItem.release_dataset):
+        control_point_count, the number of control points of the beam,
+        meterset_weights (control_point_count), the cumulative meterset weight of each control point,
+        leaf_widths (n_leaves) of the MLC (None if the beam has no MLC),
+    and for the control points carrying a BeamLimitingDevicePositionSequence:
+        control_point_indexes (n_cp, position in the ControlPointSequence),
+        gantry_angles (n_cp),
+        leaf_positions (n_cp x 2 x n_leaves) of the last beam limiting device,
+        y_jaw_positions (n_cp x 2) and mlc_positions (n_cp x 2 n_leaves), the devices read by the custom metrics.
+    Positions that cannot be read from the beam (e.g. a beam without MLC) are None.
+    Instances are immutable and their arrays are read-only, so they are shared by all the metrics;
+    the geometry is cached in the beam dict.
+    """
+
+    CACHE_KEY = "BeamGeometry"
+
+    __slots__ = ("control_point_count", "meterset_weights", "leaf_widths", "control_point_indexes",
+                 "gantry_angles", "leaf_positions", "y_jaw_positions", "mlc_positions")
+
+    def __init__(
+        self,
+        control_point_count: int,
+        meterset_weights: np.ndarray,
+        leaf_widths: np.ndarray,
+        control_point_indexes: np.ndarray,
+        gantry_angles: np.ndarray,
+        leaf_positions: np.ndarray,
+        y_jaw_positions: np.ndarray = None,
+        mlc_positions: np.ndarray = None,
+    ) -> None:
+        values = (control_point_count, meterset_weights, leaf_widths, control_point_indexes,
+                  gantry_angles, leaf_positions, y_jaw_positions, mlc_positions)
+        for name, value in zip(self.__slots__, values):
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BeamGeometry is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("BeamGeometry is immutable")
+
+    def __reduce__(self):
+        return self.__class__, tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return "BeamGeometry - %d control points, %d with positions" % (
+            self.control_point_count, len(self.control_point_indexes))
+
+    @property
+    def nbytes(self) -> int:
+        """
+            Memory used by the arrays of the geometry (arrays sharing memory are counted once)
+        """
+        total = 0
+        counted = []
+        for name in self.__slots__:
+            array = getattr(self, name)
+            if isinstance(array, np.ndarray):
+                if not any(np.shares_memory(array, other) for other in counted):
+                    total += array.nbytes
+                counted.append(array)
+        return total
+
+    @classmethod
+    def from_beam(cls, beam: Dict[str, str]) -> "BeamGeometry":
+        """
+            Returns the geometry of a beam, extracting it on first request
+        :param beam: Dicomparser Beam dict from plan_dict
+        :return: the BeamGeometry of the beam
+        """
+        geometry = beam.get(cls.CACHE_KEY)
+        if geometry is None:
+            geometry = cls.build(beam)
+            beam[cls.CACHE_KEY] = geometry
+        return geometry
+
+    @classmethod
+    def build(cls, beam: Dict[str, str]) -> "BeamGeometry":
+        # Positions, angles and weights of all the control points are decoded at once from the raw DS values
+        control_points = beam["ControlPointSequence"]
+        indexes, positions = get_raw_leaf_jaw_positions(control_points)
+        default_angle = float(beam["GantryAngle"]) if beam["GantryAngle"] != "" else np.nan
+        gantry_angles = get_control_point_values(control_points, GANTRY_ANGLE, default_angle)[indexes]
+        meterset_weights = get_control_point_values(control_points, CUMULATIVE_METERSET_WEIGHT)
+
+        leaf_widths = cls.GetLeafWidths(beam["BeamLimitingDeviceSequence"])
+        n_leaves = len(leaf_widths) if leaf_widths is not None else 0
+        try:
+            leaf_positions = decode_DS_rows([devices[-1] for devices in positions]).reshape(len(indexes), 2, n_leaves)
+        except (IndexError, ValueError):
+            leaf_positions = None
+
+        # Custom metrics read the Y jaws and the MLC as the second and third of three devices, or as the first
+        # and second of two: the MLC is then the last device, whose positions are shared
+        y_jaw_positions = None
+        mlc_positions = None
+        try:
+            y_jaw_positions = decode_DS_rows([devices[1] if len(devices) == 3 else devices[0] for devices in positions])
+            if (leaf_positions is not None) and all(len(devices) in (2, 3) for devices in positions):
+                mlc_positions = leaf_positions.reshape(len(indexes), 2 * n_leaves)
+            else:
+                mlc_positions = decode_DS_rows([devices[2] if len(devices) == 3 else devices[1]
+                                                for devices in positions])
+        except (IndexError, ValueError):
+            y_jaw_positions = None
+
+        return cls(len(control_points), meterset_weights, leaf_widths, indexes, gantry_angles, leaf_positions,
+                   y_jaw_positions, mlc_positions)
+
+    @staticmethod
+    def GetLeafWidths(beam_limiting_devices) -> np.ndarray:
+        """
+            Get MLCX leaf width from  BeamLimitingDeviceSequence
+            (300a, 00be) Leaf Position Boundaries Tag
+        :param beam_limiting_devices: the BeamLimitingDeviceSequence of the beam
+        :return: MLCX leaf width, None if the beam has no MLCX
+        """
+        # the script only takes MLCX as parameter
+        for device in beam_limiting_devices:
+            if device.RTBeamLimitingDeviceType in ["MLCX", "MLCX1", "MLCX2"]:
+                return np.diff(device.LeafPositionBoundaries)
@@ -0,0 +1,111 @@
+from functools import partial
+
+import numpy as np
+
+from macaron_plancomplexity.ArrayApertureMetric import ArrayAperture
+from macaron_plancomplexity.LazyDict import LazyDict
+
+
+class BeamQuantities(LazyDict):
+    """
+    Intermediate quantities of the apertures of a beam (field sizes, areas, perimeters...) shared by metrics.
+    Each quantity is registered in QUANTITIES with the quantities it is derived from; it is computed on first
+    request from the memoized values of those, so whatever the combination of metrics asking for quantities,
+    each one is computed once per beam.
+    Metrics declare the quantities they read in REQUIRES, so that an evaluator can compute all of them
+    up front (see compute); new quantities are added with BeamQuantities.register.
+    """
+
+    # Name of each quantity: (names of the quantities it is derived from, function computing it)
+    QUANTITIES = {}
+
+    def __init__(self, apertures: ArrayAperture):
+        """
+        Initializes the BeamQuantities of a beam, without computing anything
+        :param apertures: all the apertures of the beam, as a single ArrayAperture
+        """
+        super().__init__(dict((name, partial(self.compute_quantity, name)) for name in self.QUANTITIES))
+        self.apertures = apertures
+
+    @classmethod
+    def register(cls, name: str, requires=()):
+        """
+        Decorator registering a quantity, computed by the decorated function as
+        function(apertures, *values of the required quantities)
+        :param name: the name of the quantity
+        :param requires: the names of the quantities it is derived from
+        :return: the decorator
+        """
+        def decorator(function):
+            cls.QUANTITIES[name] = (tuple(requires), function)
+            return function
+        return decorator
+
+    @classmethod
+    def schedule(cls, names) -> list:
+        """
+        Orders quantities so that each one comes after the quantities it is derived from
+        :param names: the names of the requested quantities
+        :return: the requested quantities and all their requirements, each one once, in computation order
+        """
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name not in cls.QUANTITIES:
+                raise KeyError("Unknown beam quantity '" + name + "'")
+            if name in visiting:
+                raise ValueError("Beam quantity '" + name + "' depends on itself")
+            visiting.add(name)
+            for required in cls.QUANTITIES[name][0]:
+                visit(required)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    def compute(self, names) -> None:
+        """
+        Computes quantities (and their requirements) that are not computed yet
+        :param names: the names of the quantities
+        """
+        for name in self.schedule(names):
+            self[name]
+
+    def compute_quantity(self, name: str):
+        requires, function = self.QUANTITIES[name]
+        return function(self.apertures, *[self[required] for required in requires])
+
+
+@BeamQuantities.register("outside_jaw")
+def outside_jaw(apertures: ArrayAperture) -> np.ndarray:
+    return apertures.IsOutsideJaw()
+
+
+@BeamQuantities.register("field_size", requires=["outside_jaw"])
+def field_size(apertures: ArrayAperture, outside: np.ndarray) -> np.ndarray:
+    return apertures.FieldSize(outside)
+
+
+@BeamQuantities.register("open_leaf_width", requires=["outside_jaw"])
+def open_leaf_width(apertures: ArrayAperture, outside: np.ndarray) -> np.ndarray:
+    return apertures.OpenLeafWidth(outside)
+
+
+@BeamQuantities.register("leaf_pair_area", requires=["field_size", "open_leaf_width"])
+def leaf_pair_area(apertures: ArrayAperture, size: np.ndarray, width: np.ndarray) -> np.ndarray:
+    return apertures.FieldArea(size, width)
+
+
+@BeamQuantities.register("area", requires=["leaf_pair_area"])
+def area(apertures: ArrayAperture, pair_area: np.ndarray) -> np.ndarray:
+    return apertures.Area(pair_area)
+
+
+@BeamQuantities.register("side_perimeter", requires=["field_size", "outside_jaw"])
+def side_perimeter(apertures: ArrayAperture, size: np.ndarray, outside: np.ndarray) -> np.ndarray:
+    return apertures.side_perimeter(size, outside)
@@ -0,0 +1,287 @@
+import json
+import os
+import struct
+
+import numpy
+
+
+class CohortStore:
+    """
+    Append-only store of the per-control-point metrics of a cohort.
+    Each metric is a contiguous column of float64 values, kept on disk as a .npy file that can be memory-mapped,
+    and an index (a JSON-lines file) records the rows [start, stop) of every beam of every plan.
+    Queries and histograms run on the memory-mapped columns, chunk by chunk, without loading them in memory.
+
+    Columns are written first, then the index entries of all the beams of a plan at once: the index is the commit
+    point, so a run that is interrupted while appending leaves the store consistent (the partial rows are
+    overwritten by the next append, and the plan is not considered stored).
+    Metrics missing from a beam (or added after some beams were stored) are NaN.
+    """
+
+    # Size of the .npy header, fixed so that it can be rewritten in place when rows are appended
+    HEADER_SIZE = 128
+    INDEX_FILE = "index.jsonl"
+    DTYPE = numpy.dtype("<f8")
+
+    def __init__(self, folder: str):
+        """
+        Initializes a CohortStore, creating the folder if missing
+        :param folder: the folder of the store
+        """
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.entries = []
+        self.fingerprints = set()
+        self.rows = 0
+        self.load_index()
+
+    def load_index(self) -> None:
+        """
+        Reads the index of the store. Entries of a plan are only loaded if the entry of its last beam is present
+        (the beams of a plan interrupted while appending are ignored, as an incomplete last line)
+        """
+        self.entries = []
+        self.fingerprints = set()
+        self.rows = 0
+        index_file = os.path.join(self.folder, self.INDEX_FILE)
+        if not os.path.isfile(index_file):
+            return
+        pending = []
+        with open(index_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("first", True):
+                    pending = []
+                pending.append(entry)
+                if entry.get("last", True):
+                    self.commit_entries(pending)
+                    pending = []
+
+    def commit_entries(self, entries: list) -> None:
+        """
+        Adds committed index entries to the ones of the store
+        :param entries: the entries of the beams of a plan
+        """
+        for entry in entries:
+            self.entries.append(entry)
+            if entry.get("fingerprint") is not None:
+                self.fingerprints.add(entry["fingerprint"])
+            self.rows = entry["stop"]
+
+    def keys(self) -> list:
+        """
+        Gets the names of the metrics in the store
+        :return: the list of column names
+        """
+        return sorted(file_name[:-4] for file_name in os.listdir(self.folder) if file_name.endswith(".npy"))
+
+    def column_file(self, name: str) -> str:
+        """
+        Gets the path of the .npy file of a metric
+        :param name: the name of the metric
+        :return: the path of the file
+        """
+        return os.path.join(self.folder, name + ".npy")
+
+    def contains(self, fingerprint: str) -> bool:
+        """
+        Checks if a plan was already stored
+        :param fingerprint: the fingerprint of the plan
+        :return: True if the plan is in the store
+        """
+        return fingerprint in self.fingerprints
+
+    def append_plan(self, patient: str, cp_tables: dict, fingerprint: str = None) -> bool:
+        """
+        Appends the per-CP metrics of all the beams of a plan
+        :param patient: the name of the patient
+        :param cp_tables: a dictionary with, for each beam, its ControlPointTable (or a dictionary of columns)
+        :param fingerprint: the fingerprint of the plan, used to avoid storing the same plan twice
+        :return: True if the plan was appended, False if it was already in the store
+        """
+        if (fingerprint is not None) and self.contains(fingerprint):
+            return False
+        entries = []
+        start = self.rows
+        for beam, cp_table in cp_tables.items():
+            columns = cp_table.columns if hasattr(cp_table, "columns") else cp_table
+            entries.append(self.write_beam(patient, beam, columns, fingerprint, start))
+            start = entries[-1]["stop"]
+        self.commit(entries)
+        return True
+
+    def append(self, patient: str, beam: str, columns: dict, fingerprint: str = None) -> None:
+        """
+        Appends the per-CP metrics of a beam
+        :param patient: the name of the patient
+        :param beam: the name of the beam
+        :param columns: a dictionary of arrays, one per metric, all with one value per control point
+        :param fingerprint: the fingerprint of the plan the beam belongs to
+        """
+        self.commit([self.write_beam(patient, beam, columns, fingerprint, self.rows)])
+
+    def write_beam(self, patient: str, beam: str, columns: dict, fingerprint: str, start: int) -> dict:
+        """
+        Writes the per-CP metrics of a beam in the columns, without committing them (see commit)
+        :param start: the first row of the beam
+        :return: the index entry of the beam
+        """
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("Columns of beam '" + beam + "' of '" + patient + "' have different lengths")
+        count = lengths.pop() if len(lengths) > 0 else 0
+        names = set(self.keys()) | set(columns.keys())
+        for name in names:
+            values = columns.get(name)
+            if values is None:
+                values = numpy.full(count, numpy.nan)
+            self.write_rows(name, numpy.asarray(values, dtype=self.DTYPE), start)
+        return {"patient": patient, "beam": beam, "fingerprint": fingerprint, "start": start, "stop": start + count}
+
+    def commit(self, entries: list) -> None:
+        """
+        Commits the rows of the beams of a plan, written by write_beam, by appending their entries to the index
+        in a single write: the first and the last entries are flagged, so that a plan whose entries are not all
+        written is ignored by load_index
+        :param entries: the index entries of the beams of the plan
+        """
+        if len(entries) == 0:
+            return
+        for position, entry in enumerate(entries):
+            entry["first"] = position == 0
+            entry["last"] = position == len(entries) - 1
+        text = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with open(os.path.join(self.folder, self.INDEX_FILE), "a+b") as f:
+            # Terminates an incomplete last line, left by an interrupted commit
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    text = "\n" + text
+            f.write(text.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        self.commit_entries(entries)
+
+    def write_rows(self, name: str, values: numpy.ndarray, start: int) -> None:
+        """
+        Writes values in a column from a row (after the committed rows), then updates the .npy header.
+        A column that does not exist yet is created, filled with NaN for the rows before start
+        :param name: the name of the metric
+        :param values: the values to append
+        :param start: the row of the first value
+        """
+        file_path = self.column_file(name)
+        if not os.path.isfile(file_path):
+            with open(file_path, "wb") as f:
+                f.write(npy_header(0))
+            if start > 0:
+                self.write_column(file_path, 0, numpy.full(start, numpy.nan, dtype=self.DTYPE))
+        self.write_column(file_path, start, values)
+
+    def write_column(self, file_path: str, start: int, values: numpy.ndarray) -> None:
+        with open(file_path, "r+b") as f:
+            f.seek(self.HEADER_SIZE + start * self.DTYPE.itemsize)
+            f.write(values.tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(npy_header(start + len(values)))
+
+    def column(self, name: str) -> numpy.ndarray:
+        """
+        Gets a metric of all the control points in the store, memory-mapped (read only)
+        :param name: the name of the metric
+        :return: the memory-mapped array, with one value per row of the store
+        """
+        column = numpy.load(self.column_file(name), mmap_mode="r")
+        return column[:self.rows]
+
+    def find(self, patient: str = None, beam: str = None) -> list:
+        """
+        Finds the index entries of the beams of a patient
+        :param patient: the name of the patient (None for all patients)
+        :param beam: the name of the beam (None for all beams)
+        :return: the list of entries (patient, beam, fingerprint, start, stop)
+        """
+        return [entry for entry in self.entries
+                if (patient is None or entry["patient"] == patient) and (beam is None or entry["beam"] == beam)]
+
+    def get(self, name: str, patient: str, beam: str = None) -> numpy.ndarray:
+        """
+        Gets a metric of the control points of a patient
+        :param name: the name of the metric
+        :param patient: the name of the patient
+        :param beam: the name of the beam (None for all the beams of the patient)
+        :return: the array of values
+        """
+        column = self.column(name)
+        entries = self.find(patient, beam)
+        if len(entries) == 0:
+            return numpy.zeros(0, dtype=self.DTYPE)
+        return numpy.concatenate([column[entry["start"]:entry["stop"]] for entry in entries])
+
+    def locate(self, rows) -> list:
+        """
+        Gets the index entries containing some rows of the store
+        :param rows: row numbers (e.g. returned by query)
+        :return: the list of entries, one per row
+        """
+        starts = numpy.array([entry["start"] for entry in self.entries])
+        positions = numpy.searchsorted(starts, numpy.asarray(rows), side="right") - 1
+        return [self.entries[position] for position in positions]
+
+    def query(self, name: str, condition, chunk_size: int = 1 << 20) -> numpy.ndarray:
+        """
+        Finds the control points whose metric satisfies a condition, reading the column chunk by chunk
+        :param name: the name of the metric
+        :param condition: function mapping an array of values to a boolean mask, e.g. lambda v: v < 10
+        :param chunk_size: number of values read at once
+        :return: the rows of the store satisfying the condition (see locate)
+        """
+        column = self.column(name)
+        rows = [numpy.flatnonzero(condition(numpy.asarray(column[start:start + chunk_size]))) + start
+                for start in range(0, len(column), chunk_size)]
+        return numpy.concatenate(rows) if len(rows) > 0 else numpy.zeros(0, dtype=int)
+
+    def histogram(self, name: str, bins: int = 10, value_range: tuple = None, chunk_size: int = 1 << 20):
+        """
+        Computes the histogram of a metric over the whole cohort, reading the column chunk by chunk
+        (NaN values are ignored)
+        :param name: the name of the metric
+        :param bins: the number of bins
+        :param value_range: (min, max) of the bins, computed from the data if None
+        :param chunk_size: number of values read at once
+        :return: the counts and the bin edges, as numpy.histogram
+        """
+        column = self.column(name)
+        if value_range is None:
+            lows = [numpy.nanmin(column[start:start + chunk_size], initial=numpy.inf)
+                    for start in range(0, len(column), chunk_size)]
+            highs = [numpy.nanmax(column[start:start + chunk_size], initial=-numpy.inf)
+                     for start in range(0, len(column), chunk_size)]
+            value_range = (min(lows, default=0.0), max(highs, default=1.0))
+            if not numpy.isfinite(value_range).all():
+                value_range = (0.0, 1.0)
+        edges = numpy.histogram_bin_edges(numpy.zeros(0), bins=bins, range=value_range)
+        counts = numpy.zeros(bins, dtype=numpy.int64)
+        for start in range(0, len(column), chunk_size):
+            chunk = numpy.asarray(column[start:start + chunk_size])
+            counts += numpy.histogram(chunk[~numpy.isnan(chunk)], bins=edges)[0]
+        return counts, edges
+
+    def __len__(self) -> int:
+        return self.rows
+
+
+def npy_header(rows: int) -> bytes:
+    """
+    Creates the header of a 1D float64 .npy file (format 1.0), padded to CohortStore.HEADER_SIZE bytes
+    :param rows: the number of values in the file
+    :return: the header bytes
+    """
+    magic = b"\x93NUMPY\x01\x00"
+    text_size = CohortStore.HEADER_SIZE - len(magic) - 2
+    text = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (CohortStore.DTYPE.str, rows)
+    return magic + struct.pack("<H", text_size) + (text.ljust(text_size - 1) + "\n").encode("latin1")
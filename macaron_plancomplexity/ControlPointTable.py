@@ -0,0 +1,74 @@
+from collections.abc import Sequence
+
+import numpy
+
+
+class ControlPointTable(Sequence):
+    """
+    Columnar table of the per-control-point metrics of a beam: one NumPy array per metric.
+    It can also be used as the list of per-control-point dicts it replaces
+    (e.g. by write_dict); those dicts are only produced when they are accessed.
+    """
+
+    def __init__(self, columns: dict = None):
+        """
+        Initializes a ControlPointTable
+        :param columns: a dictionary of arrays, one per metric, all with one value per control point
+        """
+        self.columns = {}
+        self.records = None
+        if columns is not None:
+            for name, values in columns.items():
+                self.add_column(name, values)
+
+    def add_column(self, name: str, values) -> None:
+        """
+        Adds (or replaces) a metric column
+        :param name: name of the metric
+        :param values: one value per control point
+        """
+        values = numpy.asarray(values)
+        if len(self.columns) > 0 and len(values) != len(self):
+            raise ValueError("Column '" + name + "' has " + str(len(values)) + " values, expected " + str(len(self)))
+        self.columns[name] = values
+        self.records = None
+
+    def column(self, name: str) -> numpy.ndarray:
+        """
+        Gets the array of a metric
+        :param name: name of the metric
+        :return: the array with one value per control point
+        """
+        return self.columns[name]
+
+    def keys(self) -> list:
+        """
+        Gets the names of the metrics in the table
+        :return: the list of column names
+        """
+        return list(self.columns.keys())
+
+    def to_records(self) -> list:
+        """
+        Gets the table as a list of dicts, one per control point (built once, then cached)
+        :return: the list of per-control-point dicts
+        """
+        if self.records is None:
+            lists = [(name, values.tolist()) for name, values in self.columns.items()]
+            self.records = [{name: values[i] for name, values in lists} for i in range(len(self))]
+        return self.records
+
+    def __len__(self) -> int:
+        if len(self.columns) == 0:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, index):
+        return self.to_records()[index]
+
+    def __iter__(self):
+        return iter(self.to_records())
+
+    def __getstate__(self) -> dict:
+        # Per-control-point dicts are rebuilt on demand, they are not pickled
+        return {"columns": self.columns, "records": None}
@@ -1,11 +1,15 @@
 import os
 
+from macaron_plancomplexity.PlotRenderer import PlotRenderer
 from macaron_plancomplexity.StudyType import StudyType
+from macaron_plancomplexity.columnar_utils import COLUMNAR_FORMATS, write_custom_metrics, write_lib_metrics
 from macaron_plancomplexity.complexity_utils import calculate_RTPlan_lib_metrics, calculate_RTPlan_custom_metrics
 from macaron_plancomplexity.DICOMFileObject import DICOMFileObject
 from macaron_plancomplexity.DICOMType import DICOMType
+from macaron_plancomplexity.dicomrt import RTPlan, release_beam
+from macaron_plancomplexity.PyApertureMetric import BeamTensor
 from macaron_plancomplexity.utils import load_DICOM, extractPatientData, clear_folder, write_dict, \
-    extractManufacturerData, extractStudyData, extractImageData
+    extractManufacturerData, extractStudyData, extractImageData, plan_fingerprint
 
 
 class DICOMItem:
@@ -13,21 +17,35 @@ class DICOMItem:
     Class that contains information of a set of DICOM, including TC, RT_STRUCT, RT_DOSE, RT_PLAN
     """
 
-    def __init__(self, rtp_file):
+    def __init__(self, rtp_file, header=None, cache=None):
         """
         Initializes a DICOMItem
         :param rtp_file: the path to the RTPlan
+        :param header: the (DICOMObject, DICOMType) returned by load_DICOM_header, if the file was already
+                    classified: the RTPlan is then fully loaded only when it is needed
+        :param cache: a MetricCache where metric results are looked up before computing them (None for no cache)
         """
         self.id = rtp_file
         self.rtp_file = rtp_file
-        f_ob, f_type = load_DICOM(rtp_file)
-        if f_type == DICOMType.RT_PLAN:
-            self.rtp_object = DICOMFileObject(rtp_file, f_ob, f_type)
+        self.cache = cache
+        self.rtp_object = None
+        if header is not None:
+            f_ob, f_type = header
+        else:
+            f_ob, f_type = load_DICOM(rtp_file)
+            if f_type == DICOMType.RT_PLAN:
+                self.rtp_object = DICOMFileObject(rtp_file, f_ob, f_type)
+        self.valid = f_type == DICOMType.RT_PLAN
+        self.sop_instance_uid = None
+        if self.valid:
             if hasattr(f_ob, "PatientName"):
                 self.id = str(f_ob.PatientName)
+            if hasattr(f_ob, "SOPInstanceUID"):
+                self.sop_instance_uid = str(f_ob.SOPInstanceUID)
         else:
-            self.rtp_object = None
             print("Unable to read object '" + str(rtp_file) + "'")
+        self.rt_plan = None
+        self.plan_dict = None
         self.plan_details = None
         self.plan_metrics = None
         self.plan_custom_metrics = None
@@ -37,7 +55,7 @@ class DICOMItem:
         Checks if the item contains a valid RTPlan
         :return:
         """
-        return self.rtp_object is not None
+        return self.valid
 
     def get_name(self) -> str:
         """
@@ -46,19 +64,83 @@ class DICOMItem:
         """
         return self.id
 
+    def get_fingerprint(self, content_hash: bool = False) -> str:
+        """
+        Gets the fingerprint of the RTPlan file (SOPInstanceUID and file version), see plan_fingerprint
+        :param content_hash: True to identify the file version by a hash of its content, instead of size and mtime
+        :return: the fingerprint string
+        """
+        return plan_fingerprint(self.rtp_file, self.sop_instance_uid, content_hash)
+
+    def get_cache_key(self) -> str:
+        """
+        Gets the key of the results of this RTPlan in the MetricCache
+        :return: the fingerprint of the RTPlan, or None if there is no cache
+        """
+        if (self.cache is None) or (not self.valid):
+            return None
+        return self.get_fingerprint()
+
     def get_rtp_object(self) -> DICOMFileObject:
         """
-        Gets the dicom object of the RTPlan
+        Gets the dicom object of the RTPlan, loading it from disk on first request
         :return:
         """
+        if (self.rtp_object is None) and self.valid:
+            f_ob, f_type = load_DICOM(self.rtp_file)
+            self.rtp_object = DICOMFileObject(self.rtp_file, f_ob, f_type)
         return self.rtp_object
 
+    def get_rt_plan(self) -> RTPlan:
+        """
+        Gets the RTPlan parser, wrapping the dataset already loaded from disk (created once)
+        :return: the RTPlan object, or None if the item does not contain a valid RTPlan
+        """
+        if (self.rt_plan is None) and self.valid:
+            self.rt_plan = RTPlan(dataset=self.get_rtp_object().get_object())
+        return self.rt_plan
+
+    def get_plan_dict(self) -> dict:
+        """
+        Gets the plan dictionary of the RTPlan (computed once, then shared by all metrics).
+        Its fields are decoded when metrics access them
+        :return: the plan dictionary, as returned by RTPlan.get_plan(lazy=True)
+        """
+        if (self.plan_dict is None) and (self.get_rt_plan() is not None):
+            self.plan_dict = self.get_rt_plan().get_plan(lazy=True)
+        return self.plan_dict
+
+    def release_dataset(self) -> None:
+        """
+        Drops the pydicom dataset of the RTPlan, keeping what was already extracted from it: the beams of the
+        plan dictionary keep their decoded fields and their BeamGeometry, but no pydicom sequences.
+        Plan fields that were not read yet are read from a temporary copy of the RTPlan if they are needed
+        (see load_plan_dict), and the dataset itself is loaded again from disk by get_rtp_object
+        """
+        if (self.plan_dict is not None) and self.plan_dict.is_loaded("beams"):
+            for beam in self.plan_dict["beams"].values():
+                release_beam(beam)
+                # Apertures and their quantities are built again from the geometry if needed
+                beam.pop(BeamTensor.CACHE_KEY, None)
+        if self.plan_dict is not None:
+            self.plan_dict.rebind(self.load_plan_dict)
+        self.rt_plan = None
+        self.rtp_object = None
+
+    def load_plan_dict(self) -> dict:
+        """
+        Reads the plan dictionary from the RTPlan file again, without keeping the dataset on the item
+        :return: a new plan dictionary, as returned by RTPlan.get_plan(lazy=True)
+        """
+        f_ob, f_type = load_DICOM(self.rtp_file)
+        return RTPlan(dataset=f_ob).get_plan(lazy=True)
+
     def get_patient_info(self) -> dict:
         """
         Extracts patient data from RTPlan
         """
-        if self.rtp_object is not None:
-            return extractPatientData(self.rtp_object.get_object())
+        if self.valid:
+            return extractPatientData(self.get_rtp_object().get_object())
         else:
             return None
 
@@ -67,34 +149,42 @@ class DICOMItem:
         Gets the RT_PLAN from the DICOMGroup
         :return: a dictionary containing the detail of the RT_PLAN, and a supporting string
         """
-        if self.rtp_object is not None:
+        if self.plan_details is not None:
+            return self.plan_details
+        if self.valid:
             self.plan_details = {}
             new_dict = self.get_patient_info()
             if new_dict is not None:
                 self.plan_details.update(new_dict)
-            new_dict = extractManufacturerData(self.rtp_object.get_object())
+            new_dict = extractManufacturerData(self.get_rtp_object().get_object())
             if new_dict is not None:
                 self.plan_details.update(new_dict)
-            new_dict = extractStudyData(self.rtp_object.get_object())
+            new_dict = extractStudyData(self.get_rtp_object().get_object())
             if new_dict is not None:
                 self.plan_details.update(new_dict)
-            new_dict = extractImageData(self.rtp_object.get_object())
+            new_dict = extractImageData(self.get_rtp_object().get_object())
             if new_dict is not None:
                 self.plan_details.update(new_dict)
             return self.plan_details
         else:
             return None
 
-    def calculate_RTPlan_metrics(self, metrics_list=None, generate_plots=True, output_folder=None):
+    def calculate_RTPlan_metrics(self, metrics_list=None, generate_plots=True, output_folder=None,
+                                 renderer: PlotRenderer = None):
         """
         Calculates Complexity indexes from RTPlan
         :param output_folder: folder to print plots to
         :param generate_plots: True if plots have to be generated and saved to file
+        :param renderer: the PlotRenderer drawing plots in background (plots are written before returning if None)
         :param metrics_list: the list of metrics to be calculated, initialized as DEFAULT_RTP_METRICS when missing
         :return: a dictionary containing the metric value and the unit for the RTPlan
         """
         self.plan_metrics, plan_imgs = calculate_RTPlan_lib_metrics(self.rtp_file, self.id, metrics_list,
-                                                                    generate_plots, output_folder)
+                                                                    generate_plots, output_folder,
+                                                                    plan_dict=self.get_plan_dict,
+                                                                    cache=self.cache,
+                                                                    fingerprint=self.get_cache_key(),
+                                                                    renderer=renderer)
         return self.plan_metrics
 
     def calculate_RTPlan_custom_metrics(self) -> dict:
@@ -102,10 +192,21 @@ class DICOMItem:
         Calculates Complexity indexes from RTPlan
         :return: a dictionary containing the metric value and the unit for each RTPlan metric
         """
-        self.plan_custom_metrics = calculate_RTPlan_custom_metrics(self.rtp_file)
+        self.plan_custom_metrics = calculate_RTPlan_custom_metrics(self.rtp_file, plan_dict=self.get_plan_dict,
+                                                                   cache=self.cache,
+                                                                   fingerprint=self.get_cache_key())
         return self.plan_custom_metrics
 
-    def report_macaron(self, studies, output_folder: str, clean_folder: bool = True):
+    def report_macaron(self, studies, output_folder: str, clean_folder: bool = True, output_format: str = "csv"):
+        """
+        Runs studies on the RTPlan, writing their reports in a folder named after the patient
+        :param studies: the list of StudyType to report about
+        :param output_folder: the folder where the folder of the patient is created
+        :param clean_folder: True if existing reports of the patient have to be deleted
+        :param output_format: "csv", or one of COLUMNAR_FORMATS to write metrics as typed per-CP, per-beam
+                    and per-plan tables (plan details are always written as CSV)
+        :return: the summary dict of the patient
+        """
         if os.path.exists(output_folder) and os.path.isdir(output_folder):
             group_folder = os.path.join(output_folder, self.id)
             if os.path.exists(group_folder):
@@ -116,37 +217,52 @@ class DICOMItem:
                 os.makedirs(group_folder)
             if (studies is not None) and (len(studies) > 0):
                 overall_dict = {}
-                for study in studies:
-                    # try:
-                    if study is StudyType.PLAN_DETAIL:
-                        out_file = os.path.join(group_folder, "plan_detail.csv")
-                        self.get_plan()
-                        write_dict(dict_obj=self.plan_details, filename=out_file, header="attribute,value")
-                        overall_dict.update(dict(("plan_details." + key, value) for (key, value) in self.plan_details.items()))
-                    elif study is StudyType.PLAN_METRICS_DATA:
-                        out_file = os.path.join(group_folder, "plan_lib_metrics.csv")
-                        self.calculate_RTPlan_metrics(generate_plots=False)
-                        write_dict(dict_obj=self.plan_metrics, filename=out_file, header="metric,value,unit")
-                        overall_dict.update(dict(("plan_metrics." + key, value[0]) for (key, value) in self.plan_metrics.items()))
-                    elif study is StudyType.PLAN_METRICS_IMG:
-                        self.calculate_RTPlan_metrics(output_folder=group_folder, generate_plots=True)
-                    elif study is StudyType.CONTROL_POINT_METRICS:
-                        self.calculate_RTPlan_custom_metrics()
-                        out_file = os.path.join(group_folder, "plan_custom_metrics.csv")
-                        write_dict(dict_obj=self.plan_custom_metrics, filename=out_file,
-                                   header="beam,attribute,list_index,metric_name,metric_value")
-                        overall_dict.update(dict(("cp_beam1." + key, value) for (key, value) in self.plan_custom_metrics["Beam1"].items()))
-                        overall_dict.pop('cp_beam1.Sequence', None)
-                        if "Beam2" in self.plan_custom_metrics.keys():
-                            overall_dict.update(dict(("cp_beam2." + key, value) for (key, value) in self.plan_custom_metrics["Beam2"].items()))
+                # Plots are rendered in background while the other studies are computed
+                renderer = PlotRenderer() if StudyType.PLAN_METRICS_IMG in studies else None
+                try:
+                    for study in studies:
+                        # try:
+                        if study is StudyType.PLAN_DETAIL:
+                            out_file = os.path.join(group_folder, "plan_detail.csv")
+                            self.get_plan()
+                            write_dict(dict_obj=self.plan_details, filename=out_file, header="attribute,value")
+                            overall_dict.update(dict(("plan_details." + key, value) for (key, value) in self.plan_details.items()))
+                        elif study is StudyType.PLAN_METRICS_DATA:
+                            self.calculate_RTPlan_metrics(generate_plots=False)
+                            if output_format in COLUMNAR_FORMATS:
+                                write_lib_metrics(self.plan_metrics, self.id, group_folder, output_format)
+                            else:
+                                out_file = os.path.join(group_folder, "plan_lib_metrics.csv")
+                                write_dict(dict_obj=self.plan_metrics, filename=out_file, header="metric,value,unit")
+                            overall_dict.update(dict(("plan_metrics." + key, value[0]) for (key, value) in self.plan_metrics.items()))
+                        elif study is StudyType.PLAN_METRICS_IMG:
+                            self.calculate_RTPlan_metrics(output_folder=group_folder, generate_plots=True,
+                                                          renderer=renderer)
+                        elif study is StudyType.CONTROL_POINT_METRICS:
+                            self.calculate_RTPlan_custom_metrics()
+                            if output_format in COLUMNAR_FORMATS:
+                                write_custom_metrics(self.plan_custom_metrics, self.id, group_folder, output_format)
+                            else:
+                                out_file = os.path.join(group_folder, "plan_custom_metrics.csv")
+                                write_dict(dict_obj=self.plan_custom_metrics, filename=out_file,
+                                           header="beam,attribute,list_index,metric_name,metric_value")
+                            overall_dict.update(dict(("cp_beam1." + key, value) for (key, value) in self.plan_custom_metrics["Beam1"].items()))
+                            overall_dict.pop('cp_beam1.Sequence', None)
+                            if "Beam2" in self.plan_custom_metrics.keys():
+                                overall_dict.update(dict(("cp_beam2." + key, value) for (key, value) in self.plan_custom_metrics["Beam2"].items()))
+                            else:
+                                overall_dict.update(dict(("cp_beam2." + key, None) for (key, value) in self.plan_custom_metrics["Beam1"].items()))
+                            overall_dict.pop('cp_beam2.Sequence', None)
+                            overall_dict.update(dict(("cp_plan." + key, value) for (key, value) in self.plan_custom_metrics["plan"].items()))
                         else:
-                            overall_dict.update(dict(("cp_beam2." + key, None) for (key, value) in self.plan_custom_metrics["Beam1"].items()))
-                        overall_dict.pop('cp_beam2.Sequence', None)
-                        overall_dict.update(dict(("cp_plan." + key, value) for (key, value) in self.plan_custom_metrics["plan"].items()))
-                    else:
-                        print("Cannot recognize study '" + study + "' to report about")
-                    # except:
-                    #    print("Error while processing study")
+                            print("Cannot recognize study '" + study + "' to report about")
+                        # except:
+                        #    print("Error while processing study")
+                finally:
+                    if renderer is not None:
+                        renderer.close()
+                    # Reports are written (or failed): only the compact data extracted from the RTPlan is kept
+                    self.release_dataset()
                 return overall_dict
             else:
                 print("No valid studies to report. Please input a list containing DICOMStudy objects")
@@ -0,0 +1,98 @@
+from collections.abc import MutableMapping
+
+
+class LazyDict(MutableMapping):
+    """
+    Dictionary whose values are computed on first access, then stored.
+    Keys that are always present have one loader each (a function without arguments returning the value).
+    Keys whose presence itself depends on the data come from extra_loader, a function returning a dictionary:
+    it is called once, only when a key without loader is requested or when all keys are needed
+    (iteration, len, membership of a key without loader).
+    Values can be set and deleted as in a dict, and a set value replaces its loader.
+    """
+
+    def __init__(self, loaders: dict = None, extra_loader=None):
+        """
+        Initializes a LazyDict
+        :param loaders: a dictionary with the loader of each key that is always present
+        :param extra_loader: a function returning the dictionary of the other keys (None if there are none)
+        """
+        self.loaders = dict(loaders) if loaders is not None else {}
+        self.loaded = {}
+        self.order = dict.fromkeys(self.loaders)
+        self.extra_loader = extra_loader
+
+    def load_extra(self) -> None:
+        """
+        Adds the keys returned by extra_loader (keys that are already present are not replaced)
+        """
+        if self.extra_loader is not None:
+            extra_loader, self.extra_loader = self.extra_loader, None
+            for key, value in extra_loader().items():
+                if key not in self.order:
+                    self.loaded[key] = value
+                    self.order[key] = None
+
+    def rebind(self, source) -> None:
+        """
+        Replaces the loaders of the values not computed yet (and extra_loader) by reads of another mapping with the
+        same keys, e.g. so that the LazyDict no longer references the data its loaders were reading
+        :param source: a function returning the other mapping, called only when one of these values is needed
+        """
+        def read(key):
+            return lambda: source()[key]
+
+        for key in self.loaders:
+            self.loaders[key] = read(key)
+        if self.extra_loader is not None:
+            def load_extra():
+                other = source()
+                return dict((key, other[key]) for key in other if key not in self.order)
+            self.extra_loader = load_extra
+
+    def is_loaded(self, key) -> bool:
+        """
+        Checks if the value of a key was already computed
+        :param key: the key
+        :return: True if the value is stored
+        """
+        return key in self.loaded
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if key in self.loaders:
+            value = self.loaders.pop(key)()
+            self.loaded[key] = value
+            return value
+        self.load_extra()
+        return self.loaded[key]
+
+    def __setitem__(self, key, value) -> None:
+        self.loaders.pop(key, None)
+        self.loaded[key] = value
+        self.order[key] = None
+
+    def __delitem__(self, key) -> None:
+        if key not in self.order:
+            self.load_extra()
+        del self.order[key]
+        self.loaders.pop(key, None)
+        self.loaded.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        if key not in self.order:
+            self.load_extra()
+        return key in self.order
+
+    def __iter__(self):
+        self.load_extra()
+        return iter(list(self.order))
+
+    def __len__(self) -> int:
+        self.load_extra()
+        return len(self.order)
+
+    def __repr__(self) -> str:
+        loaded = dict((key, self.loaded[key]) for key in self.order if key in self.loaded)
+        return "LazyDict(" + repr(loaded) + ", pending=" + repr([key for key in self.loaders]) + ")"
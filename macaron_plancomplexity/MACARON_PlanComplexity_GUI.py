@@ -1,4 +1,3 @@
-import csv
 import os
 import shutil
 
@@ -8,40 +7,14 @@ from tkinter import *
 from tkinter import ttk
 from tkinter.filedialog import askdirectory
 
-from PIL import Image, ImageTk
-
 from macaron_plancomplexity.StudyType import StudyType
-from macaron_plancomplexity.DICOMItem import DICOMItem
+from macaron_plancomplexity.SummaryWriter import SummaryWriter
+from macaron_plancomplexity.batch_utils import iter_batch
+from macaron_plancomplexity.discovery_utils import iter_DICOM_groups
 from macaron_plancomplexity.utils import clear_folder, write_dict
 
-OUT_FOLDER = ".\\output"
-
-
-def find_DICOM_groups(main_folder):
-    """
-    Returns an array of DICOMItem in the main folder
-    @param main_folder: root folder
-    @return: array of dicom groups
-    """
-    plans = []
-    rec_find_DICOM_groups(main_folder, plans)
-    return plans
-
-
-def rec_find_DICOM_groups(main_path, plans):
-    """
-    Supports the function to find all RTPlans in a folder
-    """
-    if os.path.isdir(main_path):
-        for sub_item in os.listdir(main_path):
-            subfolder_path = os.path.join(main_path, sub_item)
-            rec_find_DICOM_groups(subfolder_path, plans)
-    else:
-        if os.path.isfile(main_path) and main_path.endswith(".dcm"):
-            new_item = DICOMItem(main_path)
-            if new_item.is_valid():
-                plans.append(new_item)
-    return plans
+OUT_FOLDER = os.path.join(".", "output")
+SUMMARY_FILE = "metric_all_patients.csv"
 
 
 class MacaronGUI(tkinter.Frame):
@@ -144,12 +117,16 @@ class MacaronGUI(tkinter.Frame):
         folder = askdirectory(initialdir="./")
         if folder is not None:
             self.dicom_folder = folder
-            patients = find_DICOM_groups(self.dicom_folder)
-            if patients is not None:
-                self.patients = patients
-                self.group_label['text'] = str(len(patients))
-                self.run_button['text'] = "Process DICOM Data"
-                self.run_button['state'] = "normal"
+            self.patients = []
+            # Patients are counted while the folder is being scanned
+            for patient in iter_DICOM_groups(self.dicom_folder):
+                self.patients.append(patient)
+                self.group_label['text'] = str(len(self.patients))
+                self.root.update_idletasks()
+            self.patients.sort(key=lambda item: item.rtp_file)
+            self.group_label['text'] = str(len(self.patients))
+            self.run_button['text'] = "Process DICOM Data"
+            self.run_button['state'] = "normal"
         else:
             print("Not a valid DICOM folder")
 
@@ -176,46 +153,32 @@ class MacaronGUI(tkinter.Frame):
                 studies.append([name, tag])
 
         # Bar Setup
-        progress_step = float(100.0 / (len(studies) * len(self.patients)))
-        progress = 0
-
-        # Analysis Loop
-        if self.clean_data is True:
-            clean_folder = True
-        else:
-            clean_folder = False
-        summary = []
-        for patient in self.patients:
-            study_index = 1
-            patient_dict = {}
-            for [name, study] in studies:
-                popup.update()
-                info_label['text'] = "Processing '" + patient.get_name() + "' for study " + \
-                                     name + "' [" + str(study_index) + "/" + str(len(studies)) + "]"
-                if self.create_data.get() is True:
-                    summary_dict = patient.report_macaron(studies=[study], output_folder=OUT_FOLDER,
-                                                          clean_folder=clean_folder)
-                    patient_dict.update(summary_dict)
-                    print("Results of '" + str(study) + "' for patient '" + patient.get_name() +
-                          "' were computed and stored as TXT/CSV files or Images")
-                progress += progress_step
-                progress_var.set(progress)
-                clean_folder = False
-                study_index = study_index + 1
-            summary.append(patient_dict)
+        progress_step = float(100.0 / len(self.patients))
+
+        def show_progress(completed, submitted, patient_name):
+            info_label['text'] = "Processed '" + patient_name + "' [" + str(completed) + "/" + \
+                                 str(len(self.patients)) + "]"
+            progress_var.set(completed * progress_step)
+            popup.update()
+
+        # Analysis Loop: patients are processed in parallel by a pool of processes
+        # Summary file is written while patients are processed
+        if self.create_data.get() is True:
+            popup.update()
+            with SummaryWriter(os.path.join(OUT_FOLDER, SUMMARY_FILE)) as summary_writer:
+                for rtp_file, patient_name, patient_dict in iter_batch(self.patients,
+                                                                       [study for [name, study] in studies],
+                                                                       OUT_FOLDER, clean_folder=self.clean_data.get(),
+                                                                       progress_callback=show_progress):
+                    print("Results of " + str([name for [name, study] in studies]) + " for patient '" +
+                          patient_name + "' were computed and stored as TXT/CSV files or Images")
+                    if patient_dict is not None:
+                        summary_writer.write(patient_dict)
 
         progress_bar.stop()
         self.run_button['state'] = "normal"
         popup.destroy()
 
-        # Saving Summary file
-        keys = summary[0].keys()
-        with open(os.path.join(OUT_FOLDER, "metric_all_patients.csv"), 'w', newline='') as output_file:
-            dict_writer = csv.DictWriter(output_file, keys)
-            dict_writer.writeheader()
-            for patient_dict in summary:
-                dict_writer.writerow(patient_dict)
-
 
 if __name__ == "__main__":
 
@@ -231,6 +194,7 @@ if __name__ == "__main__":
                 "\nper Plan:     \n\t- MUplan     \n\t- Mplan     \n\t- MCSplan     \n\t- MCSVplan     \n\t- MFCplan     \n\t- PI     \n\t- nCP     \n\t- avgApertureLessThan1cm \n\t- yDiffLessThan1cm" +
                 "Moreover, it plots the following graphs, and the corresponding CSV file:" +
                 "\n\t- ApertureIrregularityMetric     \n\t- AreaMetricEstimator \n\t- MeanAreaMetricEstimator     \n\t- PyComplexityMetric \n" +
+                "\t- ModulationComplexityScore     \n\t- ModulationIndexScore (speed, acceleration and total, without graph) \n" +
                 "using the library at https://github.com/victorgabr/ApertureComplexity, from Victor Gabriel Leandro Alves, D.Sc. University of Michigan, Radiation Oncology https://github.com/umro/Complexity" +
                 "\n\nDependencies of the Python tool: \n\t- numpy     \n\t- matplotlib     \n\t- pydicom     \n\t- shutil     \n\t- and the GitHub library above")
 
@@ -0,0 +1,122 @@
+import os
+import pickle
+import sqlite3
+import time
+
+
+class MetricCache:
+    """
+    Persistent cache of metric results, stored in a SQLite database.
+    Results are keyed by plan fingerprint (see plan_fingerprint), metric name and metric version:
+    bumping the VERSION of a metric makes its old results unreachable, while the results of the other
+    metrics are still used. When the cached results exceed max_size bytes, the least recently used
+    ones are evicted.
+    The connection is opened lazily, so a MetricCache can be handed to worker processes
+    (each one opens its own connection to the same database).
+    """
+
+    DEFAULT_MAX_SIZE = 1 << 30
+
+    def __init__(self, db_path: str, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        Initializes a MetricCache
+        :param db_path: path to the SQLite database (created if missing)
+        :param max_size: maximum size of the cached results, in bytes
+        """
+        self.db_path = db_path
+        self.max_size = max_size
+        self.connection = None
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Gets the connection to the database, opening (and creating) it on first use
+        :return: the sqlite3 Connection
+        """
+        if self.connection is None:
+            folder = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(folder, exist_ok=True)
+            self.connection = sqlite3.connect(self.db_path, timeout=60)
+            # WAL lets worker processes read while another one is writing
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metrics ("
+                                    "fingerprint TEXT NOT NULL, metric TEXT NOT NULL, version TEXT NOT NULL, "
+                                    "value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL, "
+                                    "PRIMARY KEY (fingerprint, metric, version))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS metrics_last_access ON metrics (last_access)")
+            self.connection.commit()
+        return self.connection
+
+    def close(self) -> None:
+        """
+        Closes the connection to the database (it is opened again if the cache is used later on)
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, fingerprint: str, metric: str, version):
+        """
+        Gets a cached result, marking it as recently used
+        :param fingerprint: the fingerprint of the plan
+        :param metric: the name of the metric
+        :param version: the version of the metric implementation
+        :return: the cached result, or None if missing
+        """
+        connection = self.connect()
+        key = (fingerprint, metric, str(version))
+        row = connection.execute("SELECT value FROM metrics WHERE fingerprint = ? AND metric = ? AND version = ?",
+                                 key).fetchone()
+        if row is None:
+            return None
+        with connection:
+            connection.execute("UPDATE metrics SET last_access = ? "
+                               "WHERE fingerprint = ? AND metric = ? AND version = ?", (time.time(),) + key)
+        return pickle.loads(row[0])
+
+    def put(self, fingerprint: str, metric: str, version, value) -> None:
+        """
+        Stores a result in the cache, evicting the least recently used results if the cache gets too big
+        :param fingerprint: the fingerprint of the plan
+        :param metric: the name of the metric
+        :param version: the version of the metric implementation
+        :param value: the result (any picklable object)
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        connection = self.connect()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)",
+                               (fingerprint, metric, str(version), blob, len(blob), time.time()))
+            self.evict(connection)
+
+    def evict(self, connection: sqlite3.Connection) -> None:
+        """
+        Deletes the least recently used results until the cache fits in max_size
+        :param connection: the connection, inside the transaction of put
+        """
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM metrics").fetchone()[0]
+        if total <= self.max_size:
+            return
+        excess = total - self.max_size
+        evicted = []
+        for rowid, size in connection.execute("SELECT rowid, size FROM metrics ORDER BY last_access"):
+            evicted.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM metrics WHERE rowid = ?", evicted)
+
+    def size(self) -> int:
+        """
+        Gets the size of the cached results
+        :return: the number of bytes
+        """
+        return self.connect().execute("SELECT COALESCE(SUM(size), 0) FROM metrics").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.connect().execute("SELECT COUNT(*) FROM metrics").fetchone()[0]
+
+    def __getstate__(self) -> dict:
+        # Connections cannot be pickled: worker processes open their own
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PlotRenderer:
+    """
+    Renders per-control-point plots to PNG files on background threads, so that metric computation
+    does not wait for PNG encoding.
+    Figures are drawn with the Agg canvas directly (no pyplot, so no global figure manager that keeps
+    figures alive): each rendering thread owns one figure, which is cleared and reused for every plot.
+    matplotlib is imported by the first plot, so that code that never plots does not pay for it.
+    """
+
+    def __init__(self, workers: int = 1):
+        """
+        Initializes a PlotRenderer
+        :param workers: number of rendering threads
+        """
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="PlotRenderer")
+        self.futures = []
+        self.local = threading.local()
+
+    def get_figure(self):
+        """
+        Gets the figure of the calling thread, created on first use
+        :return: the Figure and its Axes
+        """
+        if not hasattr(self.local, "figure"):
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            self.local.figure = figure
+            self.local.axes = figure.add_subplot()
+        return self.local.figure, self.local.axes
+
+    def render(self, values, file_path: str, title: str, ylabel: str, xlabel: str = "Control Point") -> str:
+        """
+        Plots values and saves the plot as PNG file (in the calling thread)
+        :param values: the values to plot, one per control point
+        :param file_path: the PNG file to write
+        :param title: the title of the plot
+        :param ylabel: the label of the y axis
+        :param xlabel: the label of the x axis
+        :return: the path of the written file
+        """
+        figure, axes = self.get_figure()
+        axes.clear()
+        axes.plot(values)
+        axes.set_xlabel(xlabel)
+        axes.set_ylabel(ylabel)
+        axes.set_title(title)
+        figure.savefig(file_path, dpi=figure.dpi)
+        return file_path
+
+    def submit(self, values, file_path: str, title: str, ylabel: str, xlabel: str = "Control Point"):
+        """
+        Queues a plot, rendered by a background thread (see render)
+        :return: the Future of the written file path
+        """
+        future = self.pool.submit(self.render, values, file_path, title, ylabel, xlabel)
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> list:
+        """
+        Waits until all the queued plots are written
+        :return: the list of written files; plots that failed are reported and skipped
+        """
+        futures, self.futures = self.futures, []
+        written = []
+        for future in futures:
+            try:
+                written.append(future.result())
+            except Exception as e:
+                print("Error while rendering plot: " + str(e))
+        return written
+
+    def close(self) -> list:
+        """
+        Waits for the queued plots, then stops the rendering threads
+        :return: the list of written files
+        """
+        written = self.wait()
+        self.pool.shutdown()
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
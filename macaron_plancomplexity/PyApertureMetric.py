@@ -5,6 +5,16 @@ from pydicom.dataset import Dataset
 import numpy as np
 
 from macaron_plancomplexity.ApertureMetric import LeafPair, Jaw, Aperture
+from macaron_plancomplexity.ArrayApertureMetric import ArrayAperture
+from macaron_plancomplexity.BeamGeometry import BeamGeometry
+from macaron_plancomplexity.BeamQuantities import BeamQuantities
+from macaron_plancomplexity.jit_utils import compiled, undo_cumulative_sum_kernel
+from macaron_plancomplexity.decoding_utils import (
+    LEAF_JAW_POSITIONS,
+    CUMULATIVE_METERSET_WEIGHT,
+    get_raw_value,
+    decode_DS_rows,
+    get_control_point_values)
 
 
 class PyLeafPair(LeafPair):
@@ -32,7 +42,17 @@ class PyAperture(Aperture):
         jaw: List[float],
         gantry_angle: float,
     ) -> None:
-        super().__init__(leaf_positions, leaf_widths, jaw)
+        """
+            Geometry is held by an ArrayAperture; LeafPair objects are only
+            created when LeafPairs is accessed
+        :param leaf_positions: Numpy 2D array of floats (bank, leaf pair)
+        :param leaf_widths: Numpy array 1D
+        :param jaw: list with jaw positions
+        :param gantry_angle: gantry angle of the control point
+        """
+        self.jaw = self.CreateJaw(jaw)
+        self.geometry = ArrayAperture(leaf_positions, leaf_widths, jaw)
+        self.leaf_pairs = None
         self.gantry_angle = gantry_angle
 
     def CreateLeafPairs(
@@ -49,8 +69,28 @@ class PyAperture(Aperture):
         return pairs
 
     @property
-    def LeafPairArea(self) -> List[float]:
-        return [lp.FieldArea() for lp in self.LeafPairs]
+    def LeafPairs(self) -> List[PyLeafPair]:
+        if self.leaf_pairs is None:
+            positions = np.vstack((self.geometry.left, self.geometry.right))
+            self.leaf_pairs = self.CreateLeafPairs(positions, self.geometry.widths, self.Jaw)
+        return self.leaf_pairs
+
+    @LeafPairs.setter
+    def LeafPairs(self, value):
+        self.leaf_pairs = value
+
+    @property
+    def LeafPairArea(self) -> np.ndarray:
+        return self.geometry.LeafPairArea
+
+    def HasOpenLeafBehindJaws(self) -> bool:
+        return bool(self.geometry.HasOpenLeafBehindJaws())
+
+    def Area(self) -> float:
+        return float(self.geometry.Area())
+
+    def side_perimeter(self) -> float:
+        return float(self.geometry.side_perimeter())
 
     @property
     def GantryAngle(self) -> float:
@@ -65,27 +105,128 @@ class PyAperture(Aperture):
         return txt
 
 
-class PyAperturesFromBeamCreator:
-    def Create(self, beam: Dict[str, str]) -> List[PyAperture]:
+class BeamTensor:
+    """
+        Control points of a beam, stored as contiguous arrays (shared with the BeamGeometry of the beam):
+            leaf_positions (n_cp x 2 x n_leaves), jaws (n_cp x 4), gantry_angles (n_cp)
+        and control_point_indexes (n_cp, position in the ControlPointSequence)
+        for the control points carrying MLC positions, and cumulative_metersets
+        for every control point of the beam (None if the beam has no MU).
+        It is cached in the beam dict, so that all metrics share the same tensor.
+    """
 
-        apertures = []
+    CACHE_KEY = "BeamTensor"
 
-        leafWidths = self.GetLeafWidths(beam)
-        jaw = self.CreateJaw(beam)
+    def __init__(
+        self,
+        leaf_positions: np.ndarray,
+        leaf_widths: np.ndarray,
+        jaws: np.ndarray,
+        gantry_angles: np.ndarray,
+        cumulative_metersets: np.ndarray = None,
+        dosimeter_unit: str = "MU",
+        control_point_indexes: np.ndarray = None,
+    ) -> None:
+        self.leaf_positions = leaf_positions
+        self.leaf_widths = leaf_widths
+        self.jaws = jaws
+        self.gantry_angles = gantry_angles
+        self.cumulative_metersets = cumulative_metersets
+        self.dosimeter_unit = dosimeter_unit
+        if control_point_indexes is None:
+            control_point_indexes = np.arange(len(leaf_positions))
+        self.control_point_indexes = control_point_indexes
+        self.apertures = None
+        self.quantities = None
+
+    @classmethod
+    def from_beam(cls, beam: Dict[str, str]) -> "BeamTensor":
+        """
+            Returns the tensor of a beam, building it on first request
+        :param beam: Dicomparser Beam dict from plan_dict
+        :return: the BeamTensor of the beam
+        """
+        tensor = beam.get(cls.CACHE_KEY)
+        if tensor is None:
+            tensor = cls.build(beam)
+            beam[cls.CACHE_KEY] = tensor
+        return tensor
 
-        for controlPoint in beam["ControlPointSequence"]:
-            gantry_angle = (
-                float(controlPoint.GantryAngle)
-                if "GantryAngle" in controlPoint
-                else beam["GantryAngle"]
-            )
-            leafPositions = self.GetLeafPositions(controlPoint)
-            if leafPositions is not None:
-                apertures.append(
-                    PyAperture(leafPositions, leafWidths, jaw, gantry_angle)
-                )
+    @staticmethod
+    def can_build(beam: Dict[str, str]) -> bool:
+        """
+            Checks if the tensor of a beam can be built: its control points have to carry MLC positions
+            (e.g. setup beams with jaws only have none)
+        :param beam: Dicomparser Beam dict from plan_dict
+        :return: True if from_beam can be called on the beam
+        """
+        if (BeamGeometry.CACHE_KEY not in beam) and ("ControlPointSequence" not in beam):
+            return False
+        return BeamGeometry.from_beam(beam).leaf_positions is not None
+
+    @classmethod
+    def build(cls, beam: Dict[str, str]) -> "BeamTensor":
+        geometry = BeamGeometry.from_beam(beam)
+        if geometry.leaf_positions is None:
+            raise ValueError("MLC positions of beam '" + str(beam["BeamName"]) + "' cannot be read")
+        jaw = PyAperturesFromBeamCreator.CreateJaw(beam)
+        jaws = np.tile(np.array(jaw, dtype=float), (len(geometry.control_point_indexes), 1))
+
+        cumulative_metersets = None
+        if "MU" in beam:
+            cumulative_metersets = PyMetersetsFromMetersetWeightsCreator().GetCumulativeMetersets(beam)
+
+        return cls(
+            geometry.leaf_positions,
+            geometry.leaf_widths,
+            jaws,
+            geometry.gantry_angles,
+            cumulative_metersets,
+            beam["PrimaryDosimeterUnit"],
+            geometry.control_point_indexes,
+        )
 
-        return apertures
+    @property
+    def ControlPointCount(self) -> int:
+        return self.leaf_positions.shape[0]
+
+    @property
+    def Apertures(self) -> ArrayAperture:
+        """
+            All the apertures of the beam, as a single batched ArrayAperture
+        """
+        if self.apertures is None:
+            self.apertures = ArrayAperture(self.leaf_positions, self.leaf_widths, self.jaws)
+        return self.apertures
+
+    @property
+    def Quantities(self) -> BeamQuantities:
+        """
+            Intermediate quantities of the apertures (field sizes, areas...), memoized for all the metrics
+        """
+        if self.quantities is None:
+            self.quantities = BeamQuantities(self.Apertures)
+        return self.quantities
+
+    @property
+    def Metersets(self) -> np.ndarray:
+        """
+            Metersets of the control points, as PyMetersetsFromMetersetWeightsCreator.Create
+        """
+        if self.dosimeter_unit != "MU" or self.cumulative_metersets is None:
+            return None
+        return PyMetersetsFromMetersetWeightsCreator.UndoCummulativeSum(self.cumulative_metersets)
+
+    def CreateApertures(self) -> List[PyAperture]:
+        return [
+            PyAperture(self.leaf_positions[i], self.leaf_widths, list(self.jaws[i]), self.gantry_angles[i])
+            for i in range(self.ControlPointCount)
+        ]
+
+
+class PyAperturesFromBeamCreator:
+    def Create(self, beam: Dict[str, str]) -> List[PyAperture]:
+        return BeamTensor.from_beam(beam).CreateApertures()
 
     @staticmethod
     def CreateJaw(beam: dict) -> List[float]:
@@ -111,14 +252,9 @@ class PyAperturesFromBeamCreator:
 
             #TODO HALCYON leaf widths
         :param beam_dict: Dicomparser Beam dict from plan_dict
-        :return: MLCX leaf width
+        :return: MLCX leaf width, as extracted in the BeamGeometry of the beam
         """
-
-        bs = beam_dict["BeamLimitingDeviceSequence"]
-        # the script only takes MLCX as parameter
-        for b in bs:
-            if b.RTBeamLimitingDeviceType in ["MLCX", "MLCX1", "MLCX2"]:
-                return np.diff(b.LeafPositionBoundaries)
+        return BeamGeometry.from_beam(beam_dict).leaf_widths
 
     def GetLeafTops(self, beam_dict: Dict) -> np.ndarray:
         """
@@ -142,7 +278,7 @@ class PyAperturesFromBeamCreator:
         """
         if "BeamLimitingDevicePositionSequence" in control_point:
             pos = control_point.BeamLimitingDevicePositionSequence[-1]
-            mlc_open = pos.LeafJawPositions
+            mlc_open = decode_DS_rows([get_raw_value(pos, LEAF_JAW_POSITIONS)])[0]
             n_pairs = int(len(mlc_open) / 2)
             bank_a_pos = mlc_open[:n_pairs]
             bank_b_pos = mlc_open[n_pairs:]
@@ -155,21 +291,19 @@ class PyMetersetsFromMetersetWeightsCreator:
         if beam["PrimaryDosimeterUnit"] != "MU":
             return None
 
-        metersetWeights = self.GetMetersetWeights(beam["ControlPointSequence"])
+        metersetWeights = BeamGeometry.from_beam(beam).meterset_weights
         metersets = self.ConvertMetersetWeightsToMetersets(beam["MU"], metersetWeights)
 
         return self.UndoCummulativeSum(metersets)
 
     def GetCumulativeMetersets(self, beam):
-        metersetWeights = self.GetMetersetWeights(beam["ControlPointSequence"])
+        metersetWeights = BeamGeometry.from_beam(beam).meterset_weights
         metersets = self.ConvertMetersetWeightsToMetersets(beam["MU"], metersetWeights)
         return metersets
 
     @staticmethod
     def GetMetersetWeights(ControlPoints):
-        return np.array(
-            [cp.CumulativeMetersetWeight for cp in ControlPoints], dtype=float
-        )
+        return get_control_point_values(ControlPoints, CUMULATIVE_METERSET_WEIGHT)
 
     @staticmethod
     def ConvertMetersetWeightsToMetersets(beamMeterset, metersetWeights):
@@ -179,17 +313,18 @@ class PyMetersetsFromMetersetWeightsCreator:
     def UndoCummulativeSum(cummulativeSum):
         """
             Returns the values whose cummulative sum is "cummulativeSum"
+            (compiled kernel of jit_utils when numba is available, NumPy otherwise)
         :param cummulativeSum:
         :return:
         """
+        cummulativeSum = np.asarray(cummulativeSum, dtype=float)
+        kernel = compiled(undo_cumulative_sum_kernel)
+        if kernel is not None:
+            return kernel(cummulativeSum)
 
+        deltas = np.diff(cummulativeSum)
         values = np.zeros(len(cummulativeSum))
-        delta_prev = 0.0
-        for i in range(len(values) - 1):
-            delta_curr = cummulativeSum[i + 1] - cummulativeSum[i]
-            values[i] = 0.5 * delta_prev + 0.5 * delta_curr
-            delta_prev = delta_curr
-
-        values[-1] = 0.5 * delta_prev
+        values[:-1] = 0.5 * np.concatenate(([0.0], deltas[:-1])) + 0.5 * deltas
+        values[-1] = 0.5 * deltas[-1] if len(deltas) > 0 else 0.0
 
         return values
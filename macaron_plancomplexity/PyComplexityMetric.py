@@ -4,15 +4,33 @@ import numpy as np
 from typing import Dict, List
 
 from macaron_plancomplexity.ApertureMetric import EdgeMetricBase
+from macaron_plancomplexity.ArrayApertureMetric import ArrayAperture, sequential_sum
+from macaron_plancomplexity.BeamQuantities import BeamQuantities
 from macaron_plancomplexity.EsapiApertureMetric import ComplexityMetric
-from macaron_plancomplexity.PyApertureMetric import PyAperture, PyMetersetsFromMetersetWeightsCreator, \
-    PyAperturesFromBeamCreator
+from macaron_plancomplexity.PyApertureMetric import PyAperture, BeamTensor
+
+
+def division_or_default(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+        Element-wise a / b, defaulting to 0 where b is 0
+    """
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    return np.divide(a, b, out=np.zeros(a.shape), where=b != 0)
 
 
 class PyEdgeMetricBase(EdgeMetricBase):
+    # BeamQuantities read by CalculateQuantities
+    REQUIRES = ("side_perimeter", "area")
+
     def Calculate(self, aperture: PyAperture) -> float:
         return self.DivisionOrDefault(aperture.side_perimeter(), aperture.Area())
 
+    def CalculateBatch(self, apertures: ArrayAperture) -> np.ndarray:
+        return self.CalculateQuantities(BeamQuantities(apertures))
+
+    def CalculateQuantities(self, quantities: BeamQuantities) -> np.ndarray:
+        return division_or_default(quantities["side_perimeter"], quantities["area"])
+
     @staticmethod
     def DivisionOrDefault(a: float, b: float) -> float:
         return a / b if b != 0 else 0.0
@@ -21,6 +39,13 @@ class PyEdgeMetricBase(EdgeMetricBase):
 class PyComplexityMetric(ComplexityMetric):
     # TODO add unit tests
 
+    # Version of the implementation: to be increased whenever results change (see MetricCache)
+    VERSION = 1
+    # BeamQuantities used by CalculatePerTensor, computed once per beam for all the metrics
+    REQUIRES = PyEdgeMetricBase.REQUIRES
+    # False for metrics that only have a plan value (no value per control point, so no plot)
+    PER_CONTROL_POINT = True
+
     def CalculateForPlan(
         self, patient: None = None, plan: Dict[str, str] = None
     ) -> float:
@@ -65,7 +90,7 @@ class PyComplexityMetric(ComplexityMetric):
         :param beam:
         :return:
         """
-        return PyMetersetsFromMetersetWeightsCreator().Create(beam)
+        return BeamTensor.from_beam(beam).Metersets
 
     def CalculateForPlanPerBeam(
         self, patient: None, plan: Dict[str, str]
@@ -86,15 +111,47 @@ class PyComplexityMetric(ComplexityMetric):
 
         return values
 
+    def WeightedSum(self, weights: List[float], values: List[float]) -> float:
+        """
+            Returns the weighted sum of the given values and weights,
+            as ComplexityMetric.WeightedSum but without a Python loop
+        :param weights:
+        :param values:
+        :return:
+        """
+        weights = np.asarray(weights, dtype=float)
+        values = np.asarray(values, dtype=float)
+        return float(sequential_sum(weights[:len(values)] / sequential_sum(weights) * values))
+
     def CalculatePerAperture(self, apertures: List[PyAperture]) -> List[float]:
         metric = PyEdgeMetricBase()
         return [metric.Calculate(aperture) for aperture in apertures]
 
+    def CalculatePerTensor(self, tensor: BeamTensor) -> np.ndarray:
+        """
+            Returns the unweighted metrics of all the apertures of a beam at once
+        :param tensor: BeamTensor of the beam
+        :return: metric per control point
+        """
+        return PyEdgeMetricBase().CalculateQuantities(tensor.Quantities)
+
     def CalculateForBeamPerAperture(
         self, patient: None, plan: Dict[str, str], beam: Dict[str, str]
     ) -> List[float]:
-        apertures = self.CreateApertures(patient, plan, beam)
-        return self.CalculatePerAperture(apertures)
+        tensor = self.CreateBeamTensor(patient, plan, beam)
+        return self.CalculatePerTensor(tensor).tolist()
+
+    def CreateBeamTensor(
+        self, patient: None, plan: Dict[str, str], beam: Dict[str, str]
+    ) -> BeamTensor:
+        """
+            Returns the BeamTensor of the beam, shared with the other metrics
+        :param patient:
+        :param plan:
+        :param beam:
+        :return:
+        """
+        return BeamTensor.from_beam(beam)
 
     def CreateApertures(
         self, patient: None, plan: Dict[str, str], beam: Dict[str, str]
@@ -106,10 +163,12 @@ class PyComplexityMetric(ComplexityMetric):
         :param beam:
         :return:
         """
-        return PyAperturesFromBeamCreator().Create(beam)
+        return self.CreateBeamTensor(patient, plan, beam).CreateApertures()
 
 
 class MeanApertureAreaMetric:
+    REQUIRES = ("leaf_pair_area",)
+
     def Calculate(self, aperture):
         """
             Calculates the mean aperture area of all leaf pairs
@@ -119,14 +178,30 @@ class MeanApertureAreaMetric:
         areas = np.array(aperture.LeafPairArea)
         return areas[np.nonzero(areas)].mean()
 
+    def CalculateBatch(self, apertures):
+        return self.CalculateQuantities(BeamQuantities(apertures))
+
+    def CalculateQuantities(self, quantities):
+        areas = quantities["leaf_pair_area"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return areas.sum(axis=-1) / np.count_nonzero(areas, axis=-1)
+
 
 class MeanAreaMetricEstimator(PyComplexityMetric):
+    VERSION = 1
+    REQUIRES = MeanApertureAreaMetric.REQUIRES
+
     def CalculatePerAperture(self, apertures):
         metric = MeanApertureAreaMetric()
         return [metric.Calculate(aperture) for aperture in apertures]
 
+    def CalculatePerTensor(self, tensor):
+        return MeanApertureAreaMetric().CalculateQuantities(tensor.Quantities)
+
 
 class ApertureAreaMetric:
+    REQUIRES = ("area",)
+
     def Calculate(self, aperture):
         """
             return the aperture area.
@@ -135,25 +210,50 @@ class ApertureAreaMetric:
         """
         return aperture.Area()
 
+    def CalculateBatch(self, apertures):
+        return self.CalculateQuantities(BeamQuantities(apertures))
+
+    def CalculateQuantities(self, quantities):
+        return quantities["area"]
+
 
 class AreaMetricEstimator(PyComplexityMetric):
+    VERSION = 1
+    REQUIRES = ApertureAreaMetric.REQUIRES
+
     def CalculatePerAperture(self, apertures):
         metric = ApertureAreaMetric()
         return [metric.Calculate(aperture) for aperture in apertures]
 
+    def CalculatePerTensor(self, tensor):
+        return ApertureAreaMetric().CalculateQuantities(tensor.Quantities)
+
 
 class ApertureIrregularity:
+    REQUIRES = ("area", "side_perimeter")
+
     def Calculate(self, aperture):
         aa = aperture.Area()
         ap = aperture.side_perimeter()
         return self.DivisionOrDefault(ap ** 2, 4 * np.pi * aa)
 
+    def CalculateBatch(self, apertures):
+        return self.CalculateQuantities(BeamQuantities(apertures))
+
+    def CalculateQuantities(self, quantities):
+        aa = quantities["area"]
+        ap = quantities["side_perimeter"]
+        return division_or_default(ap ** 2, 4 * np.pi * aa)
+
     @staticmethod
     def DivisionOrDefault(a, b):
         return a / b if b != 0 else 0
 
 
 class ApertureIrregularityMetric(PyComplexityMetric):
+    VERSION = 1
+    REQUIRES = ApertureIrregularity.REQUIRES
+
     def CalculatePerAperture(self, apertures):
         """
             Du W, Cho SH, Zhang X, Hoffman KE, Kudchadker RJ. Quantification of beam
@@ -164,3 +264,7 @@ class ApertureIrregularityMetric(PyComplexityMetric):
         """
         metric = ApertureIrregularity()
         return [metric.Calculate(aperture) for aperture in apertures]
+
+    def CalculatePerTensor(self, tensor):
+        return ApertureIrregularity().CalculateQuantities(tensor.Quantities)
+
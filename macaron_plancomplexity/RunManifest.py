@@ -0,0 +1,93 @@
+import json
+import os
+
+
+class RunManifest:
+    """
+    Journal of the plans processed in an output folder, used to resume interrupted runs and to skip plans
+    whose reports are already up to date. It is a JSON-lines file: one line is appended (and flushed)
+    as soon as a plan is processed, recording its fingerprint, the studies that were run and its summary dict.
+    Plans are identified by their fingerprint (SOPInstanceUID and file version, see plan_fingerprint),
+    so a changed RTPlan gets a new fingerprint and is computed again.
+    """
+
+    FILE_NAME = "run_manifest.jsonl"
+
+    def __init__(self, output_folder: str, file_name: str = FILE_NAME):
+        """
+        Initializes a RunManifest, loading the entries already recorded in the output folder
+        :param output_folder: the folder where reports are written
+        :param file_name: the name of the manifest file inside the output folder
+        """
+        self.output_folder = output_folder
+        self.file_path = os.path.join(output_folder, file_name)
+        self.entries = {}
+        self.load()
+
+    def load(self) -> None:
+        """
+        Reads the manifest file: later lines override earlier lines with the same fingerprint.
+        Lines that cannot be parsed (e.g. the last one of a run that was killed while writing) are ignored
+        """
+        self.entries = {}
+        if not os.path.isfile(self.file_path):
+            return
+        with open(self.file_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["fingerprint"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+    def get_entry(self, fingerprint: str) -> dict:
+        """
+        Gets the entry recorded for a fingerprint
+        :param fingerprint: the fingerprint of the plan
+        :return: the entry dict (rtp_file, fingerprint, name, studies, summary), or None if not recorded
+        """
+        return self.entries.get(fingerprint)
+
+    def is_current(self, fingerprint: str, studies) -> bool:
+        """
+        Checks if the reports of a plan are up to date: the same version of the plan was already processed
+        with (at least) the same studies, and its reports are still in the output folder
+        :param fingerprint: the fingerprint of the plan
+        :param studies: the list of StudyType to report about
+        :return: True if the plan does not need to be computed again
+        """
+        entry = self.get_entry(fingerprint)
+        if entry is None or entry.get("summary") is None:
+            return False
+        if not {study.name for study in studies}.issubset(entry.get("studies", [])):
+            return False
+        return os.path.isdir(os.path.join(self.output_folder, entry["name"]))
+
+    def record(self, rtp_file: str, fingerprint: str, name: str, studies, summary: dict) -> None:
+        """
+        Appends the entry of a processed plan to the manifest file
+        :param rtp_file: the path to the RTPlan
+        :param fingerprint: the fingerprint of the plan
+        :param name: the name of the patient (i.e. the report folder)
+        :param studies: the list of StudyType that were run
+        :param summary: the summary dict returned by report_macaron, None if the plan failed
+        """
+        entry = {"rtp_file": rtp_file, "fingerprint": fingerprint, "name": name,
+                 "studies": [study.name for study in studies], "summary": summary}
+        line = json.dumps(entry, default=to_json_value)
+        with open(self.file_path, "a") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[fingerprint] = json.loads(line)
+
+
+def to_json_value(value):
+    """
+    Converts values that json cannot serialize (e.g. NumPy scalars and arrays)
+    :param value: the value
+    :return: a serializable value
+    """
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
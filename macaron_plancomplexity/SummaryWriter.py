@@ -0,0 +1,83 @@
+import csv
+import os
+
+
+class SummaryWriter:
+    """
+    Writes the summary of many patients (one dict per patient) as a CSV file, one row at a time.
+    Each row is flushed as soon as it is written, so that a run that fails leaves a usable partial file.
+    Patients may have different keys (e.g. a different number of beams, or other studies): columns are
+    the union of all keys, in order of appearance. New keys are appended to the rows written from then on,
+    and the header (with the padding of earlier rows) is rewritten when the writer is closed.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Initializes a SummaryWriter, truncating the file
+        :param filename: the CSV file to write
+        """
+        self.filename = filename
+        self.fields = []
+        self.field_set = set()
+        self.header_size = 0
+        self.rows = 0
+        self.file = open(filename, 'w', newline='')
+        self.writer = csv.writer(self.file)
+
+    def write(self, row: dict) -> None:
+        """
+        Appends the summary of a patient to the file
+        :param row: the summary dict of the patient
+        """
+        for key in row.keys():
+            if key not in self.field_set:
+                self.fields.append(key)
+                self.field_set.add(key)
+        if self.rows == 0:
+            self.writer.writerow(self.fields)
+            self.header_size = len(self.fields)
+        self.writer.writerow([format_value(row.get(key)) for key in self.fields])
+        self.rows += 1
+        self.file.flush()
+
+    def close(self) -> None:
+        """
+        Closes the file, rewriting it if columns were added after the header was written
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.header_size < len(self.fields):
+            self.rewrite()
+
+    def rewrite(self) -> None:
+        """
+        Rewrites the file with the complete header, padding the rows written before the last columns
+        were added. Rows are streamed into a temporary file that replaces the original one
+        """
+        temp_filename = self.filename + ".tmp"
+        with open(self.filename, 'r', newline='') as source, open(temp_filename, 'w', newline='') as target:
+            reader = csv.reader(source)
+            writer = csv.writer(target)
+            next(reader)
+            writer.writerow(self.fields)
+            for values in reader:
+                writer.writerow(values + [""] * (len(self.fields) - len(values)))
+        os.replace(temp_filename, self.filename)
+        self.header_size = len(self.fields)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def format_value(value):
+    """
+    Formats a value as csv.DictWriter does (missing values are empty)
+    :param value: the value
+    :return: the value to write
+    """
+    return "" if value is None else value
@@ -0,0 +1,180 @@
+import argparse
+import os
+import sys
+
+from macaron_plancomplexity.CohortStore import CohortStore
+from macaron_plancomplexity.MetricCache import MetricCache
+from macaron_plancomplexity.RunManifest import RunManifest
+from macaron_plancomplexity.StudyType import StudyType
+from macaron_plancomplexity.SummaryWriter import SummaryWriter
+from macaron_plancomplexity.batch_utils import iter_batch
+from macaron_plancomplexity.columnar_utils import COLUMNAR_FORMATS, OUTPUT_FORMATS, convert_summary, \
+    import_pyarrow
+from macaron_plancomplexity.discovery_utils import iter_DICOM_groups
+
+SUMMARY_FILE = "metric_all_patients.csv"
+
+
+def parse_arguments(argv=None) -> argparse.Namespace:
+    """
+    Parses the command line of the headless batch runner
+    :param argv: the arguments (sys.argv[1:] if None)
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog="python -m macaron_plancomplexity",
+                                     description="Computes the complexity metrics of all the RTPlans "
+                                                 "found below the input folders, without GUI")
+    parser.add_argument("inputs", nargs="+",
+                        help="folders (or single .dcm files) that are scanned for RTPlans")
+    parser.add_argument("-o", "--output", default="output",
+                        help="folder where reports and summary are written (default: %(default)s)")
+    parser.add_argument("-s", "--studies", nargs="+", choices=[study.name for study in StudyType],
+                        default=[study.name for study in StudyType], metavar="STUDY",
+                        help="studies to run, among " + ", ".join(study.name for study in StudyType) +
+                             " (default: all)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs, 1 runs in this process)")
+    parser.add_argument("-f", "--format", dest="output_format", choices=OUTPUT_FORMATS, default="csv",
+                        help="format of metric reports and summary file: parquet and arrow write typed tables "
+                             "(they require pyarrow), the summary is also kept as CSV (default: %(default)s)")
+    parser.add_argument("--skip-existing", action="store_true",
+                        help="skips plans whose patient folder already contains reports")
+    parser.add_argument("--resume", action="store_true",
+                        help="skips plans already processed in the output folder (see " + RunManifest.FILE_NAME +
+                             ") whose RTPlan did not change since, and reuses their summary")
+    parser.add_argument("--fingerprint", choices=["stat", "hash"], default="stat",
+                        help="how changes of RTPlans are detected: file size and modification time, "
+                             "or hash of the content (default: %(default)s)")
+    parser.add_argument("--cache", default=None, metavar="DB",
+                        help="SQLite database caching metric results across runs (default: no cache)")
+    parser.add_argument("--cache-size", type=int, default=MetricCache.DEFAULT_MAX_SIZE >> 20, metavar="MB",
+                        help="maximum size of the cached results, least recently used ones are evicted "
+                             "(default: %(default)s)")
+    parser.add_argument("--cohort-store", default=None, metavar="FOLDER",
+                        help="appends the per-CP custom metrics of each plan to a memory-mapped cohort store "
+                             "(requires the CONTROL_POINT_METRICS study)")
+    parser.add_argument("--clean", action="store_true",
+                        help="deletes existing reports of a patient before computing them again")
+    parser.add_argument("-q", "--quiet", action="store_true", help="does not print progress")
+    args = parser.parse_args(argv)
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def iter_plans(inputs: list, output_folder: str, skip_existing: bool = False):
+    """
+    Finds the RTPlans below all the input folders
+    :param inputs: list of folders (or .dcm files)
+    :param output_folder: the folder where reports are written
+    :param skip_existing: True if plans that already have reports have to be skipped
+    :return: a generator of DICOMItem
+    """
+    for main_folder in inputs:
+        if not os.path.exists(main_folder):
+            print("Input '" + main_folder + "' does not exist")
+            continue
+        for item in iter_DICOM_groups(main_folder):
+            if skip_existing and has_reports(item, output_folder):
+                print("Skipping '" + item.get_name() + "': reports already exist")
+                continue
+            yield item
+
+
+def iter_changed_plans(plans, manifest: RunManifest, studies, fingerprints: dict, skipped: list,
+                       summary_writer: SummaryWriter, content_hash: bool = False):
+    """
+    Filters out the plans whose reports are up to date according to the run manifest
+    :param plans: iterable of DICOMItem
+    :param manifest: the RunManifest of the output folder
+    :param studies: the list of StudyType to report about
+    :param fingerprints: dict filled with the fingerprint of each plan, by path of the RTPlan
+    :param skipped: list filled with the names of the plans that are skipped
+    :param summary_writer: the SummaryWriter where the recorded summary of skipped plans is written
+    :param content_hash: True to fingerprint plans by a hash of their content
+    :return: a generator of the DICOMItem that have to be computed
+    """
+    for item in plans:
+        fingerprint = item.get_fingerprint(content_hash)
+        fingerprints[item.rtp_file] = fingerprint
+        if manifest is not None and manifest.is_current(fingerprint, studies):
+            print("Skipping '" + item.get_name() + "': reports are up to date")
+            skipped.append(item.get_name())
+            summary_writer.write(manifest.get_entry(fingerprint)["summary"])
+            continue
+        yield item
+
+
+def has_reports(item, output_folder: str) -> bool:
+    """
+    Checks if the reports of a plan were already computed
+    :param item: the DICOMItem
+    :param output_folder: the folder where reports are written
+    :return: True if the patient folder exists and is not empty
+    """
+    group_folder = os.path.join(output_folder, item.get_name())
+    return os.path.isdir(group_folder) and len(os.listdir(group_folder)) > 0
+
+
+def main(argv=None) -> int:
+    """
+    Runs the studies on all the RTPlans found below the input folders and writes the summary file
+    :param argv: the arguments (sys.argv[1:] if None)
+    :return: exit code, 1 if at least a plan failed
+    """
+    args = parse_arguments(argv)
+    studies = [StudyType[name] for name in args.studies]
+    os.makedirs(args.output, exist_ok=True)
+
+    def show_progress(completed, submitted, patient_name):
+        if not args.quiet:
+            print("[" + str(completed) + "/" + str(submitted) + "] " + patient_name)
+
+    cache = None
+    if args.cache is not None:
+        cache = MetricCache(args.cache, max_size=args.cache_size << 20)
+
+    if args.output_format in COLUMNAR_FORMATS:
+        # Fails before processing any plan if pyarrow is missing
+        try:
+            import_pyarrow()
+        except ImportError as e:
+            print(e)
+            return 2
+
+    cohort_store = None
+    if args.cohort_store is not None:
+        cohort_store = CohortStore(args.cohort_store)
+
+    processed = 0
+    failed = 0
+    with SummaryWriter(os.path.join(args.output, SUMMARY_FILE)) as summary_writer:
+        # Every processed plan is recorded, so that any run can be resumed later on
+        manifest = RunManifest(args.output)
+        fingerprints = {}
+        skipped = []
+        plans = iter_changed_plans(iter_plans(args.inputs, args.output, args.skip_existing),
+                                   manifest if args.resume else None, studies, fingerprints, skipped,
+                                   summary_writer, content_hash=args.fingerprint == "hash")
+
+        for rtp_file, patient_name, patient_dict in iter_batch(plans, studies, args.output, workers=args.workers,
+                                                               clean_folder=args.clean,
+                                                               progress_callback=show_progress, cache=cache,
+                                                               output_format=args.output_format,
+                                                               cohort_store=cohort_store):
+            manifest.record(rtp_file, fingerprints.pop(rtp_file), patient_name, studies, patient_dict)
+            if patient_dict is None:
+                failed += 1
+            else:
+                processed += 1
+                summary_writer.write(patient_dict)
+
+    if (args.output_format in COLUMNAR_FORMATS) and (processed + len(skipped) > 0):
+        convert_summary(os.path.join(args.output, SUMMARY_FILE), args.output_format)
+    print("Processed " + str(processed) + " plans, " + str(len(skipped)) + " up to date, " +
+          str(failed) + " failed")
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from macaron_plancomplexity.DICOMItem import DICOMItem
+
+
+def process_plan(rtp_file: str, studies, output_folder: str, clean_folder: bool = False, cache=None,
+                 output_format: str = "csv", cp_metrics: bool = False) -> tuple:
+    """
+    Runs all the studies on a single RTPlan (executed by batch workers)
+    :param rtp_file: the path to the RTPlan
+    :param studies: the list of StudyType to report about
+    :param output_folder: the folder where reports are written
+    :param clean_folder: True if existing reports of the patient have to be deleted
+    :param cache: a MetricCache storing metric results (None for no cache)
+    :param output_format: format of the reports, see report_macaron
+    :param cp_metrics: True to send back the per-CP custom metrics of the plan (e.g. for a CohortStore)
+    :return: the path of the RTPlan, the name of the patient, the summary dict returned by report_macaron,
+            and the fingerprint and the ControlPointTable of each beam (None if not requested or not computed)
+    """
+    item = DICOMItem(rtp_file, cache=cache)
+    if not item.is_valid():
+        return rtp_file, item.get_name(), {}, None
+    summary = item.report_macaron(studies=studies, output_folder=output_folder, clean_folder=clean_folder,
+                                  output_format=output_format)
+    cp_tables = None
+    if cp_metrics and (item.plan_custom_metrics is not None):
+        cp_tables = (item.get_fingerprint(), dict((beam, beam_metrics["Sequence"]) for (beam, beam_metrics)
+                                                  in item.plan_custom_metrics.items() if beam != "plan"))
+    return rtp_file, item.get_name(), summary, cp_tables
+
+
+def iter_batch(plans, studies, output_folder: str, workers: int = None, clean_folder: bool = False,
+               progress_callback=None, cache=None, output_format: str = "csv", cohort_store=None):
+    """
+    Runs the studies on many RTPlans using a pool of processes, yielding results as soon as they are ready.
+    Plans are submitted while they are iterated, so that a streaming discovery (e.g. iter_DICOM_groups)
+    overlaps with processing
+    :param plans: iterable of DICOMItem or of paths to RTPlans
+    :param studies: the list of StudyType to report about
+    :param output_folder: the folder where reports are written
+    :param workers: number of worker processes (os.cpu_count() if None, 1 to run in the calling process)
+    :param clean_folder: True if existing reports of the patients have to be deleted
+    :param progress_callback: function called as progress_callback(completed, submitted, name) after each plan
+    :param cache: a MetricCache storing metric results (None for no cache), each worker opens its own connection
+    :param output_format: format of the reports, see report_macaron
+    :param cohort_store: a CohortStore where the per-CP custom metrics of each plan are appended
+                    (by the calling process, as soon as the plan is processed)
+    :return: a generator of (rtp_file, patient name, summary dict), the summary being None if the plan failed
+    """
+    if workers == 1:
+        completed = 0
+        for plan in plans:
+            rtp_file = get_plan_file(plan)
+            try:
+                result = process_plan(rtp_file, studies, output_folder, clean_folder, cache, output_format,
+                                      cohort_store is not None)
+            except Exception as e:
+                result = report_failure(rtp_file, e)
+            result = store_cp_metrics(result, cohort_store)
+            completed += 1
+            if progress_callback is not None:
+                progress_callback(completed, completed, result[1])
+            yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        submitted = 0
+        completed = 0
+        for plan in plans:
+            rtp_file = get_plan_file(plan)
+            future = pool.submit(process_plan, rtp_file, studies, output_folder, clean_folder, cache, output_format,
+                                 cohort_store is not None)
+            pending[future] = rtp_file
+            submitted += 1
+            # Hand back what is already finished while plans keep being submitted
+            for future in [f for f in pending if f.done()]:
+                completed += 1
+                result = store_cp_metrics(collect_result(future, pending.pop(future)), cohort_store)
+                if progress_callback is not None:
+                    progress_callback(completed, submitted, result[1])
+                yield result
+        for future in as_completed(list(pending)):
+            completed += 1
+            result = store_cp_metrics(collect_result(future, pending.pop(future)), cohort_store)
+            if progress_callback is not None:
+                progress_callback(completed, submitted, result[1])
+            yield result
+
+
+def run_batch(plans, studies, output_folder: str, workers: int = None, clean_folder: bool = False,
+              progress_callback=None, cache=None, output_format: str = "csv", cohort_store=None) -> list:
+    """
+    Runs the studies on many RTPlans using a pool of processes (see iter_batch)
+    :return: the list of (rtp_file, patient name, summary dict), in completion order
+    """
+    return list(iter_batch(plans, studies, output_folder, workers, clean_folder, progress_callback, cache,
+                           output_format, cohort_store))
+
+
+def get_plan_file(plan) -> str:
+    """
+    Gets the path of a plan, given as DICOMItem or as path
+    :param plan: a DICOMItem or a path
+    :return: the path to the RTPlan
+    """
+    return plan.rtp_file if isinstance(plan, DICOMItem) else os.fspath(plan)
+
+
+def collect_result(future, rtp_file: str) -> tuple:
+    """
+    Gets the result of a worker, reporting failures instead of raising them
+    :param future: the future of process_plan
+    :param rtp_file: the path to the RTPlan
+    :return: the result of process_plan, or the one of report_failure if it failed
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        return report_failure(rtp_file, e)
+
+
+def report_failure(rtp_file: str, error: Exception) -> tuple:
+    """
+    Reports a plan that could not be processed
+    :param rtp_file: the path to the RTPlan
+    :param error: the exception raised while processing it
+    :return: (rtp_file, rtp_file, None, None), in place of the result of process_plan
+    """
+    print("Error while processing '" + rtp_file + "': " + str(error))
+    return rtp_file, rtp_file, None, None
+
+
+def store_cp_metrics(result: tuple, cohort_store) -> tuple:
+    """
+    Appends the per-CP custom metrics sent back by a worker to the cohort store
+    :param result: the result of process_plan
+    :param cohort_store: the CohortStore (None if per-CP metrics are not stored)
+    :return: the path of the RTPlan, the name of the patient and the summary dict
+    """
+    rtp_file, name, summary, cp_tables = result
+    if (cohort_store is not None) and (cp_tables is not None):
+        fingerprint, tables = cp_tables
+        cohort_store.append_plan(name, tables, fingerprint)
+    return rtp_file, name, summary
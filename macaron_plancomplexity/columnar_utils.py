@@ -0,0 +1,113 @@
+import os
+
+import numpy
+
+# Columnar output formats, and the extension of their files
+COLUMNAR_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+OUTPUT_FORMATS = ["csv"] + list(COLUMNAR_FORMATS.keys())
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is needed only for columnar outputs (it is not a dependency of the CSV outputs)
+    :return: the pyarrow module
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet/Arrow outputs require pyarrow, install it with 'pip install pyarrow'") from e
+    return pyarrow
+
+
+def write_table(columns: dict, file_path: str, output_format: str) -> str:
+    """
+    Writes a table as Parquet or Arrow IPC file
+    :param columns: a dictionary of columns (lists or NumPy arrays) of the same length
+    :param file_path: the path of the file to write, without extension
+    :param output_format: one of COLUMNAR_FORMATS
+    :return: the path of the written file
+    """
+    pa = import_pyarrow()
+    table = columns if isinstance(columns, pa.Table) else pa.table(columns)
+    file_path = file_path + COLUMNAR_FORMATS[output_format]
+    if output_format == "parquet":
+        pa.parquet.write_table(table, file_path)
+    else:
+        with pa.OSFile(file_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    return file_path
+
+
+def custom_metrics_tables(pcm: dict, patient_name: str):
+    """
+    Converts the custom metrics of a plan into per-CP, per-beam and per-plan tables
+    :param pcm: the dictionary returned by calculate_RTPlan_custom_metrics
+    :param patient_name: the name of the patient, stored in a "patient" column of each table
+    :return: the dictionaries of columns of the per-CP, per-beam and per-plan tables
+    """
+    beams = [key for key in pcm.keys() if key != "plan"]
+
+    cp_columns = {"patient": [], "beam": []}
+    for beam in beams:
+        cp_table = pcm[beam]["Sequence"]
+        cp_columns["patient"] += [patient_name] * len(cp_table)
+        cp_columns["beam"] += [beam] * len(cp_table)
+    for name in (pcm[beams[0]]["Sequence"].keys() if len(beams) > 0 else []):
+        cp_columns[name] = numpy.concatenate([pcm[beam]["Sequence"].column(name) for beam in beams])
+
+    beam_columns = {"patient": [patient_name] * len(beams), "beam": beams}
+    for beam in beams:
+        for name, value in pcm[beam].items():
+            if name != "Sequence":
+                beam_columns.setdefault(name, []).append(value)
+
+    plan_columns = {"patient": [patient_name]}
+    plan_columns.update((name, [value]) for name, value in pcm["plan"].items())
+    return cp_columns, beam_columns, plan_columns
+
+
+def write_custom_metrics(pcm: dict, patient_name: str, folder: str, output_format: str) -> list:
+    """
+    Writes the custom metrics of a plan as per-CP, per-beam and per-plan columnar files
+    :param pcm: the dictionary returned by calculate_RTPlan_custom_metrics
+    :param patient_name: the name of the patient
+    :param folder: the folder to write to
+    :param output_format: one of COLUMNAR_FORMATS
+    :return: the list of written files
+    """
+    cp_columns, beam_columns, plan_columns = custom_metrics_tables(pcm, patient_name)
+    return [write_table(cp_columns, os.path.join(folder, "plan_custom_metrics_cp"), output_format),
+            write_table(beam_columns, os.path.join(folder, "plan_custom_metrics_beam"), output_format),
+            write_table(plan_columns, os.path.join(folder, "plan_custom_metrics_plan"), output_format)]
+
+
+def write_lib_metrics(pm: dict, patient_name: str, folder: str, output_format: str) -> str:
+    """
+    Writes the library metrics of a plan as columnar file, one row per metric
+    :param pm: the dictionary returned by calculate_RTPlan_lib_metrics, containing [value, unit] for each metric
+    :param patient_name: the name of the patient
+    :param folder: the folder to write to
+    :param output_format: one of COLUMNAR_FORMATS
+    :return: the written file
+    """
+    columns = {"patient": [patient_name] * len(pm),
+               "metric": list(pm.keys()),
+               "value": [float(value[0]) for value in pm.values()],
+               "unit": [value[1] for value in pm.values()]}
+    return write_table(columns, os.path.join(folder, "plan_lib_metrics"), output_format)
+
+
+def convert_summary(csv_file: str, output_format: str) -> str:
+    """
+    Converts the summary CSV file of a cohort into a columnar file, next to it (column types are inferred)
+    :param csv_file: the summary file written by SummaryWriter
+    :param output_format: one of COLUMNAR_FORMATS
+    :return: the written file
+    """
+    pa = import_pyarrow()
+    table = pa.csv.read_csv(csv_file)
+    return write_table(table, os.path.splitext(csv_file)[0], output_format)
@@ -3,14 +3,20 @@ import math
 import os
 import sys
 
-import matplotlib.pyplot as plt
 import numpy
 
+from macaron_plancomplexity.ArrayApertureMetric import sequential_sum
+from macaron_plancomplexity.BeamGeometry import BeamGeometry
+from macaron_plancomplexity.ControlPointTable import ControlPointTable
+from macaron_plancomplexity.PlotRenderer import PlotRenderer
+from macaron_plancomplexity.jit_utils import compiled, perimeter_lsv_kernel
+from macaron_plancomplexity.PyApertureMetric import BeamTensor
 from macaron_plancomplexity.PyComplexityMetric import (
     PyComplexityMetric,
     MeanAreaMetricEstimator,
     AreaMetricEstimator,
     ApertureIrregularityMetric)
+from macaron_plancomplexity.misc import ModulationComplexityScore, ModulationIndexScore
 
 from macaron_plancomplexity.dicomrt import RTPlan
 
@@ -19,67 +25,206 @@ DEFAULT_RTP_METRICS = [
     PyComplexityMetric,
     MeanAreaMetricEstimator,
     AreaMetricEstimator,
-    ApertureIrregularityMetric]
+    ApertureIrregularityMetric,
+    ModulationComplexityScore,
+    ModulationIndexScore]
 
 RTP_METRICS_UNITS = {
     PyComplexityMetric: "CI [mm^-1]",
     MeanAreaMetricEstimator: "mm^2",
     AreaMetricEstimator: "mm^2",
-    ApertureIrregularityMetric: "dimensionless"}
+    ApertureIrregularityMetric: "dimensionless",
+    ModulationComplexityScore: "dimensionless",
+    ModulationIndexScore: "dimensionless"}
 
+# Version of calculate_RTPlan_custom_metrics: to be increased whenever its results change (see MetricCache)
+CUSTOM_METRICS_VERSION = 1
+CUSTOM_METRICS_KEY = "CustomMetrics"
 
-def calculate_RTPlan_lib_metrics(rtp_filename: str, patient_name: str, metrics_list=None, generate_plots=True, output_folder=None):
+
+def evaluate_RTPlan_lib_metrics(plan_dict: dict, metrics_list=None, per_beam: bool = False):
+    """
+    Evaluates all library metrics in a single traversal of the plan: each beam tensor is built once,
+    per-CP values of every metric are computed on it, and both plan-level weighted sums and
+    per-CP series are derived from those same arrays
+    :param plan_dict: plan dictionary, as returned by RTPlan.get_plan()
+    :param metrics_list: the list of metrics to be calculated, initialized as DEFAULT_RTP_METRICS when missing
+    :param per_beam: True if per-CP series are needed for every beam (e.g. plots), not only for treatment beams;
+                    beams without MLC positions (e.g. setup beams) have no series
+    :return: a dictionary with the plan value of each metric, and a dictionary with the per-CP series
+            of each metric for each beam (empty for metrics whose PER_CONTROL_POINT is False)
+    """
+    if (metrics_list is None) or (type(metrics_list) is not list):
+        metrics_list = DEFAULT_RTP_METRICS
+
+    metric_objs = [metric() for metric in metrics_list]
+    beam_series = {metric.__name__: {} for metric in metrics_list}
+    beam_values = {metric.__name__: [] for metric in metrics_list}
+    # Intermediate quantities of the apertures needed by the per-CP metrics (see BeamQuantities)
+    required = [name for met_obj in metric_objs if getattr(met_obj, "PER_CONTROL_POINT", True)
+                for name in getattr(met_obj, "REQUIRES", ())]
+
+    for k, beam in plan_dict["beams"].items():
+        is_weighted = beam["TreatmentDeliveryType"] == "TREATMENT" and "MU" in beam and beam["MU"] > 0.0
+        if not (is_weighted or per_beam):
+            continue
+        if (not is_weighted) and (not BeamTensor.can_build(beam)):
+            continue
+        if len(required) > 0:
+            BeamTensor.from_beam(beam).Quantities.compute(required)
+        for metric, met_obj in zip(metrics_list, metric_objs):
+            if not getattr(met_obj, "PER_CONTROL_POINT", True):
+                continue
+            if hasattr(met_obj, "CalculatePerTensor"):
+                series = met_obj.CalculatePerTensor(met_obj.CreateBeamTensor(None, plan_dict, beam))
+                if is_weighted:
+                    beam_values[metric.__name__].append(met_obj.WeightedSum(met_obj.GetWeightsBeam(beam), series))
+            else:
+                series = met_obj.CalculateForBeamPerAperture(None, plan_dict, beam)
+            beam_series[metric.__name__][k] = series
+
+    plan_values = {}
+    for metric, met_obj in zip(metrics_list, metric_objs):
+        if hasattr(met_obj, "CalculatePerTensor") and getattr(met_obj, "PER_CONTROL_POINT", True):
+            plan_values[metric.__name__] = met_obj.WeightedSum(met_obj.GetWeightsPlan(plan_dict),
+                                                               beam_values[metric.__name__])
+        else:
+            plan_values[metric.__name__] = met_obj.CalculateForPlan(None, plan_dict)
+    return plan_values, beam_series
+
+
+def evaluate_cached_RTPlan_lib_metrics(plan_dict, metrics_list, cache, fingerprint: str, per_beam: bool = False):
+    """
+    Same as evaluate_RTPlan_lib_metrics, getting from a MetricCache the results of metrics that were already
+    computed (with the same VERSION) for the same plan fingerprint: only the others are computed, then cached
+    :param plan_dict: plan dictionary, or a function returning it (called only if some metric is not cached)
+    :param metrics_list: the list of metrics to be calculated, initialized as DEFAULT_RTP_METRICS when missing
+    :param cache: the MetricCache
+    :param fingerprint: the fingerprint of the plan
+    :param per_beam: True if per-CP series are needed for every beam (e.g. plots), not only for treatment beams.
+                    Cached results record whether they hold the series of every beam: results with the series of
+                    treatment beams only are computed again when per_beam is True
+    :return: a dictionary with the plan value of each metric, and a dictionary with the per-CP series
+            of each metric for each beam; None, None if the plan cannot be parsed
+    """
+    if (metrics_list is None) or (type(metrics_list) is not list):
+        metrics_list = DEFAULT_RTP_METRICS
+
+    plan_values = {}
+    beam_series = {}
+    missing = []
+    for metric in metrics_list:
+        cached = cache.get(fingerprint, metric.__name__, getattr(metric, "VERSION", 0))
+        # Results are cached as (plan value, per-CP series, True if the series of every beam are included)
+        if (cached is None) or (len(cached) < 3) or (per_beam and not cached[2]):
+            missing.append(metric)
+        else:
+            plan_values[metric.__name__], beam_series[metric.__name__] = cached[:2]
+
+    if len(missing) > 0:
+        if callable(plan_dict):
+            plan_dict = plan_dict()
+        if plan_dict is None:
+            return None, None
+        new_values, new_series = evaluate_RTPlan_lib_metrics(plan_dict, missing, per_beam=per_beam)
+        for metric in missing:
+            name = metric.__name__
+            cache.put(fingerprint, name, getattr(metric, "VERSION", 0), (new_values[name], new_series[name], per_beam))
+            plan_values[name] = new_values[name]
+            beam_series[name] = new_series[name]
+    return plan_values, beam_series
+
+
+def calculate_RTPlan_lib_metrics(rtp_filename: str, patient_name: str, metrics_list=None, generate_plots=True,
+                                 output_folder=None, plan_dict=None, cache=None, fingerprint: str = None,
+                                 renderer: PlotRenderer = None):
     """
     Calculates Complexity indexes from RTPlan
+    :param plan_dict: plan dictionary, if already parsed (rtp_filename is not read again),
+                    or a function returning it, called only when needed
     :param output_folder: folder to print plots to
-    :param generate_plots: True if plots have to be generated and saved to file
+    :param generate_plots: True if plots have to be generated and saved to file, one per metric and beam
+    :param renderer: the PlotRenderer drawing plots in background: plots may still be queued when the function
+                    returns (see PlotRenderer.wait). If None, a renderer is created and plots are written on return
     :param metrics_list: the list of metrics to be calculated, initialized as DEFAULT_RTP_METRICS when missing
-    :return: a dictionary containing the metric value and the unit for each RTPlan metric
+    :param cache: a MetricCache storing the results of the metrics (None not to use a cache)
+    :param fingerprint: the fingerprint of the plan, key of the results in the cache
+    :return: a dictionary containing the metric value and the unit for each RTPlan metric,
+            and a dictionary with the list of plot files of each metric
     """
     if (metrics_list is None) or (type(metrics_list) is not list):
         metrics_list = DEFAULT_RTP_METRICS
 
-    if rtp_filename is not None:
+    if (rtp_filename is not None) or (plan_dict is not None):
         pm = {}
         plan_imgs = {}
-        plan_info = RTPlan(filename=rtp_filename)
-        if plan_info is not None:
-            plan_dict = plan_info.get_plan()
+        if (cache is not None) and (fingerprint is not None):
+            if plan_dict is None:
+                plan_dict = lambda: RTPlan(filename=rtp_filename).get_plan()
+            plan_values, beam_series = evaluate_cached_RTPlan_lib_metrics(plan_dict, metrics_list, cache,
+                                                                          fingerprint, per_beam=generate_plots)
+        else:
+            if plan_dict is None:
+                plan_dict = RTPlan(filename=rtp_filename).get_plan()
+            elif callable(plan_dict):
+                plan_dict = plan_dict()
+            plan_values, beam_series = None, None
+            if plan_dict is not None:
+                plan_values, beam_series = evaluate_RTPlan_lib_metrics(plan_dict, metrics_list,
+                                                                       per_beam=generate_plots)
+        if plan_values is not None:
+            own_renderer = generate_plots and (renderer is None)
+            if own_renderer:
+                renderer = PlotRenderer()
             for metric in metrics_list:
                 unit = RTP_METRICS_UNITS[metric]
-                met_obj = metric()
-                plan_metric = met_obj.CalculateForPlan(None, plan_dict)
-                pm[metric.__name__] = [plan_metric, unit]
+                if hasattr(metric, "COMPONENTS"):
+                    # Metrics returning several values are reported as one entry per value
+                    for component, value in zip(metric.COMPONENTS, plan_values[metric.__name__]):
+                        pm[metric.__name__ + "_" + component] = [value, unit]
+                else:
+                    pm[metric.__name__] = [plan_values[metric.__name__], unit]
                 if generate_plots:
-                    for k, beam in plan_dict["beams"].items():
-                        fig, ax = plt.subplots()
-                        cpx_beam_cp = met_obj.CalculateForBeamPerAperture(None, plan_dict, beam)
-                        ax.plot(cpx_beam_cp)
-                        ax.set_xlabel("Control Point")
-                        ax.set_ylabel(f"${unit}$")
+                    plan_imgs[metric.__name__] = []
+                    for k, cpx_beam_cp in beam_series[metric.__name__].items():
                         txt = f"Patient: {patient_name} - {metric.__name__} per control point"
-                        ax.set_title(txt)
+                        img_path = patient_name + "_" + metric.__name__ + "_beam" + str(k) + ".png"
                         if output_folder is not None:
-                            img_path = os.path.join(output_folder, patient_name + "_" + metric.__name__ + ".png")
-                        else:
-                            img_path = patient_name + "_" + metric.__name__ + ".png"
-                        fig.savefig(img_path, dpi=fig.dpi)
-                        plan_imgs[metric.__name__] = img_path
+                            img_path = os.path.join(output_folder, img_path)
+                        renderer.submit(cpx_beam_cp, img_path, txt, f"${unit}$")
+                        plan_imgs[metric.__name__].append(img_path)
+            if own_renderer:
+                renderer.close()
             return pm, plan_imgs
         else:
             print("Supplied file is not an RT_PLAN")
     return None, None
 
 
-def calculate_RTPlan_custom_metrics(rtp_filename: str) -> dict:
+def calculate_RTPlan_custom_metrics(rtp_filename: str, plan_dict=None, cache=None, fingerprint: str = None) -> dict:
     """
     Calculates Custom Complexity indexes from RTPlan
+    Per-CP metrics of each beam are stored in a ControlPointTable (under the "Sequence" key),
+    and beam/plan metrics are computed as reductions over its columns
+    :param plan_dict: plan dictionary, if already parsed (rtp_filename is not read again),
+                    or a function returning it, called only when needed
+    :param cache: a MetricCache storing the results (None not to use a cache)
+    :param fingerprint: the fingerprint of the plan, key of the results in the cache
     :return: a dictionary containing the metric value and the unit for each RTPlan metric
     """
 
-    if rtp_filename is not None:
+    if (rtp_filename is not None) or (plan_dict is not None):
 
-        plan_dict = RTPlan(filename=rtp_filename).get_plan()
+        use_cache = (cache is not None) and (fingerprint is not None)
+        if use_cache:
+            pcm = cache.get(fingerprint, CUSTOM_METRICS_KEY, CUSTOM_METRICS_VERSION)
+            if pcm is not None:
+                return pcm
+
+        if plan_dict is None:
+            plan_dict = RTPlan(filename=rtp_filename).get_plan()
+        elif callable(plan_dict):
+            plan_dict = plan_dict()
         beam_index = 1
         pcm = {}
 
@@ -88,153 +233,47 @@ def calculate_RTPlan_custom_metrics(rtp_filename: str) -> dict:
             beam_name = "Beam" + str(beam_index)
             beam_mu = float(beam['MU'])
             beam_final_ms_weight = float(beam['FinalCumulativeMetersetWeight'])
-            pcm[beam_name] = {"Sequence": [], "MUbeam": beam_mu, "MUfinalweight": beam_final_ms_weight}
-
-            item_index = 0
-            left_jaws = []
-            right_jaws = []
-            for item in beam["ControlPointSequence"]:
-                item_index += 1
-                cp_mu = float(item['CumulativeMetersetWeight'].value)
-                if hasattr(item, "BeamLimitingDevicePositionSequence"):
-                    if len(item.BeamLimitingDevicePositionSequence) == 3:
-                        y_data = item.BeamLimitingDevicePositionSequence[1].LeafJawPositions
-                        lj_arr = item.BeamLimitingDevicePositionSequence[2].LeafJawPositions
-                    else:
-                        y_data = item.BeamLimitingDevicePositionSequence[0].LeafJawPositions
-                        lj_arr = item.BeamLimitingDevicePositionSequence[1].LeafJawPositions
-                    cm, left, right = complexity_indexes(y_data, lj_arr)
-                    left_jaws.append(left)
-                    right_jaws.append(right)
-                    if cm is not None:
-                        cm["index"] = item_index
-                        if item_index < len(beam["ControlPointSequence"]):
-                            next_cp_mu = float(
-                                beam["ControlPointSequence"][item_index]['CumulativeMetersetWeight'].value)
-                            cm["MU"] = (next_cp_mu - cp_mu) * beam_mu / beam_final_ms_weight
-                        else:
-                            cm["MU"] = 0
-                        cm["MUrel"] = cm["MU"] / beam_mu
-                        cm["MUcumrel"] = cp_mu + cm["MUrel"]
-                    pcm[beam_name]["Sequence"].append(cm)
-                else:
-                    print("Item " + str(item_index) + "of beam " + str(beam_index) + " not properly formatted")
+
+            # Jaw and leaf positions of all control points, as extracted in the geometry of the beam
+            geometry = BeamGeometry.from_beam(beam)
+            cp_indexes = geometry.control_point_indexes
+            for item_index in numpy.setdiff1d(numpy.arange(geometry.control_point_count), cp_indexes):
+                print("Item " + str(item_index + 1) + "of beam " + str(beam_index) + " not properly formatted")
+            if geometry.y_jaw_positions is None:
+                raise ValueError("Jaw and MLC positions of beam " + str(beam_index) + " cannot be read")
+            y_jaws = geometry.y_jaw_positions
+            mlc_jaws = geometry.mlc_positions
+            cp_indexes = cp_indexes + 1
             beam_index += 1
 
-            # Compute Additional Beam metrics: M
-            M = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                M = M + cp_metrics["MU"] * cp_metrics["perimeter"] / cp_metrics["area"]
-            pcm[beam_name]["M"] = M / pcm[beam_name]["MUbeam"]
+            # Complexity indexes of all control points at once
+            cms, left_jaws, right_jaws = complexity_indexes_batch(y_jaws, mlc_jaws)
+            cp_table = ControlPointTable(cms)
+
+            # MU delivered between each control point and the next one (0 for the last one)
+            cp_weights = geometry.meterset_weights
+            next_weights = numpy.append(cp_weights[1:], cp_weights[-1])
+            cp_mu = cp_weights[cp_indexes - 1]
+            cp_table.add_column("index", cp_indexes)
+            cp_table.add_column("MU", numpy.where(cp_indexes < len(cp_weights),
+                                                  (next_weights[cp_indexes - 1] - cp_mu) * beam_mu / beam_final_ms_weight,
+                                                  0.0))
+            cp_table.add_column("MUrel", cp_table.column("MU") / beam_mu)
+            cp_table.add_column("MUcumrel", cp_mu + cp_table.column("MUrel"))
 
             # Compute Additional CP/Beam metrics: AAV
-            left_jaws = numpy.asarray(left_jaws)
-            right_jaws = numpy.asarray(right_jaws)
-            norm_factor = sum(abs(numpy.max(right_jaws, axis=0) - numpy.min(left_jaws, axis=0)))
-            for i in range(len(pcm[beam_name]["Sequence"])):
-                pcm[beam_name]["Sequence"][i]["AAV"] = \
-                    pcm[beam_name]["Sequence"][i]["sumAllApertures"] / norm_factor
-
-            # Compute Additional Beam metrics: MCS
-            MCS = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                MCS = MCS + cp_metrics["AAV"] * cp_metrics["LSV"] * cp_metrics["MUrel"]
-            pcm[beam_name]["MCS"] = MCS
-
-            # Compute Additional Beam metrics: MCSV
-            MCSV = 0
-            for i in range(len(pcm[beam_name]["Sequence"]) - 1):
-                cpi = pcm[beam_name]["Sequence"][i]
-                cpi1 = pcm[beam_name]["Sequence"][i + 1]
-                MCSV = MCSV + (cpi["AAV"] + cpi1["AAV"]) / 2 * (cpi["LSV"] + cpi1["LSV"]) / 2 * cpi["MUrel"]
-            pcm[beam_name]["MCSV"] = MCSV
-
-            # Compute Additional Beam metrics: MFC
-            MFC = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                MFC = MFC + cp_metrics["area"] * cp_metrics["MUrel"]
-            pcm[beam_name]["MFC"] = MFC
-
-            # Compute Additional Beam metrics: BI
-            BI = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                BI = BI + cp_metrics["MUrel"] * (
-                            math.pow(cp_metrics["perimeter"], 2) / (4 * math.pi * cp_metrics["area"]))
-            pcm[beam_name]["BI"] = BI
-
-            # Compute Additional Beam metrics: average aperture less than 10mm / 1cm
-            aal10 = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                if cp_metrics["avgAperture"] <= 10:
-                    aal10 = aal10 + 1
-            pcm[beam_name]["avgApertureLessThan1cm"] = aal10
-
-            # Compute Additional Beam metrics: average aperture less than 10mm / 1cm
-            ydl10 = 0
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                if cp_metrics["yDiff"] <= 10:
-                    ydl10 = ydl10 + 1
-            pcm[beam_name]["yDiffLessThan1cm"] = ydl10
-
-            # Compute Additional Beam metrics: SAS
-            SAS = {"nAperturesLeq2": 0, "nAperturesLeq5": 0, "nAperturesLeq10": 0, "nAperturesLeq20": 0}
-            for cp_metrics in pcm[beam_name]["Sequence"]:
-                for key in SAS:
-                    SAS[key] = SAS[key] + cp_metrics[key] / cp_metrics["nAperturesG0"] * cp_metrics["MUrel"]
-            pcm[beam_name]["SAS2"] = SAS["nAperturesLeq2"]
-            pcm[beam_name]["SAS5"] = SAS["nAperturesLeq5"]
-            pcm[beam_name]["SAS10"] = SAS["nAperturesLeq10"]
-            pcm[beam_name]["SAS20"] = SAS["nAperturesLeq20"]
+            norm_factor = sequential_sum(abs(numpy.max(right_jaws, axis=0) - numpy.min(left_jaws, axis=0)))
+            cp_table.add_column("AAV", cp_table.column("sumAllApertures") / norm_factor)
+
+            pcm[beam_name] = {"Sequence": cp_table, "MUbeam": beam_mu, "MUfinalweight": beam_final_ms_weight}
+            pcm[beam_name].update(compute_beam_metrics(cp_table, beam_mu))
 
         # Computing Plan Metrics
         beams = copy.deepcopy(list(pcm.keys()))
-        pcm["plan"] = {}
-
-        MU = 0
-        for beam_name in beams:
-            MU = MU + pcm[beam_name]["MUbeam"]
-        pcm["plan"]["MUplan"] = MU
-
-        M = 0
-        for beam_name in beams:
-            M = M + pcm[beam_name]["MUbeam"] * pcm[beam_name]["M"]
-        pcm["plan"]["Mplan"] = M / MU
-
-        MCS = 0
-        for beam_name in beams:
-            MCS = MCS + pcm[beam_name]["MUbeam"] * pcm[beam_name]["MCS"]
-        pcm["plan"]["MCSplan"] = MCS / MU
-
-        MCSV = 0
-        for beam_name in beams:
-            MCSV = MCSV + pcm[beam_name]["MUbeam"] * pcm[beam_name]["MCSV"]
-        pcm["plan"]["MCSVplan"] = MCSV / MU
-
-        MFC = 0
-        for beam_name in beams:
-            MFC = MFC + pcm[beam_name]["MUbeam"] * pcm[beam_name]["MFC"]
-        pcm["plan"]["MFCplan"] = MFC / MU
-
-        PI = 0
-        for beam_name in beams:
-            PI = PI + pcm[beam_name]["MUbeam"] * pcm[beam_name]["BI"]
-        pcm["plan"]["PI"] = PI / MU
-
-        nCP = 0
-        for beam_name in beams:
-            nCP = nCP + len(pcm[beam_name]["Sequence"])
-        pcm["plan"]["nCP"] = nCP
-
-        al10 = 0
-        for beam_name in beams:
-            al10 = al10 + pcm[beam_name]["avgApertureLessThan1cm"]
-        pcm["plan"]["avgApertureLessThan1cm"] = al10
-
-        yl10 = 0
-        for beam_name in beams:
-            yl10 = yl10 + pcm[beam_name]["yDiffLessThan1cm"]
-        pcm["plan"]["yDiffLessThan1cm"] = yl10
+        pcm["plan"] = compute_plan_metrics(pcm, beams)
 
+        if use_cache:
+            cache.put(fingerprint, CUSTOM_METRICS_KEY, CUSTOM_METRICS_VERSION, pcm)
         return pcm
 
     else:
@@ -243,6 +282,70 @@ def calculate_RTPlan_custom_metrics(rtp_filename: str) -> dict:
     return None
 
 
+def compute_beam_metrics(cp_table: ControlPointTable, beam_mu: float) -> dict:
+    """
+    Computes beam metrics as reductions over the per-CP columns of a beam
+    :param cp_table: the ControlPointTable of the beam
+    :param beam_mu: MU of the beam
+    :return: a dictionary containing the beam metrics
+    """
+    mu = cp_table.column("MU")
+    mu_rel = cp_table.column("MUrel")
+    area = cp_table.column("area")
+    perimeter = cp_table.column("perimeter")
+    aav = cp_table.column("AAV")
+    lsv = cp_table.column("LSV")
+    n_open = cp_table.column("nAperturesG0")
+
+    bm = {
+        # M
+        "M": float(sequential_sum(mu * perimeter / area)) / beam_mu,
+        # MCS
+        "MCS": float(sequential_sum(aav * lsv * mu_rel)),
+        # MCSV
+        "MCSV": float(sequential_sum((aav[:-1] + aav[1:]) / 2 * (lsv[:-1] + lsv[1:]) / 2 * mu_rel[:-1])),
+        # MFC
+        "MFC": float(sequential_sum(area * mu_rel)),
+        # BI
+        "BI": float(sequential_sum(mu_rel * (perimeter ** 2 / (4 * math.pi * area)))),
+        # average aperture less than 10mm / 1cm
+        "avgApertureLessThan1cm": int(numpy.count_nonzero(cp_table.column("avgAperture") <= 10)),
+        # y jaws closer than 10mm / 1cm
+        "yDiffLessThan1cm": int(numpy.count_nonzero(cp_table.column("yDiff") <= 10)),
+    }
+    # SAS
+    for threshold in [2, 5, 10, 20]:
+        bm["SAS" + str(threshold)] = \
+            float(sequential_sum(cp_table.column("nAperturesLeq" + str(threshold)) / n_open * mu_rel))
+    return bm
+
+
+def compute_plan_metrics(pcm: dict, beams: list) -> dict:
+    """
+    Computes plan metrics as MU-weighted reductions over beam metrics
+    :param pcm: the dictionary of custom metrics of each beam
+    :param beams: the names of the beams in pcm
+    :return: a dictionary containing the plan metrics
+    """
+    beam_mu = numpy.array([pcm[beam_name]["MUbeam"] for beam_name in beams])
+    MU = float(sequential_sum(beam_mu))
+
+    def weighted(key):
+        return float(sequential_sum(beam_mu * numpy.array([pcm[beam_name][key] for beam_name in beams]))) / MU
+
+    return {
+        "MUplan": MU,
+        "Mplan": weighted("M"),
+        "MCSplan": weighted("MCS"),
+        "MCSVplan": weighted("MCSV"),
+        "MFCplan": weighted("MFC"),
+        "PI": weighted("BI"),
+        "nCP": sum(len(pcm[beam_name]["Sequence"]) for beam_name in beams),
+        "avgApertureLessThan1cm": sum(pcm[beam_name]["avgApertureLessThan1cm"] for beam_name in beams),
+        "yDiffLessThan1cm": sum(pcm[beam_name]["yDiffLessThan1cm"] for beam_name in beams),
+    }
+
+
 def complexity_indexes(y12, lj_array: numpy.ndarray, jawSize:int=5):
     """
     Computes complexity indexes over a set of jaws
@@ -365,18 +468,128 @@ def complexity_indexes(y12, lj_array: numpy.ndarray, jawSize:int=5):
     return cm,  lj_array[0:int(len(lj_array)/2)], lj_array[int(len(lj_array)/2):]
 
 
+def complexity_indexes_batch(y12: numpy.ndarray, lj_array: numpy.ndarray, jawSize: int = 5):
+    """
+    Computes complexity indexes over the jaws of all control points of a beam at once
+    (same results as calling complexity_indexes once per control point)
+    :param y12: (n_cp x 2) array with the size of relevant area of each control point
+    :param lj_array: (n_cp x n_jaws) array with the jaws of each control point
+    :param jawSize: size of jaws
+    :return: a dictionary with the keys of complexity_indexes, each holding one value per control point
+    """
+    y12 = numpy.asarray(y12, dtype=float)
+    lj_array = numpy.asarray(lj_array, dtype=float)
+    n_jaws = lj_array.shape[1]
+    half = int(n_jaws / 2)
+
+    minActiveIndex = int(n_jaws / 4) + numpy.trunc(y12[:, 0] / jawSize).astype(int)
+    maxActiveIndex = int(n_jaws / 4) + numpy.trunc(y12[:, 1] / jawSize).astype(int)
+    activeMLC = maxActiveIndex - minActiveIndex
+    if numpy.any(activeMLC <= 0):
+        raise ValueError("Found control points without active MLCs")
+
+    # Active MLCs of each control point, left-aligned: column k is MLC minActiveIndex + k
+    k = numpy.arange(activeMLC.max())
+    index = minActiveIndex[:, None] + k
+    active = k < activeMLC[:, None]
+    if numpy.any(active & ((index < -n_jaws) | (half + index >= n_jaws))):
+        raise IndexError("Active MLC index out of the jaws array")
+    left = numpy.take_along_axis(lj_array, index % n_jaws, axis=1)
+    right = numpy.take_along_axis(lj_array, (half + index) % n_jaws, axis=1)
+    apertures = numpy.abs(left - right)
+
+    # Pre-Scan of the MLCs
+    max_right = numpy.max(right, axis=1, where=active, initial=-sys.float_info.max)
+    min_left = numpy.min(left, axis=1, where=active, initial=sys.float_info.max)
+    pos_max = numpy.abs(max_right - min_left)
+
+    kernel = compiled(perimeter_lsv_kernel)
+    if kernel is not None:
+        perimeter, lsv_l, lsv_r = kernel(left, right, activeMLC, pos_max)
+    else:
+        perimeter, lsv_l, lsv_r = perimeter_lsv(left, right, apertures, active, pos_max)
+    lsv = lsv_l * lsv_r / (activeMLC * pos_max) ** 2
+
+    ap_active = numpy.where(active, apertures, 0.0)
+    ap_total = sequential_sum(ap_active)
+    y_diff = numpy.abs(y12[:, 0] - y12[:, 1])
+
+    cm = {
+        "minAperture": numpy.min(apertures, axis=1, where=active, initial=numpy.inf),
+        "maxAperture": numpy.max(apertures, axis=1, where=active, initial=-numpy.inf),
+        "maxApertureNoAlign": pos_max,
+        "avgAperture": ap_total / activeMLC,
+        "sumAllApertures": sequential_sum(numpy.abs(lj_array[:, half:2 * half] - lj_array[:, :half])),
+        "yDiff": y_diff,
+        "totalMLC": numpy.full(len(lj_array), half),
+        "activeMLC": activeMLC,
+        "lowestActiveMLC": minActiveIndex,
+        "highestActiveMLC": maxActiveIndex - 1,
+        "perimeter": perimeter + y_diff * 2,
+        "perimeterNoMLCSize": perimeter,
+        "area": ap_total * jawSize,
+        "LSV": lsv,
+        "nAperturesG0": numpy.sum(active & (apertures > 0), axis=1),
+        "nAperturesLeq2": numpy.sum(active & (apertures <= 2), axis=1),
+        "nAperturesLeq5": numpy.sum(active & (apertures <= 5), axis=1),
+        "nAperturesLeq10": numpy.sum(active & (apertures <= 10), axis=1),
+        "nAperturesLeq20": numpy.sum(active & (apertures <= 20), axis=1),
+    }
+
+    # Complexity measures, left jaws, right jaws
+    return cm, lj_array[:, 0:half], lj_array[:, half:]
+
+
+def perimeter_lsv(left: numpy.ndarray, right: numpy.ndarray, apertures: numpy.ndarray, active: numpy.ndarray,
+                  pos_max: numpy.ndarray):
+    """
+    Computes the perimeter and the LSV sums of complexity_indexes_batch with NumPy
+    (jit_utils.perimeter_lsv_kernel is used instead when numba is available)
+    :param left: (n_cp x n_active) left positions of the active MLCs, left-aligned
+    :param right: (n_cp x n_active) right positions of the active MLCs, left-aligned
+    :param apertures: (n_cp x n_active) apertures of the active MLCs
+    :param active: (n_cp x n_active) True for the columns holding an active MLC
+    :param pos_max: maximum aperture between misaligned MLCs of each control point
+    :return: the perimeter, and the left and right LSV sums of each control point
+    """
+    activeMLC = active.sum(axis=1)
+
+    # LSV (avoiding the last active control point)
+    lsv_mask = active[:, 1:]
+    lsv_l = sequential_sum(numpy.where(lsv_mask, pos_max[:, None] - numpy.abs(left[:, :-1] - left[:, 1:]), 0.0))
+    lsv_r = sequential_sum(numpy.where(lsv_mask, pos_max[:, None] - numpy.abs(right[:, :-1] - right[:, 1:]), 0.0))
+
+    # Perimeter: each active MLC against the previous one
+    ap_old, ap_new = apertures[:, :-1], apertures[:, 1:]
+    left_old, left_new = left[:, :-1], left[:, 1:]
+    right_old, right_new = right[:, :-1], right[:, 1:]
+    contrib = numpy.select(
+        [
+            # Two apertures do not overlap
+            (right_new <= left_old) | (left_new >= right_old),
+            # Old aperture wraps the new one
+            (right_new <= right_old) & (left_new >= left_old),
+            # New aperture wraps the old one
+            (right_new > right_old) & (left_new < left_old),
+        ],
+        [ap_new + ap_old, ap_old - ap_new, ap_new - ap_old],
+        # New aperture overlaps + exceeds on the right/left
+        default=numpy.abs(left_new - left_old) + numpy.abs(right_new - right_old),
+    )
+    contrib = numpy.where(active[:, 1:], contrib, 0.0)
+    last_aperture = apertures[numpy.arange(len(apertures)), activeMLC - 1]
+    perimeter = sequential_sum(numpy.column_stack((apertures[:, 0], contrib, last_aperture)))
+    return perimeter, lsv_l, lsv_r
+
+
 def compute_metrics_stat(pcm, beams):
-    cm_array = []
-    for beam in beams:
-        cm_array.extend(pcm[beam]["Sequence"])
+    tables = [pcm[beam]["Sequence"] for beam in beams]
     ms = {}
-    for key in list(cm_array[0].keys()):
-        num_list = []
-        for cm in cm_array:
-            num_list.append(cm[key])
+    for key in tables[0].keys():
+        num_list = numpy.concatenate([table.column(key) for table in tables])
         ms[key + "_avg"] = numpy.average(num_list)
         ms[key + "_std"] = numpy.std(num_list)
         ms[key + "_max"] = numpy.max(num_list)
         ms[key + "_min"] = numpy.min(num_list)
         ms[key + "_med"] = numpy.median(num_list)
-    return ms
\ No newline at end of file
+    return ms
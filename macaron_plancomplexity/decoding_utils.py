@@ -0,0 +1,104 @@
+import numpy
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+LEAF_JAW_POSITIONS = Tag(0x300A, 0x011C)
+GANTRY_ANGLE = Tag(0x300A, 0x011E)
+CUMULATIVE_METERSET_WEIGHT = Tag(0x300A, 0x0134)
+BEAM_LIMITING_DEVICE_POSITION_SEQUENCE = Tag(0x300A, 0x011A)
+
+
+def get_raw_value(dataset, tag) -> object:
+    """
+    Gets the value of an element without letting pydicom convert it: the raw bytes if the element was never
+    accessed (so no DSfloat is created), its converted value otherwise
+    :param dataset: the pydicom Dataset
+    :param tag: the tag of the element
+    :return: the bytes or the converted value, None if the element is missing
+    """
+    element = dataset.get_item(tag)
+    return None if element is None else element.value
+
+
+def decode_DS(values: list) -> tuple:
+    """
+    Decodes many Decimal String values at once: the numbers of all the values are parsed by a single
+    numpy conversion, instead of one DSfloat per number
+    :param values: the values, as returned by get_raw_value (raw bytes, converted values or None)
+    :return: a float64 array with the numbers of all the values, and an array with the count of numbers of each value
+    """
+    tokens = []
+    counts = numpy.zeros(len(values), dtype=numpy.intp)
+    for i, value in enumerate(values):
+        if isinstance(value, bytes):
+            value = value.strip(b" \x00")
+            numbers = value.split(b"\\") if len(value) > 0 else []
+        elif (value is None) or (value == ""):
+            numbers = []
+        elif isinstance(value, (MultiValue, list, tuple)):
+            numbers = list(value)
+        else:
+            numbers = [value]
+        tokens.extend(numbers)
+        counts[i] = len(numbers)
+    return numpy.array(tokens, dtype=float), counts
+
+
+def decode_DS_rows(values: list) -> numpy.ndarray:
+    """
+    Decodes Decimal String values having the same number of numbers (e.g. the LeafJawPositions of all the
+    control points of a beam)
+    :param values: the values, as returned by get_raw_value
+    :return: a float64 array with one row per value
+    """
+    numbers, counts = decode_DS(values)
+    if len(values) == 0:
+        return numbers.reshape(0, 0)
+    if (counts != counts[0]).any():
+        raise ValueError("Values have different numbers of elements")
+    return numbers.reshape(len(values), counts[0])
+
+
+def decode_DS_scalars(values: list, default: float = numpy.nan) -> numpy.ndarray:
+    """
+    Decodes single-number Decimal String values
+    :param values: the values, as returned by get_raw_value
+    :param default: the number of missing or empty values
+    :return: a float64 array with one number per value
+    """
+    numbers, counts = decode_DS(values)
+    if (counts > 1).any():
+        raise ValueError("Values have more than one element")
+    result = numpy.full(len(values), default, dtype=float)
+    result[counts == 1] = numbers
+    return result
+
+
+def get_control_point_values(control_points, tag, default: float = numpy.nan) -> numpy.ndarray:
+    """
+    Decodes a single-number element (e.g. GANTRY_ANGLE or CUMULATIVE_METERSET_WEIGHT) of all the control points
+    of a beam at once
+    :param control_points: the ControlPointSequence of the beam
+    :param tag: the tag of the element
+    :param default: the number of control points without the element
+    :return: a float64 array with one number per control point
+    """
+    return decode_DS_scalars([get_raw_value(control_point, tag) for control_point in control_points], default)
+
+
+def get_raw_leaf_jaw_positions(control_points) -> tuple:
+    """
+    Gets the raw LeafJawPositions of the control points of a beam, to be decoded with decode_DS_rows
+    once the beam limiting devices to use are chosen
+    :param control_points: the ControlPointSequence of the beam
+    :return: the indexes (from 0) of the control points having a BeamLimitingDevicePositionSequence,
+            and for each of them, the list of raw LeafJawPositions of the items of the sequence
+    """
+    indexes = []
+    positions = []
+    for index, control_point in enumerate(control_points):
+        if BEAM_LIMITING_DEVICE_POSITION_SEQUENCE in control_point:
+            indexes.append(index)
+            positions.append([get_raw_value(device, LEAF_JAW_POSITIONS)
+                              for device in control_point[BEAM_LIMITING_DEVICE_POSITION_SEQUENCE].value])
+    return numpy.array(indexes, dtype=numpy.intp), positions
@@ -9,13 +9,54 @@ import numpy as np
 import pydicom as dicom
 from pydicom.valuerep import IS
 
+from macaron_plancomplexity.BeamGeometry import BeamGeometry
+from macaron_plancomplexity.LazyDict import LazyDict
+
+# Beam attributes copied by get_beams, as (key in the beam dict, DICOM keyword)
+BEAM_ATTRIBUTES = [
+    ("Manufacturer", "Manufacturer"),
+    ("InstitutionName", "InstitutionName"),
+    ("TreatmentMachineName", "TreatmentMachineName"),
+    ("BeamName", "BeamName"),
+    ("SourcetoSurfaceDistance", "SourcetoSurfaceDistance"),
+    ("BeamDescription ", "BeamDescription"),
+    ("BeamType", "BeamType"),
+    ("RadiationType", "RadiationType"),
+    ("ManufacturerModelName", "ManufacturerModelName"),
+    ("PrimaryDosimeterUnit", "PrimaryDosimeterUnit"),
+    ("NumberofWedges", "NumberofWedges"),
+    ("NumberofCompensators", "NumberofCompensators"),
+    ("NumberofBoli", "NumberofBoli"),
+    ("NumberofBlocks", "NumberofBlocks"),
+    ("FinalCumulativeMetersetWeight", "FinalCumulativeMetersetWeight"),
+    ("NumberofControlPoints", "NumberofControlPoints"),
+    ("TreatmentDeliveryType", "TreatmentDeliveryType"),
+    ("BeamLimitingDeviceSequence", "BeamLimitingDeviceSequence"),
+]
+
+# Attributes of the first control point copied by get_beams
+CONTROL_POINT_ATTRIBUTES = ["NominalBeamEnergy", "DoseRateSet", "IsocenterPosition", "GantryAngle",
+                            "BeamLimitingDeviceAngle", "TableTopEccentricAngle"]
+
+# Fields of the beams of get_beams holding pydicom sequences, removed by release_beam
+SEQUENCE_KEYS = ["ControlPointSequence", "IonControlPointSequence", "BeamLimitingDeviceSequence"]
+
 
 class RTPlan:
     """Class that parses and returns formatted DICOM RT Plan data."""
 
-    def __init__(self, filename: str) -> None:
-
-        if filename:
+    def __init__(self, filename: str = None, dataset: dicom.FileDataset = None) -> None:
+        """
+        Parses the RT Plan from filename, or wraps a dataset that was already read from disk
+        :param filename: path to the RT Plan
+        :param dataset: the FileDataset of the RT Plan, if already loaded
+        """
+        if dataset is not None:
+            self.plan = dict()
+            self.ds = dataset
+            if "SOPClassUID" not in self.ds:
+                raise AttributeError
+        elif filename:
             self.plan = dict()
             try:
                 # Only pydicom 0.9.5 and above supports the force read argument
@@ -35,79 +76,122 @@ class RTPlan:
         else:
             raise AttributeError
 
-    def get_plan(self) -> Dict[str, str]:
-        """Returns the plan information."""
+    def get_plan(self, lazy: bool = False) -> Dict[str, str]:
+        """Returns the plan information.
+        If lazy, plan fields and beams (see get_beams) are only decoded when they are accessed."""
+        if lazy:
+            return self.get_lazy_plan()
         self.plan["label"] = self.ds.RTPlanLabel
         self.plan["date"] = self.ds.RTPlanDate
         self.plan["time"] = self.ds.RTPlanTime
-        self.plan["name"] = ""
-        self.plan["rxdose"] = 0.0
+        self.plan["name"], self.plan["rxdose"] = self.get_prescription()
+        self.plan.update(self.get_fractions())
+
+        # referenced beams
+        ref_beams = self.get_beams()
+        self.plan["beams"] = ref_beams
+
+        # try estimate the number of isocenters
+        self.plan["n_isocenters"] = self.count_isocenters(ref_beams)
+
+        # Total number of MU
+        self.plan["Plan_MU"] = self.get_total_mu(ref_beams)
+
+        tmp = self.get_study_info()
+        self.plan["description"] = tmp["description"]
+        self.plan["plan_name"] = self.get_plan_name()
+        self.plan["patient_name"] = self.get_patient_name()
+        return self.plan
+
+    def get_lazy_plan(self) -> LazyDict:
+        """Returns the plan information of get_plan as a LazyDict: metric code that only reads the
+        control points of the beams does not pay for isocenters, total MU, prescription and study info."""
+        plan = LazyDict(
+            loaders={
+                "label": lambda: self.ds.RTPlanLabel,
+                "date": lambda: self.ds.RTPlanDate,
+                "time": lambda: self.ds.RTPlanTime,
+                "name": lambda: self.get_prescription()[0],
+                "rxdose": lambda: self.get_prescription()[1],
+                "beams": lambda: self.get_beams(lazy=True),
+                "n_isocenters": lambda: self.count_isocenters(plan["beams"]),
+                "Plan_MU": lambda: self.get_total_mu(plan["beams"]),
+                "description": lambda: self.get_study_info()["description"],
+                "plan_name": self.get_plan_name,
+                "patient_name": self.get_patient_name,
+            },
+            extra_loader=self.get_fractions,
+        )
+        return plan
+
+    def get_prescription(self):
+        """Returns the name of the prescription site and the prescription dose."""
+        name = ""
+        rxdose = 0.0
         if "DoseReferenceSequence" in self.ds:
             for item in self.ds.DoseReferenceSequence:
                 if item.DoseReferenceStructureType == "SITE":
-                    self.plan["name"] = "N/A"
+                    name = "N/A"
                     if "DoseReferenceDescription" in item:
-                        self.plan["name"] = item.DoseReferenceDescription
+                        name = item.DoseReferenceDescription
                     if "TargetPrescriptionDose" in item:
-                        rxdose = item.TargetPrescriptionDose * 100
-                        if rxdose > self.plan["rxdose"]:
-                            self.plan["rxdose"] = rxdose
+                        dose = item.TargetPrescriptionDose * 100
+                        if dose > rxdose:
+                            rxdose = dose
                 elif item.DoseReferenceStructureType == "VOLUME":
                     if "TargetPrescriptionDose" in item:
-                        self.plan["rxdose"] = item.TargetPrescriptionDose * 100
-        if ("FractionGroupSequence" in self.ds) and (self.plan["rxdose"] == 0):
+                        rxdose = item.TargetPrescriptionDose * 100
+        if ("FractionGroupSequence" in self.ds) and (rxdose == 0):
             fg = self.ds.FractionGroupSequence[0]
             if ("ReferencedBeamSequence" in fg) and ("NumberofFractionsPlanned" in fg):
                 beams = fg.ReferencedBeamSequence
                 fx = fg.NumberofFractionsPlanned
                 for beam in beams:
                     if "BeamDose" in beam:
-                        self.plan["rxdose"] += beam.BeamDose * fx * 100
+                        rxdose += beam.BeamDose * fx * 100
+        return name, int(rxdose)
 
+    def get_fractions(self) -> Dict[str, int]:
+        """Returns {"fractions": number of fractions planned}, or an empty dict if not referenced."""
         if "FractionGroupSequence" in self.ds:
             fg = self.ds.FractionGroupSequence[0]
             if "ReferencedBeamSequence" in fg:
-                self.plan["fractions"] = fg.NumberOfFractionsPlanned
-        self.plan["rxdose"] = int(self.plan["rxdose"])
+                return {"fractions": fg.NumberOfFractionsPlanned}
+        return {}
 
-        # referenced beams
-        ref_beams = self.get_beams()
-        self.plan["beams"] = ref_beams
-
-        # try estimate the number of isocenters
-        isos = np.array([ref_beams[i]["IsocenterPosition"] for i in ref_beams])
+    @staticmethod
+    def count_isocenters(beams) -> int:
+        """Estimates the number of isocenters of the beams."""
+        isos = np.array([beams[i]["IsocenterPosition"] for i in beams])
 
         # round to 2 decimals
         isos = np.round(isos, 2)
         dist = np.sqrt(np.sum((isos - isos[0]) ** 2, axis=1))
-        self.plan["n_isocenters"] = len(np.unique(dist))
+        return len(np.unique(dist))
 
-        # Total number of MU
-        total_mu = np.sum(
-            [ref_beams[b]["MU"] for b in ref_beams if "MU" in ref_beams[b]]
-        )
-        self.plan["Plan_MU"] = total_mu
+    @staticmethod
+    def get_total_mu(beams) -> float:
+        """Returns the total number of MU of the beams."""
+        return np.sum([beams[b]["MU"] for b in beams if "MU" in beams[b]])
 
-        tmp = self.get_study_info()
-        self.plan["description"] = tmp["description"]
-        if "RTPlanName" in self.ds:
-            self.plan["plan_name"] = self.ds.RTPlanName
-        else:
-            self.plan["plan_name"] = ""
+    def get_plan_name(self) -> str:
+        """Returns the name of the plan."""
+        return self.ds.RTPlanName if "RTPlanName" in self.ds else ""
+
+    def get_patient_name(self) -> str:
+        """Returns the name of the patient, as 'Family Given'."""
         if "PatientsName" in self.ds:
-            name = (
+            return (
                 self.ds.PatientsName.family_comma_given()
                 .replace(",", "")
                 .replace("^", " ")
                 .strip()
             )
-            self.plan["patient_name"] = name
-        else:
-            self.plan["patient_name"] = ""
-        return self.plan
+        return ""
 
-    def get_beams(self, fx: int = 0) -> Dict[IS, Dict[str, str]]:
-        """Return the referenced beams from the specified fraction."""
+    def get_beams(self, fx: int = 0, lazy: bool = False) -> Dict[IS, Dict[str, str]]:
+        """Return the referenced beams from the specified fraction.
+        If lazy, each beam is a LazyDict whose fields are decoded on first access (see get_lazy_beam)."""
 
         beams = {}
         if "BeamSequence" in self.ds:
@@ -118,6 +202,9 @@ class RTPlan:
             return beams
         # Obtain the beam information
         for bi in bdict:
+            if lazy:
+                beams[bi.BeamNumber] = self.get_lazy_beam(bi)
+                continue
             beam = dict()
             beam["Manufacturer"] = bi.Manufacturer if "Manufacturer" in bi else ""
             beam["InstitutionName"] = (
@@ -261,6 +348,40 @@ class RTPlan:
                         beams[bi.ReferencedBeamNumber]["MU"] = float(bi.BeamMeterset)
         return beams
 
+    @staticmethod
+    def get_lazy_beam(bi: dicom.Dataset) -> LazyDict:
+        """Returns the fields of a beam as get_beams does, in a LazyDict: each field is decoded on first access,
+        and the control points are only read when needed (e.g. by metrics)."""
+        loaders = dict((key, attribute_loader(bi, keyword)) for (key, keyword) in BEAM_ATTRIBUTES)
+        if "ControlPointSequence" in bi:
+            loaders["ControlPointSequence"] = lambda: bi.ControlPointSequence
+            for keyword in CONTROL_POINT_ATTRIBUTES:
+                loaders[keyword] = attribute_loader(bi, keyword, "ControlPointSequence")
+
+        def load_extra():
+            # Fields whose presence depends on the first control point
+            beam = dict()
+            if "ControlPointSequence" in bi:
+                cp0 = bi.ControlPointSequence[0]
+                final_cp = bi.ControlPointSequence[-1]
+                if "GantryRotationDirection" in cp0:
+                    if cp0.GantryRotationDirection != "NONE":
+                        beam["GantryRotationDirection"] = cp0.GantryRotationDirection
+                        if not hasattr(final_cp, "GantryRotationDirection") or final_cp.GantryRotationDirection == "NONE":
+                            beam["GantryFinalAngle"] = final_cp.GantryAngle if "GantryAngle" in cp0 else ""
+                if "BeamLimitingDevicePositionSequence" in cp0:
+                    for bl in cp0.BeamLimitingDevicePositionSequence:
+                        beam[bl.RTBeamLimitingDeviceType] = bl.LeafJawPositions
+            if "IonControlPointSequence" in bi:
+                beam["IonControlPointSequence"] = bi.IonControlPointSequence
+                cp0 = bi.IonControlPointSequence[0]
+                for keyword in ["NominalBeamEnergyUnit", "NominalBeamEnergy", "DoseRateSet", "IsocenterPosition",
+                                "GantryAngle", "BeamLimitingDeviceAngle"]:
+                    beam[keyword] = getattr(cp0, keyword) if keyword in cp0 else ""
+            return beam
+
+        return LazyDict(loaders, load_extra)
+
     def get_study_info(self) -> Dict[str, str]:
         """Return the study information of the current file."""
 
@@ -276,3 +397,27 @@ class RTPlan:
             study["id"] = self.ds.StudyInstanceUID
 
         return study
+
+
+def attribute_loader(ds: dicom.Dataset, keyword: str, sequence: str = None):
+    """Returns a function reading an attribute of a dataset ("" if missing), or of the first item of one of
+    its sequences, for LazyDict."""
+
+    def load():
+        item = ds if sequence is None else getattr(ds, sequence)[0]
+        return getattr(item, keyword) if keyword in item else ""
+
+    return load
+
+
+def release_beam(beam: Dict[str, str]) -> None:
+    """Extracts the BeamGeometry of a beam of get_beams and decodes its other fields, then removes the fields
+    holding pydicom sequences (see SEQUENCE_KEYS), so that the beam no longer references the dataset."""
+    if "ControlPointSequence" in beam:
+        BeamGeometry.from_beam(beam)
+    for key in list(beam):
+        if key in SEQUENCE_KEYS:
+            del beam[key]
+        else:
+            # Decoding the value drops its loader, which reads the dataset
+            beam[key]
@@ -0,0 +1,87 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from macaron_plancomplexity.DICOMItem import DICOMItem
+from macaron_plancomplexity.DICOMType import DICOMType
+from macaron_plancomplexity.utils import load_DICOM_header
+
+
+def find_DICOM_groups(main_folder, workers: int = None) -> list:
+    """
+    Returns an array of DICOMItem in the main folder
+    @param main_folder: root folder
+    @param workers: number of threads scanning the folder (default of ThreadPoolExecutor if None)
+    @return: array of dicom groups, sorted by file path
+    """
+    plans = list(iter_DICOM_groups(main_folder, workers))
+    plans.sort(key=lambda item: item.rtp_file)
+    return plans
+
+
+def iter_DICOM_groups(main_folder, workers: int = None):
+    """
+    Finds all RTPlans below a folder, yielding a DICOMItem for each of them as soon as it is found.
+    Folders are walked iteratively: listing folders and reading DICOM headers is spread over a pool of threads
+    @param main_folder: root folder (or a single DICOM file)
+    @param workers: number of threads scanning the folder (default of ThreadPoolExecutor if None)
+    @return: a generator of DICOMItem
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        if os.path.isdir(main_folder):
+            pending.add(pool.submit(list_folder, main_folder))
+        elif is_DICOM_file(main_folder):
+            pending.add(pool.submit(read_plan_header, main_folder))
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if type(result) is tuple:
+                    # Header of a DICOM file
+                    file_path, header = result
+                    if header[1] == DICOMType.RT_PLAN:
+                        yield DICOMItem(file_path, header=header)
+                else:
+                    # Content of a folder
+                    for folder_path, is_folder in result:
+                        if is_folder:
+                            pending.add(pool.submit(list_folder, folder_path))
+                        else:
+                            pending.add(pool.submit(read_plan_header, folder_path))
+
+
+def list_folder(folder_path: str) -> list:
+    """
+    Lists the subfolders and DICOM files of a folder
+    @param folder_path: the folder to list
+    @return: a list of (path, is_folder) for subfolders and DICOM files
+    """
+    entries = []
+    try:
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    entries.append((entry.path, True))
+                elif entry.name.endswith(".dcm") and entry.is_file():
+                    entries.append((entry.path, False))
+    except OSError as e:
+        print('Failed to list %s. Reason: %s' % (folder_path, e))
+    return entries
+
+
+def read_plan_header(file_path: str) -> tuple:
+    """
+    Reads the header of a DICOM file
+    @param file_path: the DICOM file
+    @return: the path of the file, and the (DICOMObject, DICOMType) returned by load_DICOM_header
+    """
+    return file_path, load_DICOM_header(file_path)
+
+
+def is_DICOM_file(file_path: str) -> bool:
+    """
+    Checks if a path is a DICOM file that should be scanned
+    @param file_path: the path
+    @return: True if the path is a .dcm file
+    """
+    return os.path.isfile(file_path) and file_path.endswith(".dcm")
@@ -0,0 +1,98 @@
+"""
+Measures how long the entry points of the package take to import, each one in a fresh interpreter
+(as the command line and the worker processes of a batch do), and checks that they do not import
+heavy dependencies that only some code paths need.
+
+    python -m macaron_plancomplexity.import_benchmark [--repeat N] [--budget MS]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+ENTRY_POINTS = [
+    "macaron_plancomplexity.__main__",
+    "macaron_plancomplexity.batch_utils",
+    "macaron_plancomplexity.DICOMItem",
+    "macaron_plancomplexity.complexity_utils",
+]
+
+# Imported only by the code paths that need them (PIL is not listed: pydicom imports it when available)
+LAZY_MODULES = ["matplotlib", "pandas", "scipy", "pyarrow", "numba"]
+
+IMPORT_CODE = ("import sys, time\n"
+               "start = time.perf_counter()\n"
+               "import {module}\n"
+               "elapsed = time.perf_counter() - start\n"
+               "import json\n"
+               "print(json.dumps([elapsed, [m for m in {lazy!r} if m in sys.modules]]))\n")
+
+
+def measure_import(module: str, python: str = sys.executable) -> tuple:
+    """
+    Imports a module in a new interpreter
+    :param module: the name of the module
+    :param python: the interpreter to run
+    :return: the time spent importing the module, the time spent by the whole process (both in seconds),
+            and the list of LAZY_MODULES that were imported
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([python, "-c", IMPORT_CODE.format(module=module, lazy=LAZY_MODULES)],
+                               capture_output=True, text=True, check=True)
+    process_time = time.perf_counter() - start
+    import_time, loaded = json.loads(completed.stdout.splitlines()[-1])
+    return import_time, process_time, loaded
+
+
+def benchmark(entry_points: list = None, repeat: int = 5) -> dict:
+    """
+    Measures the import time of entry points (median of several runs)
+    :param entry_points: the modules to import, ENTRY_POINTS if None
+    :param repeat: number of runs per module
+    :return: a dictionary with, for each module, the median import and process times (in ms),
+            and the LAZY_MODULES it imported
+    """
+    if entry_points is None:
+        entry_points = ENTRY_POINTS
+    results = {}
+    for module in entry_points:
+        runs = [measure_import(module) for _ in range(repeat)]
+        results[module] = {"import_ms": 1000 * statistics.median(run[0] for run in runs),
+                           "process_ms": 1000 * statistics.median(run[1] for run in runs),
+                           "lazy_loaded": sorted(set(name for run in runs for name in run[2]))}
+    return results
+
+
+def main(argv=None) -> int:
+    """
+    Prints the import times of the entry points
+    :param argv: the arguments (sys.argv[1:] if None)
+    :return: exit code, 1 if an entry point imports a lazy module or exceeds the budget
+    """
+    parser = argparse.ArgumentParser(prog="python -m macaron_plancomplexity.import_benchmark",
+                                     description="Measures the import time of the entry points of the package")
+    parser.add_argument("modules", nargs="*", default=None, help="modules to import (default: entry points)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per module (default: %(default)s)")
+    parser.add_argument("-b", "--budget", type=float, default=None, metavar="MS",
+                        help="maximum median import time of each module, in ms")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.modules if args.modules else None, args.repeat)
+    failed = False
+    print("%-45s %10s %10s  %s" % ("module", "import ms", "process ms", "lazy modules imported"))
+    for module, result in results.items():
+        print("%-45s %10.1f %10.1f  %s" % (module, result["import_ms"], result["process_ms"],
+                                            ", ".join(result["lazy_loaded"]) or "-"))
+        if len(result["lazy_loaded"]) > 0:
+            failed = True
+        if (args.budget is not None) and (result["import_ms"] > args.budget):
+            print("  import time exceeds the budget of " + str(args.budget) + " ms")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Optional JIT compilation of the per-leaf loops of the metrics.
+The kernels below are plain Python loops written so that numba can compile them; callers get the compiled
+version with compiled(kernel) and use their NumPy implementation when it returns None, i.e. when numba is not
+installed or when the environment variable MACARON_JIT is set to 0.
+numba is imported on the first request of a kernel (not when this module is imported), and compiled kernels
+are cached on disk, so that worker processes do not compile them again.
+Kernels give the same results as the NumPy implementations, sums being computed in the same order.
+"""
+
+import os
+
+import numpy as np
+
+# Compiled version of each kernel, None if numba is not available
+_compiled = {}
+_numba = None
+
+
+def import_numba():
+    """
+    Imports numba if installed and enabled (see MACARON_JIT)
+    :return: the numba module, None if it cannot be used
+    """
+    global _numba
+    if _numba is None:
+        _numba = False
+        if os.environ.get("MACARON_JIT", "1") != "0":
+            try:
+                import numba
+                _numba = numba
+            except ImportError:
+                pass
+    return _numba if _numba is not False else None
+
+
+def compiled(kernel):
+    """
+    Gets the numba-compiled version of a kernel of this module, compiling it on first request
+    :param kernel: the kernel function
+    :return: the compiled function, None if numba cannot be used (the NumPy implementation has to be used)
+    """
+    if kernel not in _compiled:
+        numba = import_numba()
+        _compiled[kernel] = numba.njit(cache=True)(kernel) if numba is not None else None
+    return _compiled[kernel]
+
+
+def undo_cumulative_sum_kernel(cumulative_sum):
+    """
+    Kernel of PyMetersetsFromMetersetWeightsCreator.UndoCummulativeSum
+    :param cumulative_sum: 1D float array
+    :return: the values whose cumulative sum is cumulative_sum (each one split over the two neighbouring intervals)
+    """
+    values = np.zeros(len(cumulative_sum))
+    delta_prev = 0.0
+    for i in range(len(values) - 1):
+        delta_curr = cumulative_sum[i + 1] - cumulative_sum[i]
+        values[i] = 0.5 * delta_prev + 0.5 * delta_curr
+        delta_prev = delta_curr
+    values[-1] = 0.5 * delta_prev
+    return values
+
+
+def side_perimeter_kernel(left, right, tops, bottoms, jaws, field_size, outside):
+    """
+    Kernel of ArrayAperture.side_perimeter, with the if-chain of Aperture.SidePerimeter
+    :param left: (n_apertures x n_pairs) positions of bank A
+    :param right: (n_apertures x n_pairs) positions of bank B
+    :param tops: (n_pairs) leaf tops
+    :param bottoms: (n_pairs) leaf bottoms
+    :param jaws: (n_apertures x 4) jaw of each aperture (left, top, right, bottom)
+    :param field_size: (n_apertures x n_pairs) field size of each leaf pair
+    :param outside: (n_apertures x n_pairs) True for leaf pairs outside the jaw
+    :return: the side perimeter of each aperture
+    """
+    n_apertures, n_pairs = left.shape
+    perimeters = np.zeros(n_apertures)
+    for a in range(n_apertures):
+        jaw_left, jaw_top, jaw_right, jaw_bottom = jaws[a, 0], jaws[a, 1], jaws[a, 2], jaws[a, 3]
+        # Top end of first leaf pair
+        perimeter = field_size[a, 0]
+        for i in range(n_pairs):
+            # The top leaf pair of the first one is the last one
+            t = i - 1 if i > 0 else n_pairs - 1
+            if outside[a, t] and outside[a, i]:
+                side = 0.0
+            elif jaw_top <= bottoms[t]:
+                side = field_size[a, i]
+            elif jaw_bottom >= tops[i]:
+                side = field_size[a, t]
+            elif (left[a, i] > right[a, t]) or (right[a, i] < left[a, t]):
+                side = field_size[a, t] + field_size[a, i]
+            else:
+                side = (abs(max(jaw_left, left[a, t]) - max(jaw_left, left[a, i]))
+                        + abs(min(jaw_right, right[a, t]) - min(jaw_right, right[a, i])))
+            perimeter += side
+        # Bottom end of last leaf pair
+        perimeters[a] = perimeter + field_size[a, n_pairs - 1]
+    return perimeters
+
+
+def perimeter_lsv_kernel(left, right, active_count, pos_max):
+    """
+    Kernel of the perimeter and LSV sums of complexity_indexes_batch
+    :param left: (n_cp x n_active) left positions of the active MLCs, left-aligned
+    :param right: (n_cp x n_active) right positions of the active MLCs, left-aligned
+    :param active_count: number of active MLCs of each control point
+    :param pos_max: maximum aperture between misaligned MLCs of each control point
+    :return: the perimeter, and the left and right LSV sums of each control point
+    """
+    n_cp = left.shape[0]
+    perimeters = np.zeros(n_cp)
+    lsv_l = np.zeros(n_cp)
+    lsv_r = np.zeros(n_cp)
+    for c in range(n_cp):
+        count = active_count[c]
+        perimeter = abs(left[c, 0] - right[c, 0])
+        sum_l = 0.0
+        sum_r = 0.0
+        for k in range(1, count):
+            left_old, right_old = left[c, k - 1], right[c, k - 1]
+            left_new, right_new = left[c, k], right[c, k]
+            ap_old = abs(left_old - right_old)
+            ap_new = abs(left_new - right_new)
+            if (right_new <= left_old) or (left_new >= right_old):
+                # Two apertures do not overlap
+                contrib = ap_new + ap_old
+            elif (right_new <= right_old) and (left_new >= left_old):
+                # Old aperture wraps the new one
+                contrib = ap_old - ap_new
+            elif (right_new > right_old) and (left_new < left_old):
+                # New aperture wraps the old one
+                contrib = ap_new - ap_old
+            else:
+                # New aperture overlaps + exceeds on the right/left
+                contrib = abs(left_new - left_old) + abs(right_new - right_old)
+            perimeter += contrib
+            sum_l += pos_max[c] - abs(left_old - left_new)
+            sum_r += pos_max[c] - abs(right_old - right_new)
+        perimeters[c] = perimeter + abs(left[c, count - 1] - right[c, count - 1])
+        lsv_l[c] = sum_l
+        lsv_r[c] = sum_r
+    return perimeters, lsv_l, lsv_r
@@ -2,17 +2,16 @@
 # Copyright (c) 2017-2018 Victor G. L. Alves
 
 import numpy as np
-import pandas as pd
-from scipy import integrate
 
-from complexity.PyApertureMetric import (
-    PyMetersetsFromMetersetWeightsCreator,
-    PyAperturesFromBeamCreator,
-)
-from complexity.PyComplexityMetric import PyComplexityMetric
+from macaron_plancomplexity.ArrayApertureMetric import ArrayAperture, sequential_sum
+from macaron_plancomplexity.BeamQuantities import BeamQuantities
+from macaron_plancomplexity.PyApertureMetric import BeamTensor
+from macaron_plancomplexity.PyComplexityMetric import PyComplexityMetric
 
 
 class LeafSequenceVariability:
+    REQUIRES = ("outside_jaw", "field_size")
+
     def Calculate(self, aperture, aav_norm):
         """
             variability in segment shape for a
@@ -26,7 +25,7 @@ class LeafSequenceVariability:
             porated by defining pos max .
             The second IMRT segment characteristic that is considered
             for the overall determination of complexity is the area
-            of the beam aperture. The aperture area variability AAV is
+            of the beam aperture. The aperture area variability AAV is
             used to characterize the variation in segment area relative to
             the maximum aperture defined by all of the segments. Segments
             that are more similar in area to the maximum beam
@@ -47,7 +46,7 @@ class LeafSequenceVariability:
         ]
         N = len(pos)
         pos_max = np.max(pos, axis=0) - np.min(pos, axis=0)
-        tmp = np.sum(pos_max + np.diff(pos, axis=0), axis=0) / (N * pos_max)
+        tmp = np.sum(pos_max - np.abs(np.diff(pos, axis=0)), axis=0) / (N * pos_max)
         LSV = np.prod(tmp)
 
         num = sum(
@@ -57,6 +56,53 @@ class LeafSequenceVariability:
 
         return LSV * AAV
 
+    def CalculateBatch(self, apertures, aav_norm):
+        """
+            Same as Calculate, for all the apertures of an ArrayAperture at once
+        :param apertures: ArrayAperture (n_cp x n_leaves)
+        :param aav_norm: Maximum aperture area
+        :return: product LSV * AAV of each aperture
+        """
+        return self.CalculateQuantities(BeamQuantities(apertures), aav_norm)
+
+    def CalculateQuantities(self, quantities, aav_norm):
+        apertures = quantities.apertures
+        inside = ~quantities["outside_jaw"]
+        N = inside.sum(axis=-1)
+
+        # Leaves inside the jaws first, in their order, so that adjacent ones are next to each other
+        order = np.argsort(~inside, axis=-1, kind="stable")
+        pairs = np.arange(inside.shape[-1] - 1) < (N - 1)[..., None]
+
+        LSV = np.ones(N.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for positions in (apertures.left, apertures.right):
+                pos_max = (np.where(inside, positions, -np.inf).max(axis=-1)
+                           - np.where(inside, positions, np.inf).min(axis=-1))
+                steps = np.abs(np.diff(np.take_along_axis(positions, order, axis=-1), axis=-1))
+                total = sequential_sum(np.where(pairs, pos_max[..., None] - steps, 0.0))
+                LSV = LSV * total / (N * pos_max)
+
+        # Field sizes of leaves outside the jaws are 0
+        num = sequential_sum(quantities["field_size"])
+        AAV = num / aav_norm if aav_norm != 0 else np.zeros(N.shape)
+
+        return np.where(N > 0, LSV, np.nan) * AAV
+
+    @staticmethod
+    def MaximumAperture(left, right, inside):
+        """
+            Normalization of the AAV: sum over the leaf pairs of their maximum opening over all the apertures
+            of the beam, leaf pairs outside the jaw being ignored
+        :param left: (n_cp x n_leaves) bank A positions, clipped to the jaw
+        :param right: (n_cp x n_leaves) bank B positions, clipped to the jaw
+        :param inside: (n_cp x n_leaves) True for the leaf pairs inside the jaw
+        :return: the maximum aperture of the beam
+        """
+        max_right = np.where(inside, right, -np.inf).max(axis=0, initial=-np.inf)
+        min_left = np.where(inside, left, np.inf).min(axis=0, initial=np.inf)
+        return float(sequential_sum(np.where(inside.any(axis=0), max_right - min_left, 0.0)))
+
     @staticmethod
     def DivisionOrDefault(a, b):
         return a / b if b != 0 else 0
@@ -68,153 +114,243 @@ class ModulationComplexityScore(PyComplexityMetric):
             modulation complexity and plan deliverability. Med Phys 2010;37:505–15.
             http://dx.doi.org/10.1118/1.3276775."""
 
+    VERSION = 2
+    REQUIRES = LeafSequenceVariability.REQUIRES
+
     def CalculatePerAperture(self, apertures):
-        aav_norm = 0
-        for aperture in apertures:
-            posi = [
-                (lp.Left, lp.Right)
-                for lp in aperture.LeafPairs
-                if not lp.IsOutsideJaw()
-            ]
-            posi_max = np.max(posi, axis=0)
-            aav_norm += abs(posi_max[1] - posi_max[0])
+        pairs = [aperture.LeafPairs for aperture in apertures]
+        left = np.array([[max(lp.Jaw.Left, lp.Left) for lp in leaf_pairs] for leaf_pairs in pairs], dtype=float)
+        right = np.array([[min(lp.Jaw.Right, lp.Right) for lp in leaf_pairs] for leaf_pairs in pairs], dtype=float)
+        inside = np.array([[not lp.IsOutsideJaw() for lp in leaf_pairs] for leaf_pairs in pairs], dtype=bool)
         metric = LeafSequenceVariability()
+        aav_norm = metric.MaximumAperture(left, right, inside)
 
         return [metric.Calculate(aperture, aav_norm) for aperture in apertures]
 
+    def CalculatePerTensor(self, tensor):
+        quantities = tensor.Quantities
+        apertures = quantities.apertures
+        inside = ~quantities["outside_jaw"]
+        left = np.maximum(apertures.jaw_left, apertures.left)
+        right = np.minimum(apertures.jaw_right, apertures.right)
+        aav_norm = LeafSequenceVariability.MaximumAperture(left, right, inside)
+        return LeafSequenceVariability().CalculateQuantities(quantities, aav_norm)
+
 
 class ModulationIndexScore(PyComplexityMetric):
-    def CalculateForPlan(self, patient=None, plan=None, k=0.02):
+    """
+        Jong Min Park et al - "Modulation indices for volumetric modulated arc therapy"
+        https://iopscience.iop.org/article/10.1088/0031-9155/59/23/7315
+        See table 1
+
+        The speed, acceleration and total modulation indices are computed for the whole plan
+        (there is no value per control point), integrating over f in [0, k] with k = 2 as in the paper
+    """
+
+    VERSION = 2
+    PER_CONTROL_POINT = False
+    REQUIRES = ()
+    COMPONENTS = ["speed", "acceleration", "total"]
+
+    def CalculateForPlan(self, patient=None, plan=None, k=2.0):
+        """
+            Modulation indices of the treatment beams of a plan: differences between control points are taken
+            within each beam, and pooled over the beams
+        :param k: upper bound of the integration over f
+        :return: speed, acceleration and total modulation indices (NaN without treatment beam)
+        """
+        tensors = [
+            BeamTensor.from_beam(beam)
+            for beam in plan["beams"].values()
+            if beam["TreatmentDeliveryType"] == "TREATMENT" and "MU" in beam and beam["MU"] > 0.0
+        ]
+        if len(tensors) == 0:
+            return np.nan, np.nan, np.nan
+        return self.CreateModulationIndex(tensors).calculate_integrate(k=k)
+
+    def CalculateForBeam(self, patient, plan, beam, k=2.0):
+        tensor = BeamTensor.from_beam(beam)
+        return self.CreateModulationIndex([tensor]).calculate_integrate(k=k)
+
+    @staticmethod
+    def CreateModulationIndex(tensors):
         """
-            Jong Min Park et al - "Modulation indices for volumetric modulated arc therapy"
-            https://iopscience.iop.org/article/10.1088/0031-9155/59/23/7315
-            See table 1
+            Returns the ModulationIndexTotal of the control points of beam tensors, one beam after the other
+        :param tensors: list of BeamTensor, all with the same MLC
         """
-        apertures = []
-        cumulative_metersets = []
-        meterset_creator = PyMetersetsFromMetersetWeightsCreator()
-        for k, beam in plan["beams"].items():
-            apertures += PyAperturesFromBeamCreator().Create(beam)
-            cum = meterset_creator.GetCumulativeMetersets(beam)
-            cumulative_metersets.append(cum)
-
-        cumulative_mu = np.concatenate(cumulative_metersets)
-        mid = ModulationIndexTotal(apertures, cumulative_mu)
-        return mid.calculate_integrate(k=k)
-
-    def CalculateForBeam(self, patient, plan, beam, k=0.02):
-        apertures = PyAperturesFromBeamCreator().Create(beam)
-        cumulative_metersets = PyMetersetsFromMetersetWeightsCreator().GetCumulativeMetersets(
-            beam
+        starts = np.cumsum([0] + [tensor.ControlPointCount for tensor in tensors[:-1]])
+        apertures = ArrayAperture(
+            np.concatenate([tensor.leaf_positions for tensor in tensors]),
+            tensors[0].leaf_widths,
+            np.concatenate([tensor.jaws for tensor in tensors]),
+        )
+        return ModulationIndexTotal(
+            apertures,
+            np.concatenate([tensor.cumulative_metersets[tensor.control_point_indexes] for tensor in tensors]),
+            np.concatenate([tensor.gantry_angles for tensor in tensors]),
+            starts,
         )
-        mid = ModulationIndexTotal(apertures, cumulative_metersets)
-        return mid.calculate_integrate(k=k)
 
 
 class ModulationIndexTotal:
-    def __init__(self, apertures, cumulative_mu):
+    """
+        Speed, acceleration and total modulation indices, computed with NumPy.
+        Differences between control points follow pandas conventions: the first value of a difference is NaN,
+        and standard deviations ignore NaN values (ddof=1).
+        Apertures may come from several beams: differences are NaN at the first control point of each beam,
+        so that they are only taken within beams.
+    """
+
+    def __init__(self, apertures, cumulative_mu, gantry_angles=None, beam_starts=None):
+        """
+        :param apertures: list of apertures, or an ArrayAperture with all of them
+        :param cumulative_mu: cumulative meterset of each aperture
+        :param gantry_angles: gantry angle of each aperture, taken from the apertures if None
+        :param beam_starts: index of the first aperture of each beam (None for a single beam)
+        """
         # beam data
         self.apertures = apertures
-        self.Ncp = len(self.apertures)
+        self.mlc_positions = self.get_positions(self.apertures)
+        self.Ncp = self.mlc_positions.shape[0]
+        self.beam_starts = np.unique(np.append(0, [] if beam_starts is None else beam_starts)).astype(int)
+        # number of speed and acceleration values (differences between control points of the same beam)
+        self.n_speed = self.Ncp - len(self.beam_starts)
+        self.n_acceleration = self.Ncp - 2 * len(self.beam_starts)
 
         # meterset data
-        self.cumulative_mu = self.get_mu_data(cumulative_mu)
+        self.cumulative_mu = np.asarray(cumulative_mu, dtype=float)
+        if len(self.cumulative_mu) != self.Ncp:
+            raise ValueError("Expected one cumulative meterset per aperture")
+        self.delta_mu = self.abs_diff(self.cumulative_mu, self.beam_starts)
+        self.time = self.calculate_time(self.delta_mu)
 
         # MLC position data
-        self.mlc_positions = self.get_positions(self.apertures)
-        self.mlc_speed = (
-            self.mlc_positions.diff().abs().T / self.cumulative_mu["time"]
-        ).T
-        self.mlc_speed_std = self.mlc_speed.std()
-        self.mlc_acceleration = (
-            self.mlc_speed.diff().abs().T / self.cumulative_mu["time"]
-        ).T
-        self.mlc_acceleration_std = self.mlc_acceleration.std()
+        self.mlc_speed = self.abs_diff(self.mlc_positions, self.beam_starts) / self.time[:, None]
+        self.mlc_speed_std = self.std(self.mlc_speed)
+        self.mlc_acceleration = self.abs_diff(self.mlc_speed, self.beam_starts) / self.time[:, None]
+        self.mlc_acceleration_std = self.std(self.mlc_acceleration)
 
         # gantry data
-        gantry_angles = np.array([ap.GantryAngle for ap in self.apertures])
-        self.gantry = pd.DataFrame(gantry_angles, columns=["gantry"])
-        self.gantry["delta_gantry"] = self.rolling_apply(
-            self.delta_gantry, gantry_angles
-        )
-        self.gantry["gantry_speed"] = (
-            self.gantry["delta_gantry"] / self.cumulative_mu["time"]
-        )
-        self.gantry["delta_gantry_speed"] = self.gantry["gantry_speed"].diff().abs()
-        self.gantry["gantry_acc"] = (
-            self.gantry["delta_gantry_speed"] / self.cumulative_mu["time"]
-        )
+        if gantry_angles is None:
+            gantry_angles = [ap.GantryAngle for ap in self.apertures]
+        self.gantry_angles = np.array(gantry_angles, dtype=float)
+        self.delta_gantry = self.calculate_delta_gantry(self.gantry_angles, self.beam_starts)
+        self.gantry_speed = self.delta_gantry / self.time
+        self.delta_gantry_speed = self.abs_diff(self.gantry_speed, self.beam_starts)
+        self.gantry_acc = self.delta_gantry_speed / self.time
 
         # dose rate data
-        self.dose_rate = pd.DataFrame(
-            self.cumulative_mu["delta_mu"] / self.cumulative_mu["time"], columns=["DR"]
-        )
-        self.dose_rate["delta_dose_rate"] = self.dose_rate.diff().abs()
-
-    def get_mu_data(self, cumulative_mu):
-        # meterset data
-        tmp = pd.DataFrame(cumulative_mu, columns=["MU"])
-        tmp["delta_mu"] = tmp.diff().abs()
-        tmp["time"] = tmp["delta_mu"].apply(self.calculate_time)
-        return tmp
+        self.dose_rate = self.delta_mu / self.time
+        self.delta_dose_rate = self.abs_diff(self.dose_rate, self.beam_starts)
 
     @staticmethod
     def calculate_time(delta_mu):
         """
             Calculate time between control points in seconds
-        :param delta_mu:
+        :param delta_mu: MU delivered between control points (NaN gives NaN)
         :return: time in seconds
         """
-        if delta_mu <= 4.238:
-            return 2.0341 / 4.8
-        elif delta_mu > 4.238:
-            return delta_mu / 10
+        delta_mu = np.asarray(delta_mu, dtype=float)
+        return np.where(delta_mu <= 4.238, 2.0341 / 4.8, delta_mu / 10)
+
+    @staticmethod
+    def calculate_delta_gantry(gantry_angles, starts=(0,)):
+        """
+            Gantry rotation between each control point and the previous one, in [0, 180] degrees
+        :param gantry_angles: gantry angle of each control point
+        :param starts: index of the first control point of each beam
+        :return: the rotations, NaN for the first control point of each beam
+        """
+        phi = np.abs(np.diff(gantry_angles)) % 360
+        delta = np.concatenate(([np.nan], np.where(phi > 180, 360 - phi, phi)))
+        delta[np.asarray(starts, dtype=int)] = np.nan
+        return delta
 
     @staticmethod
-    def delta_gantry(param):
-        alpha, beta = param
-        phi = abs(beta - alpha) % 360
-        return 360 - phi if phi > 180 else phi
+    def abs_diff(values, starts=(0,)):
+        """
+            Absolute difference between each row and the previous one (as pandas diff().abs())
+        :param values: 1D or 2D array, one row per control point
+        :param starts: index of the first control point of each beam
+        :return: the differences, NaN for the first row of each beam
+        """
+        values = np.asarray(values, dtype=float)
+        first = np.full((1,) + values.shape[1:], np.nan)
+        delta = np.concatenate((first, np.abs(np.diff(values, axis=0))))
+        delta[np.asarray(starts, dtype=int)] = np.nan
+        return delta
 
     @staticmethod
-    def rolling_apply(fun, a, w=2):
-        r = np.empty(a.shape)
-        r.fill(np.nan)
-        for i in range(w - 1, a.shape[0]):
-            r[i] = fun(a[(i - w + 1) : i + 1])
-        return r
+    def std(values):
+        """
+            Standard deviation of each column ignoring NaN values, with ddof=1 (as pandas std)
+        :param values: 2D array
+        :return: the standard deviations, NaN for columns with less than 2 values
+        """
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        mean = np.where(valid, values, 0.0).sum(axis=0) / np.maximum(count, 1)
+        squares = np.where(valid, (values - mean) ** 2, 0.0).sum(axis=0)
+        return np.where(count > 1, np.sqrt(squares / np.maximum(count - 1, 1)), np.nan)
 
     @staticmethod
     def get_positions(apertures):
+        """
+            Leaf positions of each aperture: Left and Right of each leaf pair, interleaved
+        :param apertures: list of apertures, or an ArrayAperture
+        :return: (n_cp x 2 n_leaves) array
+        """
+        if isinstance(apertures, ArrayAperture):
+            return np.stack((apertures.left, apertures.right), axis=-1).reshape(apertures.left.shape[0], -1)
+
         pos = []
         for aperture in apertures:
-            cp_pos = [(lp.Left, lp.Right) for lp in aperture.LeafPairs]
-            arr = np.ravel(cp_pos)
-            pos.append(arr)
+            if hasattr(aperture, "geometry"):
+                cp_pos = np.column_stack((aperture.geometry.left, aperture.geometry.right))
+            else:
+                cp_pos = [(lp.Left, lp.Right) for lp in aperture.LeafPairs]
+            pos.append(np.ravel(cp_pos))
 
-        return pd.DataFrame(pos)
+        return np.array(pos, dtype=float)
+
+    @staticmethod
+    def threshold_limits(values, thresholds):
+        """
+            Values of f below which "values > f * thresholds" holds, for f >= 0.
+            The condition is a step function of f: true for f < values / thresholds,
+            always true if the threshold is 0 and the value positive, never true if the threshold is NaN
+        :param values: 2D array of non-negative values (without NaN)
+        :param thresholds: threshold of each column
+        :return: the limit of each value (inf if the condition always holds)
+        """
+        thresholds = np.broadcast_to(thresholds, values.shape)
+        limits = np.where((thresholds == 0) & (values > 0), np.inf, 0.0)
+        positive = thresholds > 0
+        limits[positive] = values[positive] / thresholds[positive]
+        return limits
 
     def calc_mi_speed(self, mlc_speed, speed_std, k=1.0):
+        """
+            Integral over f in [0, k] of the fraction of MLC speeds above f * std: each speed contributes the length
+            of the interval where it is counted, its limit clipped to [0, k]
+        """
+        limits = self.threshold_limits(mlc_speed, speed_std)
+        return np.clip(limits, 0.0, k).sum() / self.n_speed
 
-        calc_z = (
-            lambda f: 1 / (self.Ncp - 1) * np.sum(np.sum(mlc_speed > f * speed_std))
-        )
-        res = integrate.quad(calc_z, 0, k)
-        return res[0]
+    def acceleration_measures(self, mlc_speed, speed_std, mlc_acc, mlc_acc_std, k=1.0, alpha=1.0):
+        """
+            Length of the interval of f in [0, k] where the speed or the acceleration of each MLC is above its threshold
+            (a union of two intervals starting at 0, so the longest one)
+        """
+        limits = np.maximum(self.threshold_limits(mlc_speed, speed_std),
+                            self.threshold_limits(mlc_acc, alpha * mlc_acc_std))
+        return np.clip(limits, 0.0, k)
 
     def calc_mi_acceleration(
         self, mlc_speed, speed_std, mlc_acc, mlc_acc_std, k=1.0, alpha=1.0
     ):
-
-        z_acc = lambda f: (1 / (self.Ncp - 2)) * np.nansum(
-            np.nansum(
-                np.logical_or(
-                    mlc_speed > f * speed_std, mlc_acc > alpha * f * mlc_acc_std
-                )
-            )
-        )
-        res = integrate.quad(z_acc, 0, k)
-        return res[0]
+        measures = self.acceleration_measures(mlc_speed, speed_std, mlc_acc, mlc_acc_std, k, alpha)
+        return measures.sum() / self.n_acceleration
 
     def calc_mi_total(
         self,
@@ -227,52 +363,37 @@ class ModulationIndexTotal:
         WGA=None,
         WMU=None,
     ):
+        measures = self.acceleration_measures(mlc_speed, speed_std, mlc_acc, mlc_acc_std, k, alpha)
+        return np.nansum(measures.sum(axis=1) * WGA * WMU) / self.n_acceleration
 
-        z_total = lambda f: (1 / (self.Ncp - 2)) * np.nansum(
-            np.nansum(
-                np.logical_or(
-                    mlc_speed > f * speed_std, mlc_acc > alpha * f * mlc_acc_std
-                ),
-                axis=1,
-            )
-            * WGA
-            * WMU
-        )
-
-        res = integrate.quad(z_total, 0, k)
-
-        return res[0]
-
-    def calculate_integrate(self, k=1.0, beta=2.0, alpha=2.0):
+    def calculate_integrate(self, k=2.0, beta=2.0, alpha=2.0):
 
         # fill NAN
         mlc_speed = np.nan_to_num(self.mlc_speed)
         mlc_acc = np.nan_to_num(self.mlc_acceleration)
 
-        mis = self.calc_mi_speed(mlc_speed, self.mlc_speed_std.values, k)
+        mis = self.calc_mi_speed(mlc_speed, self.mlc_speed_std, k)
 
-        alpha_acc = 1.0 / self.cumulative_mu["time"].mean()
+        alpha_acc = 1.0 / np.nanmean(self.time)
         mia = self.calc_mi_acceleration(
             mlc_speed,
-            self.mlc_speed_std.values,
+            self.mlc_speed_std,
             mlc_acc,
-            self.mlc_acceleration_std.values,
+            self.mlc_acceleration_std,
             k=k,
             alpha=alpha_acc,
         )
 
-        gantry_acc = self.gantry["gantry_acc"].values
-        WGA = beta / (1 + (beta - 1) * np.exp(-gantry_acc / alpha))
+        WGA = beta / (1 + (beta - 1) * np.exp(-self.gantry_acc / alpha))
 
         # Wmu
-        delta_dose_rate = self.dose_rate["delta_dose_rate"].values
-        WMU = beta / (1 + (beta - 1) * np.exp(-delta_dose_rate / alpha))
+        WMU = beta / (1 + (beta - 1) * np.exp(-self.delta_dose_rate / alpha))
 
         mit = self.calc_mi_total(
             mlc_speed,
-            self.mlc_speed_std.values,
+            self.mlc_speed_std,
             mlc_acc,
-            self.mlc_acceleration_std.values,
+            self.mlc_acceleration_std,
             k=k,
             alpha=alpha_acc,
             WGA=WGA,
@@ -283,28 +404,27 @@ class ModulationIndexTotal:
 
     def calculate(self, f=1.0, beta=2.0, alpha=2.0):
 
-        # speed MI
-        mask_speed_std = self.mlc_speed > f * self.mlc_speed_std
-        Ns = mask_speed_std.sum().sum()
-        z_speed = 1 / (self.Ncp - 1) * Ns
+        # speed MI (comparisons with NaN are False)
+        with np.errstate(invalid="ignore"):
+            mask_speed_std = self.mlc_speed > f * self.mlc_speed_std
+        Ns = mask_speed_std.sum()
+        z_speed = 1 / self.n_speed * Ns
 
         # acc MI
-        alpha_acc = 1.0 / self.cumulative_mu["time"].mean()
-        mask_acc_std = self.mlc_acceleration > alpha_acc * f * self.mlc_acceleration_std
+        alpha_acc = 1.0 / np.nanmean(self.time)
+        with np.errstate(invalid="ignore"):
+            mask_acc_std = self.mlc_acceleration > alpha_acc * f * self.mlc_acceleration_std
 
         mask_acc_mi = np.logical_or(mask_speed_std, mask_acc_std)
-        Nacc = mask_acc_mi.sum().sum()
-        z_acc = 1 / (self.Ncp - 2) * Nacc
+        Nacc = mask_acc_mi.sum()
+        z_acc = 1 / self.n_acceleration * Nacc
 
         # Total MI
-        gantry_acc = self.gantry["gantry_acc"]
-        WGA = beta / (1 + (beta - 1) * np.exp(-gantry_acc / alpha))
+        WGA = beta / (1 + (beta - 1) * np.exp(-self.gantry_acc / alpha))
 
         # Wmu
-        delta_dose_rate = self.dose_rate["delta_dose_rate"]
-        WMU = beta / (1 + (beta - 1) * np.exp(-delta_dose_rate / alpha))
+        WMU = beta / (1 + (beta - 1) * np.exp(-self.delta_dose_rate / alpha))
 
-        tmp = mask_acc_mi.multiply(WGA, axis="index").multiply(WMU, axis="index")
-        Mti = tmp.sum().sum() / (self.Ncp - 2)
+        Mti = np.nansum(mask_acc_mi.sum(axis=1) * WGA * WMU) / self.n_acceleration
 
         return z_speed, z_acc, Mti
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 
@@ -5,9 +6,14 @@ import shutil
 import pydicom
 from pydicom import FileDataset
 
+from macaron_plancomplexity.ControlPointTable import ControlPointTable
 from macaron_plancomplexity.DICOMType import DICOMType
 
 
+# Attributes read by load_DICOM_header
+HEADER_TAGS = ["SOPClassUID", "SOPInstanceUID", "PatientName"]
+
+
 def clear_folder(folder: str) -> None:
     """
     Clears data in existing folder
@@ -30,28 +36,88 @@ def load_DICOM(file_path: str, sanitize: bool = True):
     Loads a DICOM object from a file
     :param file_path: path to the DICOM file
     :param sanitize: True if a TransferSyntaxUID field may be missing from the DICOM file
+                    (it is then added to the loaded object, the file is left unchanged)
     :return: the DICOMObject and its DICOMType
     """
     dicom_ob = pydicom.read_file(file_path, force=True)
-    if sanitize and ("TransferSyntaxUID" not in dicom_ob.file_meta):
-        sanitize_DICOM(file_path)
-        dicom_ob = pydicom.read_file(file_path, force=True)
+    if sanitize:
+        set_transfer_syntax(dicom_ob)
     dicom_type = get_DICOM_type_from_object(dicom_ob)
     return dicom_ob, dicom_type
 
 
+def load_DICOM_header(file_path: str):
+    """
+    Loads only the file meta and the attributes needed to classify and name a DICOM file,
+    skipping all other values (and pixel data): cheap enough to scan whole DICOM exports
+    :param file_path: path to the DICOM file
+    :return: the (partial) DICOMObject and its DICOMType, or None, None if the file cannot be read
+    """
+    try:
+        dicom_ob = pydicom.read_file(file_path, force=True, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except Exception as e:
+        print('Failed to read header of %s. Reason: %s' % (file_path, e))
+        return None, None
+    uid = getattr(dicom_ob, 'SOPClassUID', None)
+    file_meta = getattr(dicom_ob, 'file_meta', None)
+    if (uid is None) and (file_meta is not None):
+        uid = getattr(file_meta, 'MediaStorageSOPClassUID', None)
+    return dicom_ob, get_DICOM_type_from_ID(uid)
+
+
+def plan_fingerprint(file_path: str, sop_instance_uid: str = None, content_hash: bool = False) -> str:
+    """
+    Computes a fingerprint identifying a version of a DICOM file: it changes whenever the file changes
+    :param file_path: path to the DICOM file
+    :param sop_instance_uid: the SOPInstanceUID of the DICOM object, if known
+    :param content_hash: True to hash the content of the file (SHA-256) instead of using its size and
+                    modification time: slower, but robust to copies that do not preserve timestamps
+    :return: the fingerprint string
+    """
+    if content_hash:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        version = "sha256=" + digest.hexdigest()
+    else:
+        stat = os.stat(file_path)
+        version = "size=" + str(stat.st_size) + ";mtime=" + str(stat.st_mtime_ns)
+    return str(sop_instance_uid) + ";" + version
+
+
 def sanitize_DICOM(file_path: str) -> None:
     """
     Updates a DICOM file by adding a TransferSyntaxUID parameter (default value)
     :param file_path: file to sanitize
     """
     ds = pydicom.read_file(file_path, force=True)
-    if "TransferSyntaxUID" not in ds.file_meta:
-        ds.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+    if set_transfer_syntax(ds, pydicom.uid.ImplicitVRLittleEndian):
         print("Adding parameter 'TransferSyntaxUID' to DICOM")
         pydicom.write_file(file_path, ds)
 
 
+def set_transfer_syntax(dicom_ob: FileDataset, transfer_syntax: str = None) -> bool:
+    """
+    Adds a TransferSyntaxUID parameter to a loaded DICOM object that lacks it (in memory only)
+    :param dicom_ob: the FileDataset object
+    :param transfer_syntax: the UID to set, if None the one matching the encoding the object was read with
+    :return: True if the parameter was added, False if it was already present
+    """
+    if getattr(dicom_ob, "file_meta", None) is None:
+        dicom_ob.file_meta = pydicom.dataset.FileMetaDataset()
+    if "TransferSyntaxUID" in dicom_ob.file_meta:
+        return False
+    if transfer_syntax is None:
+        if dicom_ob.is_implicit_VR is False:
+            transfer_syntax = (pydicom.uid.ExplicitVRBigEndian if dicom_ob.is_little_endian is False
+                               else pydicom.uid.ExplicitVRLittleEndian)
+        else:
+            transfer_syntax = pydicom.uid.ImplicitVRLittleEndian
+    dicom_ob.file_meta.TransferSyntaxUID = transfer_syntax
+    return True
+
+
 def get_DICOM_type(dicom_ob: FileDataset) -> DICOMType:
     """
     Gets the DICOMType corresponding to the FileDataset object
@@ -228,7 +294,7 @@ def write_rec_dict(out_f, dict_obj, prequel):
                 else:
                     new_prequel = prequel + "," + str(key) if (prequel is not None) and (len(prequel) > 0) else str(key)
                     write_rec_dict(out_f, dict_obj[key], new_prequel)
-            elif type(dict_obj[key]) is list:
+            elif (type(dict_obj[key]) is list) or isinstance(dict_obj[key], ControlPointTable):
                 item_count = 1
                 for item in dict_obj[key]:
                     new_prequel = prequel + "," + str(key) + ",item" + str(item_count) \
@@ -0,0 +1,146 @@
+"""Library metrics of a plan with a setup beam (jaws only, no MLC), with and without MetricCache"""
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ImplicitVRLittleEndian, generate_uid
+
+from macaron_plancomplexity.complexity_utils import calculate_RTPlan_lib_metrics
+from macaron_plancomplexity.MetricCache import MetricCache
+from macaron_plancomplexity.PyComplexityMetric import PyComplexityMetric
+
+RT_PLAN_STORAGE = "1.2.840.10008.5.1.4.1.1.481.5"
+
+
+def jaw_positions(x, y):
+    devices = []
+    for device_type, positions in (("ASYMX", x), ("ASYMY", y)):
+        device = Dataset()
+        device.RTBeamLimitingDeviceType = device_type
+        device.LeafJawPositions = positions
+        devices.append(device)
+    return devices
+
+
+def make_beam(number, delivery_type, n_cp, rng, bounds=None):
+    beam = Dataset()
+    beam.BeamNumber = number
+    beam.BeamName = delivery_type + str(number)
+    beam.BeamType = "DYNAMIC" if bounds is not None else "STATIC"
+    beam.RadiationType = "PHOTON"
+    beam.PrimaryDosimeterUnit = "MU"
+    beam.TreatmentDeliveryType = delivery_type
+    beam.TreatmentMachineName = "TB"
+    beam.Manufacturer = "Varian"
+    beam.NumberOfControlPoints = n_cp
+    beam.FinalCumulativeMetersetWeight = 1
+    devices = []
+    for device_type in ("ASYMX", "ASYMY", "MLCX") if bounds is not None else ("ASYMX", "ASYMY"):
+        device = Dataset()
+        device.RTBeamLimitingDeviceType = device_type
+        device.NumberOfLeafJawPairs = 1
+        if device_type == "MLCX":
+            device.NumberOfLeafJawPairs = len(bounds) - 1
+            device.LeafPositionBoundaries = list(bounds)
+        devices.append(device)
+    beam.BeamLimitingDeviceSequence = Sequence(devices)
+    control_points = Sequence()
+    for index in range(n_cp):
+        control_point = Dataset()
+        control_point.ControlPointIndex = index
+        control_point.CumulativeMetersetWeight = index / (n_cp - 1)
+        control_point.GantryAngle = round(181 + index * 358.0 / (n_cp - 1), 1) % 360
+        if index == 0:
+            control_point.NominalBeamEnergy = 6
+            control_point.DoseRateSet = 600
+            control_point.IsocenterPosition = [0.0, 0.0, 0.0]
+            control_point.GantryRotationDirection = "CW"
+            control_point.BeamLimitingDeviceAngle = 10
+            control_point.TableTopEccentricAngle = 0
+        positions = jaw_positions([-60.0, 60.0], [-50.0, 50.0])
+        if bounds is not None:
+            mlc = Dataset()
+            mlc.RTBeamLimitingDeviceType = "MLCX"
+            left = np.round(rng.normal(-10, 15, len(bounds) - 1), 1)
+            right = np.round(left + np.abs(rng.normal(15, 10, len(bounds) - 1)), 1)
+            mlc.LeafJawPositions = [float(v) for v in np.concatenate((left, right))]
+            positions.append(mlc)
+        control_point.BeamLimitingDevicePositionSequence = Sequence(positions)
+        control_points.append(control_point)
+    beam.ControlPointSequence = control_points
+    return beam
+
+
+@pytest.fixture
+def setup_beam_plan(tmp_path):
+    """RTPlan file with two treatment beams and a setup beam with jaws only"""
+    path = str(tmp_path / "RP.dcm")
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = RT_PLAN_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = RT_PLAN_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.PatientName = "PAT^SETUP"
+    ds.PatientID = "ID"
+    ds.PatientSex = "F"
+    ds.StudyID = "S1"
+    ds.StudyDate = "20200101"
+    ds.StudyDescription = "setup beam"
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Manufacturer = "Varian"
+    ds.ManufacturerModelName = "Eclipse"
+    ds.SoftwareVersions = "15"
+    ds.RTPlanLabel = "plan"
+    ds.RTPlanName = "P"
+    ds.RTPlanDescription = "setup beam"
+    ds.RTPlanDate = "20200101"
+    ds.RTPlanTime = "120000"
+    rng = np.random.default_rng(0)
+    bounds = np.arange(-100, 101, 10, dtype=float)
+    ds.BeamSequence = Sequence([make_beam(1, "TREATMENT", 20, rng, bounds), make_beam(2, "TREATMENT", 20, rng, bounds),
+                                make_beam(3, "SETUP", 2, rng)])
+    references = Sequence()
+    # The setup beam delivers no dose: it is not referenced by the fraction group
+    for number, meterset in ((1, 150.0), (2, 250.0)):
+        reference = Dataset()
+        reference.ReferencedBeamNumber = number
+        reference.BeamMeterset = meterset
+        reference.BeamDose = 1.0
+        references.append(reference)
+    fraction_group = Dataset()
+    fraction_group.ReferencedBeamSequence = references
+    fraction_group.NumberOfFractionsPlanned = 25
+    ds.FractionGroupSequence = Sequence([fraction_group])
+    ds.is_little_endian = True
+    ds.is_implicit_VR = True
+    ds.save_as(path)
+    return path
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+@pytest.mark.parametrize("generate_plots", [False, True])
+def test_setup_beam(setup_beam_plan, tmp_path, use_cache, generate_plots):
+    cache = MetricCache(str(tmp_path / "cache.db")) if use_cache else None
+    expected, _ = calculate_RTPlan_lib_metrics(setup_beam_plan, "P", generate_plots=False)
+    # Twice with the cache: results are computed, then read back
+    for _ in range(2 if use_cache else 1):
+        metrics, images = calculate_RTPlan_lib_metrics(setup_beam_plan, "P", generate_plots=generate_plots,
+                                                       output_folder=str(tmp_path), cache=cache,
+                                                       fingerprint="plan" if use_cache else None)
+        assert metrics == expected
+        if generate_plots:
+            # One plot per treatment beam, none for the setup beam
+            assert len(images["PyComplexityMetric"]) == 2
+
+
+def test_cached_series_of_treatment_beams_are_not_plotted(setup_beam_plan, tmp_path):
+    cache = MetricCache(str(tmp_path / "cache.db"))
+    calculate_RTPlan_lib_metrics(setup_beam_plan, "P", generate_plots=False, cache=cache, fingerprint="plan")
+    key = ("plan", PyComplexityMetric.__name__, PyComplexityMetric.VERSION)
+    assert cache.get(*key)[2] is False
+    calculate_RTPlan_lib_metrics(setup_beam_plan, "P", generate_plots=True, output_folder=str(tmp_path),
+                                 cache=cache, fingerprint="plan")
+    assert cache.get(*key)[2] is True